@@ -47,6 +47,31 @@ def parse_args():
         required=False
     )
     
+    parser.add_argument(
+        "-method",
+        "--method",
+        help="The integration method used for calculating UV dosage for a period. (OPTIONAL: defaults to adaptive)",
+        choices=["rectangle", "trapezoid", "simpson", "adaptive"],
+        default="adaptive",
+        required=False
+    )
+    
+    parser.add_argument(
+        "-profile",
+        "--profile",
+        help="A file to write cProfile statistics for the run to, e.g. ./output/run.prof. It can be viewed with pstats, snakeviz or flameprof. (OPTIONAL)",
+        type=str,
+        required=False
+    )
+    
+    parser.add_argument(
+        "-timings",
+        "--timings",
+        help="A JSON file to write the time spent in each stage of the run and the cache and download counters to. (OPTIONAL)",
+        type=str,
+        required=False
+    )
+    
 #     parser.add_argument(
 #         "-lat",
 #         "--latitude",
@@ -63,4 +88,62 @@ def parse_args():
 #         required=False
 #     )
     
-    return parser.parse_args()
\ No newline at end of file
+    return parser.parse_args()
+
+def parse_batch_args():
+    """
+    A function to create an argument parser for batch mode, where many locations and times are read from a file.
+    """
+    
+    parser = argparse.ArgumentParser()
+    
+    parser.add_argument(
+        "-i",
+        "--input",
+        type=str,
+        help="A CSV or Parquet file with a location column or latitude and longitude columns, and a time column or start and end columns.",
+        required=True
+    )
+    
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="The CSV or Parquet file which the results are written to.",
+        required=True
+    )
+    
+    parser.add_argument(
+        "-chunk",
+        "--chunk_size",
+        help="The number of rows read and processed at a time. (OPTIONAL)",
+        type=int,
+        default=100000,
+        required=False
+    )
+    
+    parser.add_argument(
+        "-workers",
+        "--workers",
+        help="The number of worker processes. (OPTIONAL: defaults to the number of CPUs)",
+        type=int,
+        required=False
+    )
+    
+    parser.add_argument(
+        "-utc",
+        "--utc",
+        help="Whether the times in the input file are in UTC rather than the local time of each location. (OPTIONAL)",
+        required=False,
+        action="store_true"
+    )
+    
+    parser.add_argument(
+        "-format",
+        "--time_format",
+        help="The format of the times in the input file, e.g. %%d/%%m/%%y %%H:%%M. (OPTIONAL: by default the format is inferred)",
+        type=str,
+        required=False
+    )
+    
+    return parser.parse_args()
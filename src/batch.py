@@ -0,0 +1,221 @@
+# import relevant packages
+import numpy as np
+import os
+import pandas as pd
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from src import parse_batch_args
+
+from utils.UV_exposure import dose, geocoding, incident_UV, ozone, timezones
+
+
+def read_chunks(path, chunk_size):
+    """
+    Reads a CSV or Parquet file in chunks of `chunk_size` rows.
+    """
+
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size = chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize = chunk_size)
+
+
+class ResultWriter:
+    """
+    Appends result chunks to a CSV or Parquet file as they are completed. A Parquet file takes its schema from the first
+    chunk, and later chunks are cast to it, e.g. a time column which is empty in one chunk is read as floats rather than strings.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._parquet_writer = None
+        self._header = True
+
+        if os.path.exists(path):
+            os.remove(path)
+
+    def write(self, df):
+        if self.path.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(df, preserve_index = False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.path, table.schema)
+            elif not table.schema.equals(self._parquet_writer.schema):
+                table = table.cast(self._parquet_writer.schema)
+            self._parquet_writer.write_table(table)
+        else:
+            df.to_csv(self.path, mode = 'a', header = self._header, index = False)
+            self._header = False
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+
+def _to_utc(values, timezone_names, time_format, utc):
+    """
+    Parses a column of times and converts them to naive UTC datetime64 values. Local times are converted with the
+    timezone of each row, one timezone at a time.
+    """
+
+    times = pd.to_datetime(values, format = time_format)
+    if utc:
+        return times.to_numpy(dtype = 'datetime64[us]')
+
+    utc_times = np.full(len(times), np.datetime64('NaT'), dtype = 'datetime64[us]')
+    for timezone_name in pd.unique(timezone_names):
+        if timezone_name is None:
+            continue
+        in_zone = np.asarray(timezone_names == timezone_name)
+        local = pd.DatetimeIndex(times[in_zone]).tz_localize(timezone_name, ambiguous = 'NaT', nonexistent = 'shift_forward')
+        utc_times[in_zone] = local.tz_convert('UTC').tz_localize(None).to_numpy(dtype = 'datetime64[us]')
+
+    return utc_times
+
+
+def prepare_chunk(df, geocoder, resolver, time_format = None, utc = False, ozone_for_day = ozone.get_ozone_grid):
+    """
+    Resolves the coordinates, UTC times and ozone days of a chunk in deduplicated bulk passes. This runs in the main
+    process, so that geocoding stays within its rate limit and ozone files are only downloaded once.
+    """
+
+    df = df.copy()
+
+    # a column with no values in a chunk is read as floats, so keep the text columns strings in every chunk
+    for column in ('location', 'time', 'start', 'end'):
+        if column in df and not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = df[column].astype('string')
+
+    if 'latitude' not in df or 'longitude' not in df:
+        coordinates = geocoder.geocode_many(df['location'].astype(str).unique())
+        df['latitude'] = df['location'].astype(str).map(lambda location: (coordinates[location] or (np.nan, np.nan))[0])
+        df['longitude'] = df['location'].astype(str).map(lambda location: (coordinates[location] or (np.nan, np.nan))[1])
+
+    # whole-degree coordinates are read as integers, so keep every chunk's columns the same type
+    df['latitude'], df['longitude'] = df['latitude'].astype(float), df['longitude'].astype(float)
+
+    timezone_names = None
+    if not utc:
+        found = df['latitude'].notna().to_numpy()
+        timezone_names = np.full(len(df), None, dtype = object)
+        timezone_names[found] = resolver.timezones_at(df['latitude'].to_numpy()[found], df['longitude'].to_numpy()[found])
+
+    for column in ('time', 'start', 'end'):
+        if column in df:
+            df['utc_' + column] = _to_utc(df[column], timezone_names, time_format, utc)
+
+    # Make sure every ozone grid the chunk needs is on disk before the workers load it
+    days = np.concatenate([df['utc_' + column].to_numpy(dtype = 'datetime64[D]') for column in ('time', 'start', 'end') if 'utc_' + column in df])
+    if 'utc_start' in df:
+        days = np.concatenate([days] + [np.arange(start, end + 1) for start, end in zip(df['utc_start'].to_numpy(dtype = 'datetime64[D]'), df['utc_end'].to_numpy(dtype = 'datetime64[D]'))
+                                        if not (np.isnat(start) or np.isnat(end))])
+    for day in np.unique(days[~np.isnat(days)]):
+        ozone_for_day(day.astype('datetime64[D]').item())
+
+    return df
+
+
+def compute_chunk(df, ozone_for_day = ozone.get_ozone_grid, step = 300):
+    """
+    Computes the clear-sky UVI for rows with a time, and the dose for rows with a start and end, with the vectorised engine.
+    """
+
+    lats, longs = df['latitude'].to_numpy(dtype = float), df['longitude'].to_numpy(dtype = float)
+
+    if 'utc_time' in df:
+        times = df['utc_time'].to_numpy(dtype = 'datetime64[us]')
+        valid = ~np.isnan(lats) & ~np.isnat(times)
+
+        tot_ozone = np.full(len(df), np.nan)
+        days = times.astype('datetime64[D]')
+        for day in np.unique(days[valid]):
+            on_day = valid & (days == day)
+            tot_ozone[on_day] = ozone_for_day(day.item()).thickness(lats[on_day], longs[on_day])
+
+        uvi = np.full(len(df), np.nan)
+        uvi[valid] = incident_UV.clear_sky_UVI_at(lat = lats[valid], long = longs[valid], utc_time = times[valid], tot_ozone = tot_ozone[valid])
+        df['clear_sky_uvi'] = uvi
+
+    if 'utc_start' in df:
+        starts, ends = df['utc_start'].to_numpy(dtype = 'datetime64[us]'), df['utc_end'].to_numpy(dtype = 'datetime64[us]')
+        valid = ~np.isnan(lats) & ~np.isnat(starts) & ~np.isnat(ends)
+
+        results = dose.dose_batch(zip(lats[valid], longs[valid], starts[valid], ends[valid]), ozone_for_day = ozone_for_day, step = step)
+
+        df['dose'] = np.nan
+        df['samples'] = 0
+        df.loc[valid, 'dose'] = results['dose'].to_numpy()
+        df.loc[valid, 'samples'] = results['samples'].to_numpy()
+
+    return df
+
+
+def run_batch(input_path, output_path, chunk_size = 100000, workers = None, utc = False, time_format = None,
+              geocoder = None, resolver = None, ozone_for_day = ozone.get_ozone_grid):
+    """
+    Runs a batch of UV index and dose jobs from a CSV or Parquet file and writes the results incrementally.
+
+    Chunks are prepared in this process and computed in a pool of worker processes. At most two chunks per worker are
+    in flight, so memory use stays bounded however large the input file is. Progress and throughput are printed to stderr.
+
+    Returns:
+        rows (int): the number of rows processed
+    """
+
+    geocoder = geocoder or geocoding.get_geocoder()
+    resolver = resolver or timezones.get_resolver()
+    workers = workers or os.cpu_count()
+
+    writer = ResultWriter(output_path)
+    started = time.monotonic()
+    rows = 0
+
+    def report(df):
+        nonlocal rows
+        writer.write(df)
+        rows += len(df)
+        elapsed = time.monotonic() - started
+        print("{} rows processed in {:.1f} s ({:.0f} rows/s)".format(rows, elapsed, rows / elapsed if elapsed else 0), file = sys.stderr)
+
+    try:
+        if workers == 1:
+            for chunk in read_chunks(input_path, chunk_size):
+                report(compute_chunk(prepare_chunk(chunk, geocoder, resolver, time_format, utc, ozone_for_day), ozone_for_day))
+        else:
+            with ProcessPoolExecutor(max_workers = workers) as executor:
+                in_flight = []
+                for chunk in read_chunks(input_path, chunk_size):
+                    prepared = prepare_chunk(chunk, geocoder, resolver, time_format, utc, ozone_for_day)
+                    in_flight.append(executor.submit(compute_chunk, prepared, ozone_for_day))
+
+                    # write completed chunks in input order
+                    while in_flight and (len(in_flight) >= 2 * workers or in_flight[0].done()):
+                        report(in_flight.pop(0).result())
+
+                for future in in_flight:
+                    report(future.result())
+    finally:
+        writer.close()
+
+    return rows
+
+
+if __name__ == "__main__":
+
+    args = parse_batch_args()
+
+    run_batch(
+        input_path = args.input,
+        output_path = args.output,
+        chunk_size = args.chunk_size,
+        workers = args.workers,
+        utc = args.utc,
+        time_format = args.time_format
+    )
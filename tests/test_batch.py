@@ -0,0 +1,35 @@
+import numpy as np
+import os
+import pandas as pd
+import pytest
+
+from src import batch
+from utils.UV_exposure import geocoding, ozone
+
+
+def ozone_for_day(day):
+    return ozone.OzoneGrid(np.full(ozone.OZONE_GRID_SHAPE, 300, dtype = ozone.OZONE_DTYPE))
+
+
+@pytest.mark.parametrize("output", ["results.csv", "results.parquet"])
+def test_mixed_rows_in_small_chunks(tmp_path, output):
+    pytest.importorskip('pyarrow')
+
+    input_path = os.path.join(str(tmp_path), "jobs.csv")
+    pd.DataFrame({
+        'location': ['Cardiff', 'Cardiff', 'Nowhere', 'Cardiff'],
+        'time': ['2022-06-01 12:00', None, '2022-06-01 12:00', None],
+        'start': [None, '2022-06-01 10:00', None, None],
+        'end': [None, '2022-06-01 14:00', None, None],
+    }).to_csv(input_path, index = False)
+
+    geocoder = geocoding.GeocodingCache(path = os.path.join(str(tmp_path), "geocode.sqlite"), backend = geocoding.StaticBackend({'Cardiff': (51, -3)}))
+    output_path = os.path.join(str(tmp_path), output)
+
+    rows = batch.run_batch(input_path, output_path, chunk_size = 1, workers = 1, utc = True, geocoder = geocoder, ozone_for_day = ozone_for_day)
+
+    results = pd.read_parquet(output_path) if output.endswith('.parquet') else pd.read_csv(output_path)
+    assert rows == len(results) == 4
+    assert results['clear_sky_uvi'].iloc[0] > 5
+    assert results['dose'].iloc[1] > 0
+    assert np.isnan(results['clear_sky_uvi'].iloc[2]) and np.isnan(results['latitude'].iloc[2])
@@ -0,0 +1,73 @@
+import pytest
+
+from utils.UV_exposure import cloud_cover
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_client(**kwargs):
+    clock = Clock()
+    backend = cloud_cover.FixtureBackend({(51.5, -3.2): 10, (51.5, -0.1): {'current': {'cloudcover': 5}}}, default = 0)
+
+    return cloud_cover.CloudCoverClient(backend, ttl = 60, clock = clock, **kwargs), backend, clock
+
+
+def test_nearby_queries_share_an_entry_until_it_expires():
+    client, backend, clock = make_client()
+
+    assert client.cloud_cover(51.48, -3.18) == 10
+    assert client.cloud_cover(51.52, -3.21) == 10
+    assert client.cloud_cover(51.5, -0.13) == 5
+    assert backend.calls == 2
+
+    clock.now = 59
+    client.cloud_cover(51.48, -3.18)
+    assert backend.calls == 2
+
+    clock.now = 60
+    client.cloud_cover(51.48, -3.18)
+    assert backend.calls == 3
+    assert client.stats()['hits'] == 2
+
+
+def test_expired_entries_are_evicted():
+    client, backend, clock = make_client()
+
+    for lat in range(10):
+        client.cloud_cover(lat, 0)
+    assert client.stats()['cached'] == 10
+
+    clock.now = 100
+    client.cloud_cover(51.5, -3.2)
+
+    assert client.stats()['cached'] == 1
+    assert client.stats()['evictions'] == 10
+
+
+def test_the_cache_size_is_capped():
+    client, backend, clock = make_client(max_entries = 3)
+
+    for lat in range(5):
+        clock.now += 1
+        client.cloud_cover(lat, 0)
+
+    assert client.stats()['cached'] == 3
+    # the oldest entries were dropped
+    client.cloud_cover(0, 0)
+    client.cloud_cover(4, 0)
+    assert backend.calls == 6
+
+
+def test_cloud_mod_factors_fetch_each_key_once():
+    client, backend, clock = make_client()
+
+    factors = client.cloud_mod_factors([(51.48, -3.18), (51.52, -3.21), (51.5, -0.13)])
+
+    assert factors == [pytest.approx(cloud_cover.cloud_mod_factor(10))] * 2 + [pytest.approx(cloud_cover.cloud_mod_factor(5))]
+    assert backend.calls == 2
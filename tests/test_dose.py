@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from datetime import datetime
+
+from utils.UV_exposure import dose, ozone
+
+
+def ozone_for_day(day):
+    return ozone.OzoneGrid(np.full(ozone.OZONE_GRID_SHAPE, 300, dtype = ozone.OZONE_DTYPE))
+
+
+@pytest.mark.parametrize("step", [0, -5, float('nan')])
+def test_non_positive_steps_are_rejected(step):
+    with pytest.raises(Exception, match = "step"):
+        dose.integrate_dose(0, 0, datetime(2022, 6, 1, 10), datetime(2022, 6, 1, 14), tot_ozone = 300, method = "trapezoid", step = step)
+
+    with pytest.raises(Exception, match = "step"):
+        dose.dose_batch([(0, 0, datetime(2022, 6, 1, 10), datetime(2022, 6, 1, 14))], ozone_for_day = ozone_for_day, step = step)
+
+
+def test_batch_matches_single_integration():
+    start, end = datetime(2022, 6, 1, 6), datetime(2022, 6, 2, 18)
+    results = dose.dose_batch([(51.48, -3.18, start, end)], ozone_for_day = ozone_for_day, step = 60)
+    single = dose.integrate_dose(51.48, -3.18, start, end, tot_ozone = 300, method = "adaptive", tol = 0.1)
+
+    assert results['dose'].iloc[0] == pytest.approx(single.dose, rel = 1e-3)
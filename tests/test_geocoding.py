@@ -0,0 +1,62 @@
+import os
+import pytest
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.UV_exposure import geocoding
+
+
+COORDINATES = {'Cardiff, UK': (51.48, -3.18), 'London, UK': (51.51, -0.13), 'Paris': (48.86, 2.35), 'Oslo': (59.91, 10.75)}
+
+
+class RateLimitedBackend(geocoding.StaticBackend):
+    min_interval = 0.1
+
+    def __init__(self, coordinates):
+        super().__init__(coordinates)
+        self.call_times = []
+
+    def geocode(self, location):
+        self.call_times.append(time.monotonic())
+        return super().geocode(location)
+
+
+def test_cached_locations_do_not_reach_the_backend(tmp_path):
+    path = os.path.join(str(tmp_path), "geocode.sqlite")
+    backend = geocoding.StaticBackend(COORDINATES)
+    geocoder = geocoding.GeocodingCache(path = path, backend = backend)
+
+    assert geocoder.geocode('  cardiff ,uk') == (51.48, -3.18)
+    assert geocoder.geocode_many(['Cardiff, UK', 'Atlantis']) == {'Cardiff, UK': (51.48, -3.18), 'Atlantis': None}
+    assert backend.calls == 2
+
+    # a new cache on the same file answers from disk, even offline
+    offline = geocoding.GeocodingCache(path = path, backend = backend, offline = True)
+    assert offline.geocode('CARDIFF, UK') == (51.48, -3.18)
+    assert offline.geocode_many(['Atlantis']) == {'Atlantis': None}
+    assert backend.calls == 2
+
+
+def test_offline_cache_misses_raise(tmp_path):
+    geocoder = geocoding.GeocodingCache(path = os.path.join(str(tmp_path), "geocode.sqlite"), backend = geocoding.StaticBackend(COORDINATES), offline = True)
+    geocoder.seed({'Paris': (48.86, 2.35)})
+
+    assert geocoder.geocode('paris') == (48.86, 2.35)
+    with pytest.raises(Exception, match = "offline"):
+        geocoder.geocode('Oslo')
+
+
+def test_concurrent_misses_respect_the_rate_limit(tmp_path):
+    backend = RateLimitedBackend(COORDINATES)
+    geocoder = geocoding.GeocodingCache(path = os.path.join(str(tmp_path), "geocode.sqlite"), backend = backend)
+
+    # every location twice, so that threads also race on the same location
+    with ThreadPoolExecutor(max_workers = 8) as executor:
+        results = list(executor.map(geocoder.geocode, list(COORDINATES) * 2))
+
+    assert results == [tuple(coords) for coords in COORDINATES.values()] * 2
+    assert len(backend.call_times) == len(COORDINATES)
+
+    gaps = [later - earlier for earlier, later in zip(backend.call_times, backend.call_times[1:])]
+    assert min(gaps) >= RateLimitedBackend.min_interval * 0.99
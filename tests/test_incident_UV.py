@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from datetime import datetime
+
+from utils.UV_exposure import incident_UV
+
+
+# The stated accuracy of `zenith_angle_array` against NOAA's general solar position formulas
+TOLERANCE_DEGREES = 2.0
+
+
+def noaa_zenith(lat, long, utc_time):
+    """
+    Solar zenith angle in degrees from NOAA's general solar position calculations
+    (https://gml.noaa.gov/grad/solcalc/solareqns.PDF), used as the reference solar position.
+    """
+
+    utc_time = np.asarray(utc_time, dtype = 'datetime64[s]')
+    year = utc_time.astype('datetime64[Y]').astype(int) + 1970
+    days_in_year = np.where(((year % 4 == 0) & (year % 100 != 0)) | (year % 400 == 0), 366, 365)
+    hours = (utc_time - utc_time.astype('datetime64[D]')).astype(int) / 3600
+
+    gamma = 2 * np.pi / days_in_year * (incident_UV.day_of_year(utc_time) - 1 + (hours - 12) / 24)
+    eot = 229.18 * (0.000075 + 0.001868 * np.cos(gamma) - 0.032077 * np.sin(gamma) - 0.014615 * np.cos(2 * gamma) - 0.040849 * np.sin(2 * gamma))
+    decl = (0.006918 - 0.399912 * np.cos(gamma) + 0.070257 * np.sin(gamma) - 0.006758 * np.cos(2 * gamma)
+            + 0.000907 * np.sin(2 * gamma) - 0.002697 * np.cos(3 * gamma) + 0.00148 * np.sin(3 * gamma))
+
+    hour_angle = np.radians((hours * 60 + eot + 4 * np.asarray(long)) / 4 - 180)
+    lat = np.radians(lat)
+    cos_zenith = np.sin(lat) * np.sin(decl) + np.cos(lat) * np.cos(decl) * np.cos(hour_angle)
+
+    return np.degrees(np.arccos(np.clip(cos_zenith, -1, 1)))
+
+
+@pytest.mark.parametrize("lat, long, utc_time, expected", [
+    # the Sun is overhead at the equator at solar noon on the March equinox
+    (0.0, 0.0, datetime(2022, 3, 20, 12, 7), 0.0),
+    # ... over the Tropic of Cancer on the June solstice
+    (23.44, 0.0, datetime(2022, 6, 21, 12, 2), 0.0),
+    # ... and over the Tropic of Capricorn on the December solstice
+    (-23.44, 0.0, datetime(2022, 12, 21, 11, 58), 0.0),
+    # solar noon at 90 degrees east is 6 hours earlier
+    (0.0, 90.0, datetime(2022, 3, 20, 6, 7), 0.0),
+    # the Sun is on the horizon at the North Pole at the equinox
+    (90.0, 0.0, datetime(2022, 3, 20, 12, 0), 90.0),
+    # local midnight at the equator on the equinox
+    (0.0, 0.0, datetime(2022, 3, 21, 0, 7), 180.0),
+])
+def test_zenith_angle_matches_known_solar_positions(lat, long, utc_time, expected):
+    zenith = np.degrees(incident_UV.zenith_angle(lat = lat, long = long, local_time = None, utc_time = utc_time))
+
+    assert zenith == pytest.approx(expected, abs = TOLERANCE_DEGREES)
+
+
+def test_zenith_angle_array_is_within_tolerance_of_noaa():
+    rng = np.random.default_rng(0)
+    lat = rng.uniform(-89, 89, 100000)
+    long = rng.uniform(-180, 180, 100000)
+    utc_time = np.datetime64('2000-01-01') + rng.integers(0, 30 * 365 * 86400, 100000).astype('timedelta64[s]')
+
+    zenith = np.degrees(incident_UV.zenith_angle_array(lat = lat, long = long, utc_time = utc_time))
+
+    assert np.max(np.abs(zenith - noaa_zenith(lat, long, utc_time))) < TOLERANCE_DEGREES
+
+
+def test_scalar_and_array_paths_agree():
+    rng = np.random.default_rng(1)
+    lat = rng.uniform(-89, 89, 50)
+    long = rng.uniform(-180, 180, 50)
+    utc_time = np.datetime64('2022-01-01') + rng.integers(0, 365 * 86400, 50).astype('timedelta64[s]')
+    tot_ozone = rng.uniform(200, 450, 50)
+
+    uvi = incident_UV.clear_sky_UVI_at(lat = lat, long = long, utc_time = utc_time, tot_ozone = tot_ozone)
+
+    for ii in range(50):
+        when = utc_time[ii].astype(datetime)
+        zenith = incident_UV.zenith_angle(lat = lat[ii], long = long[ii], local_time = None, utc_time = when)
+        assert zenith == incident_UV.zenith_angle_array(lat[ii], long[ii], utc_time[ii])
+        assert incident_UV.clear_sky_UVI(when.timetuple().tm_yday, zenith, tot_ozone[ii]) == pytest.approx(uvi[ii], rel = 1e-12)
+
+
+def test_uvi_is_evaluated_at_the_given_utc_time():
+    # 12:00 UTC at (0, 0) is close to solar noon, so the UV index should be high whatever the date
+    uvi = incident_UV.clear_sky_UVI_at(lat = 0.0, long = 0.0, utc_time = datetime(2026, 10, 15, 12), tot_ozone = 260)
+
+    assert uvi > 10
@@ -0,0 +1,187 @@
+import json
+import numpy as np
+import os
+import pytest
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.UV_exposure import benchmarks, ozone, ozone_archive
+
+
+# 11 January and 1 November shared the legacy raw file stamp 2022111
+DATES = [datetime(2022, 1, 11), datetime(2022, 11, 1), datetime(2022, 11, 2)]
+
+
+def server_filename(date):
+    return "OMPS-NPP_NMTO3-L3-DAILY_v2.1_{}m{:02d}{:02d}_2022.txt".format(date.year, date.month, date.day)
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves files like `http.server`, plus single 'bytes=N-' ranges so that resumed downloads can be tested.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+
+        path = self.translate_path(self.path)
+        header = self.headers.get('Range')
+        if header is None or not os.path.isfile(path):
+            return super().do_GET()
+
+        with open(path, 'rb') as f:
+            content = f.read()[int(header[len('bytes='):].rstrip('-')):]
+
+        self.send_response(206)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / "server"
+    (root / "Y2022").mkdir(parents = True)
+    grids = {}
+    for seed, date in enumerate(DATES):
+        grids[date] = benchmarks.write_synthetic_ozone_file(str(root / "Y2022" / server_filename(date)), date = date, seed = seed)
+    (root / "Y2022" / "index.html").write_text("".join('<a href="{}">file</a>\n'.format(server_filename(date)) for date in DATES))
+
+    def handler(*args, **kwargs):
+        return RangeRequestHandler(*args, directory = str(root), **kwargs)
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    httpd.requests = []
+    httpd.root = root
+    httpd.grids = grids
+    thread = threading.Thread(target = httpd.serve_forever, daemon = True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_archive(server, data_dir, **kwargs):
+    return ozone_archive.OzoneArchive(data_dir = str(data_dir), base_url = "http://127.0.0.1:{}/".format(server.server_address[1]), backoff = 0, **kwargs)
+
+
+def test_colliding_dates_are_downloaded_separately(server, tmp_path):
+    data_dir = tmp_path / "data"
+    archive = make_archive(server, data_dir)
+
+    archive.download(DATES[0])
+    # every day in between is missing from the server
+    results = archive.download_range(DATES[0], DATES[1])
+
+    for date in DATES[:2]:
+        assert results[date] == ozone._raw_filepath(date, data_dir = str(data_dir))
+        assert np.array_equal(ozone.load_ozone_grid(date, data_dir = str(data_dir)), server.grids[date])
+
+    manifest = json.loads((data_dir / "ozone_manifest.json").read_text())
+    assert manifest["2022-11-01"]["file"] == "ozone_data_raw_20221101.txt"
+
+
+def test_completed_days_are_skipped(server, tmp_path):
+    archive = make_archive(server, tmp_path / "data")
+    archive.download_range(DATES[1], DATES[2])
+    downloads = len(server.requests)
+
+    # a new archive reads the manifest, so only the year index is fetched again
+    make_archive(server, tmp_path / "data").download_range(DATES[1], DATES[2])
+
+    assert [path for path, _ in server.requests[downloads:]] == ["/Y2022/"]
+
+
+def test_partial_downloads_are_resumed(server, tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    content = (server.root / "Y2022" / server_filename(DATES[2])).read_bytes()
+    part_filepath = ozone._raw_filepath(DATES[2], data_dir = str(data_dir)) + ".part"
+    with open(part_filepath, 'wb') as f:
+        f.write(content[:1000])
+
+    filepath = make_archive(server, data_dir).download(DATES[2])
+
+    assert server.requests[-1] == ("/Y2022/" + server_filename(DATES[2]), "bytes=1000-")
+    assert open(filepath, 'rb').read() == content
+    assert not os.path.exists(part_filepath)
+
+
+def test_truncated_files_without_a_manifest_entry_are_downloaded_again(server, tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    content = (server.root / "Y2022" / server_filename(DATES[2])).read_bytes()
+    filepath = ozone._raw_filepath(DATES[2], data_dir = str(data_dir))
+    with open(filepath, 'wb') as f:
+        f.write(content[:1000])
+
+    archive = make_archive(server, data_dir)
+    assert not archive.is_complete(DATES[2])
+
+    archive.download(DATES[2])
+    assert open(filepath, 'rb').read() == content
+
+
+def test_legacy_file_names_are_only_used_for_their_own_date(server, tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    content = (server.root / "Y2022" / server_filename(DATES[0])).read_bytes()
+    (data_dir / "ozone_data_raw_2022111.txt").write_bytes(content)
+
+    archive = make_archive(server, data_dir)
+
+    assert archive.is_complete(DATES[0])
+    assert not archive.is_complete(DATES[1])
+    assert np.array_equal(ozone.load_ozone_grid(DATES[0], data_dir = str(data_dir)), server.grids[DATES[0]])
+
+    archive.download(DATES[1])
+    assert np.array_equal(ozone.load_ozone_grid(DATES[1], data_dir = str(data_dir)), server.grids[DATES[1]])
+
+
+def test_missing_days_are_reported(server, tmp_path):
+    results = make_archive(server, tmp_path / "data").download_range(datetime(2022, 11, 2), datetime(2022, 11, 3))
+
+    assert results[datetime(2022, 11, 2)].endswith("ozone_data_raw_20221102.txt")
+    assert isinstance(results[datetime(2022, 11, 3)], Exception)
+
+
+def test_days_released_after_the_index_was_fetched_are_found(server, tmp_path):
+    archive = make_archive(server, tmp_path / "data", index_refresh = 0)
+    archive.download(DATES[2])
+
+    new_date = datetime(2022, 11, 3)
+    benchmarks.write_synthetic_ozone_file(str(server.root / "Y2022" / server_filename(new_date)), date = new_date)
+    with open(str(server.root / "Y2022" / "index.html"), 'a') as f:
+        f.write('<a href="{}">file</a>\n'.format(server_filename(new_date)))
+
+    assert archive.download(new_date).endswith("ozone_data_raw_20221103.txt")
+
+
+def test_recently_fetched_indexes_are_not_fetched_again(server, tmp_path):
+    archive = make_archive(server, tmp_path / "data")
+    archive.download(DATES[2])
+    requests = len(server.requests)
+
+    with pytest.raises(Exception, match = "Cannot get ozone data"):
+        archive.download(datetime(2022, 11, 3))
+    assert len(server.requests) == requests
+
+
+def test_concurrent_downloads_of_the_same_day(server, tmp_path):
+    archive = make_archive(server, tmp_path / "data")
+
+    with ThreadPoolExecutor(max_workers = 4) as executor:
+        filepaths = list(executor.map(archive.download, [DATES[2]] * 4))
+
+    assert len(set(filepaths)) == 1
+    assert [path for path, _ in server.requests].count("/Y2022/" + server_filename(DATES[2])) == 1
+
+    with ThreadPoolExecutor(max_workers = 4) as executor:
+        grids = list(executor.map(lambda date: np.array(ozone.load_ozone_grid(date, data_dir = str(tmp_path / "data"))), [DATES[2]] * 4))
+    assert all(np.array_equal(grid, server.grids[DATES[2]]) for grid in grids)
@@ -0,0 +1,94 @@
+import numpy as np
+import os
+import pytest
+
+from datetime import datetime
+
+from utils.UV_exposure import dose, incident_UV, ozone, ozone_cube
+
+
+START = datetime(2022, 6, 1)
+
+
+def empty_cube(days):
+    return np.full((days,) + ozone.OZONE_GRID_SHAPE, np.nan, dtype = ozone_cube.CUBE_DTYPE)
+
+
+def test_short_gaps_are_interpolated_in_time():
+    values = empty_cube(5)
+    values[0], values[4] = 300, 340
+
+    assert ozone_cube.fill_ozone_gaps(values, max_gap_days = 3) == 3 * 180 * 360
+    assert values[1:4, 10, 20] == pytest.approx([310, 320, 330])
+
+
+def test_long_gaps_and_empty_days_are_filled():
+    values = empty_cube(3)
+    values[0] = 300
+    values[0, :20] = np.nan  # a polar night which is missing every day
+
+    ozone_cube.fill_ozone_gaps(values, max_gap_days = 1)
+
+    assert not np.isnan(values).any()
+    # the polar night is filled from the neighbouring cells and the empty day from the nearest day with data
+    assert values[0, 0, 0] == pytest.approx(300)
+    assert values[2] == pytest.approx(values[0])
+
+
+def test_cubes_without_any_data_are_rejected():
+    with pytest.raises(Exception, match = "no data"):
+        ozone_cube.fill_ozone_gaps(empty_cube(2))
+
+
+def test_thickness_is_interpolated_between_days():
+    values = empty_cube(2)
+    values[0], values[1] = 300, 400
+    cube = ozone_cube.OzoneCube(values, START)
+
+    # each day's value applies at noon UTC
+    assert cube.thickness(datetime(2022, 6, 1, 12), 0, 0) == pytest.approx(300)
+    assert cube.thickness(datetime(2022, 6, 2, 0), 0, 0) == pytest.approx(350)
+    assert cube.thickness(datetime(2022, 6, 2, 12), 0, 0) == pytest.approx(400)
+
+    times = np.array(['2022-06-01T18:00', '2022-06-02T06:00'], dtype = 'datetime64[us]')
+    assert cube.thickness(times, [10, -10], [0, 90]) == pytest.approx([325, 375])
+    assert cube.tot_ozone(0, 0)(times) == pytest.approx([325, 375])
+
+    with pytest.warns(UserWarning, match = "outside"):
+        assert cube.thickness(datetime(2022, 6, 5), 0, 0) == pytest.approx(400)
+
+
+def test_grids_fill_missing_cells():
+    values = np.full(ozone.OZONE_GRID_SHAPE, 300, dtype = ozone.OZONE_DTYPE)
+    values[:15] = 0  # no retrievals in the southern polar night
+    grid = ozone.OzoneGrid(values)
+
+    assert grid.thickness(-85, 0) == pytest.approx(300)
+    assert ozone.OzoneGrid(values, fill_gaps = False).thickness(-85, 0) == 0
+
+    # the UVI at a filled cell is the same as with complete data, rather than the 0 a missing cell used to give
+    job = (-80, 0, datetime(2022, 12, 1), datetime(2022, 12, 2))
+    filled = dose.dose_batch([job], ozone_for_day = lambda day: grid)
+    complete = dose.dose_batch([job], ozone_for_day = lambda day: ozone.OzoneGrid(np.full(ozone.OZONE_GRID_SHAPE, 300, dtype = ozone.OZONE_DTYPE)))
+    assert filled['dose'].iloc[0] == pytest.approx(complete['dose'].iloc[0])
+    assert incident_UV.clear_sky_UVI_at(lat = -85, long = 0, utc_time = datetime(2022, 12, 21, 12), tot_ozone = grid.thickness(-85, 0)) > 0
+
+
+def test_load_rebuilds_cubes_older_than_their_grids(tmp_path):
+    data_dir = str(tmp_path)
+    for day, value in ((1, 300), (2, 320)):
+        ozone.save_ozone_grid(np.full(ozone.OZONE_GRID_SHAPE, value), datetime(2022, 6, day), data_dir = data_dir)
+
+    end = datetime(2022, 6, 2)
+    cube = ozone_cube.OzoneCube.load(START, end, data_dir = data_dir, download = False)
+    assert cube.thickness(datetime(2022, 6, 2, 12), 0, 0) == pytest.approx(320)
+    assert not ozone_cube.cube_is_stale(START, end, data_dir = data_dir)
+
+    # a re-parsed grid which is newer than the cube
+    filepath = ozone.save_ozone_grid(np.full(ozone.OZONE_GRID_SHAPE, 360), end, data_dir = data_dir)
+    built = os.stat(ozone_cube.cube_filepath(START, end, data_dir = data_dir)).st_mtime_ns
+    os.utime(filepath, ns = (built + 10**9, built + 10**9))
+    assert ozone_cube.cube_is_stale(START, end, data_dir = data_dir)
+
+    cube = ozone_cube.OzoneCube.load(START, end, data_dir = data_dir, download = False)
+    assert cube.thickness(datetime(2022, 6, 2, 12), 0, 0) == pytest.approx(360)
@@ -0,0 +1,82 @@
+import asyncio
+import numpy as np
+import os
+import pytest
+
+from datetime import datetime
+
+from utils.UV_exposure import incident_UV, ozone, result_cache, service
+
+
+DATE = datetime(2022, 6, 1)
+
+
+def write_grid(data_dir, value):
+    filepath = ozone.save_ozone_grid(np.full(ozone.OZONE_GRID_SHAPE, value), DATE, data_dir = data_dir)
+    # make sure the replaced file gets a new modification time even on coarse-grained filesystems
+    stat = os.stat(filepath)
+    os.utime(filepath, ns = (stat.st_atime_ns, stat.st_mtime_ns + value))
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    write_grid(str(tmp_path), 300)
+    return str(tmp_path)
+
+
+def test_cached_results_are_recomputed_when_the_grid_changes(data_dir):
+    cache = result_cache.ResultCache(path = os.path.join(data_dir, "results.sqlite"), data_dir = data_dir)
+    ozone_for_day = lambda day: ozone.get_ozone_grid(day, data_dir = data_dir)
+
+    before = cache.uvi(0, 0, datetime(2022, 6, 1, 12), ozone_for_day = ozone_for_day)
+    assert cache.uvi(0, 0, datetime(2022, 6, 1, 12), ozone_for_day = ozone_for_day) == before
+
+    write_grid(data_dir, 200)
+    after = cache.uvi(0, 0, datetime(2022, 6, 1, 12), ozone_for_day = ozone_for_day)
+
+    assert after > before
+    assert cache.stats()['invalidations'] == 1
+
+    # the recomputed value is what a new process sees
+    reopened = result_cache.ResultCache(path = os.path.join(data_dir, "results.sqlite"), data_dir = data_dir)
+    assert reopened.uvi(0, 0, datetime(2022, 6, 1, 12), ozone_for_day = ozone_for_day) == after
+    assert reopened.stats()['disk_hits'] == 1
+
+
+def test_service_reloads_replaced_grids(data_dir):
+    cache = result_cache.ResultCache(data_dir = data_dir)
+    uv_service = service.UVService(ozone_for_day = lambda day: ozone.get_ozone_grid(day, data_dir = data_dir), result_cache = cache, data_dir = data_dir)
+    query = {'lat': '0', 'long': '0', 'time': '2022-06-01T12:00'}
+
+    status, before = asyncio.run(uv_service.handle('/uvi', query))
+    assert status == 200
+
+    write_grid(data_dir, 200)
+    status, after = asyncio.run(uv_service.handle('/uvi', query))
+
+    assert status == 200
+    assert after['clear_sky_uvi'] > before['clear_sky_uvi']
+    assert cache.uvi(0, 0, datetime(2022, 6, 1, 12), ozone_for_day = uv_service.ozone_grid) == after['clear_sky_uvi']
+
+
+def test_batches_match_direct_computation(data_dir):
+    cache = result_cache.ResultCache(path = os.path.join(data_dir, "results.sqlite"), data_dir = data_dir)
+    ozone_for_day = lambda day: ozone.get_ozone_grid(day, data_dir = data_dir)
+
+    ozone.save_ozone_grid(np.full(ozone.OZONE_GRID_SHAPE, 300), datetime(2022, 6, 2), data_dir = data_dir)
+
+    # repeated queries spread over two UTC days, with duplicates in the same batch
+    lats = np.array([0, 10, 10, -20, 0])
+    longs = np.array([0, 5, 5, 30, 0])
+    times = np.array(['2022-06-01T12:00', '2022-06-01T23:30', '2022-06-01T23:30', '2022-06-02T09:00', '2022-06-01T12:00'], dtype = 'datetime64[us]')
+
+    direct = incident_UV.clear_sky_UVI_at(lat = lats, long = longs, utc_time = times, tot_ozone = 300)
+    assert np.allclose(cache.uvi_many(lats, longs, times, ozone_for_day = ozone_for_day), direct)
+    assert cache.stats()['misses'] == 5
+
+    assert np.allclose(cache.uvi_many(lats, longs, times, ozone_for_day = ozone_for_day), direct)
+    assert cache.stats()['hits'] == 5
+
+    reopened = result_cache.ResultCache(path = os.path.join(data_dir, "results.sqlite"), data_dir = data_dir)
+    assert np.allclose(reopened.uvi_many(lats, longs, times, ozone_for_day = ozone_for_day), direct)
+    assert reopened.stats()['disk_hits'] == 5
@@ -0,0 +1,43 @@
+import asyncio
+import numpy as np
+
+from utils.UV_exposure import ozone, service
+
+
+def ozone_for_day(day):
+    # OMPS data only starts in 2012
+    if day.year < 2012:
+        raise Exception("Cannot get ozone data for {}.".format(day.strftime("%Y-%m-%d")))
+
+    return ozone.OzoneGrid(np.full(ozone.OZONE_GRID_SHAPE, 300, dtype = ozone.OZONE_DTYPE))
+
+
+def handle_together(queries, tmp_path):
+    uv_service = service.UVService(ozone_for_day = ozone_for_day, batch_window = 0.05, data_dir = str(tmp_path))
+
+    async def main():
+        return await asyncio.gather(*[uv_service.handle(path, params) for path, params in queries])
+
+    return asyncio.run(main())
+
+
+def test_a_failing_query_does_not_fail_its_batch(tmp_path):
+    responses = handle_together([
+        ('/uvi', {'lat': '0', 'long': '0', 'time': '2005-06-01T12:00'}),
+        ('/uvi', {'lat': '0', 'long': '0', 'time': '2022-06-01T12:00'}),
+        ('/dose', {'lat': '0', 'long': '0', 'start': '2005-06-01T10:00', 'end': '2005-06-01T14:00'}),
+        ('/dose', {'lat': '0', 'long': '0', 'start': '2022-06-01T10:00', 'end': '2022-06-01T14:00'}),
+    ], tmp_path)
+
+    assert [status for status, _ in responses] == [400, 200, 400, 200]
+    assert responses[1][1]['clear_sky_uvi'] > 5
+    assert responses[3][1]['dose'] > 0
+
+
+def test_dose_rejects_non_positive_steps(tmp_path):
+    responses = handle_together([
+        ('/dose', {'lat': '0', 'long': '0', 'start': '2022-06-01T10:00', 'end': '2022-06-01T14:00', 'step': step}) for step in ('0', '-5')
+    ], tmp_path)
+
+    assert [status for status, _ in responses] == [400, 400]
+    assert 'step' in responses[0][1]['error']
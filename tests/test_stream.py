@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from datetime import datetime, timedelta
+
+from utils.UV_exposure import dose, stream
+
+
+START, END = datetime(2022, 6, 1), datetime(2022, 6, 2)
+
+
+def collect(chunks):
+    chunks = list(chunks)
+    return np.concatenate([chunk.times for chunk in chunks]), np.concatenate([chunk.uvi for chunk in chunks]), np.concatenate([chunk.dose for chunk in chunks])
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 1440, 5000])
+def test_the_dose_does_not_depend_on_the_chunk_size(chunk_size):
+    reference = collect(stream.stream_uvi(51.48, -3.18, START, END, step = 60, chunk_size = 1441, tot_ozone = 300))
+    times, uvi, cumulative = collect(stream.stream_uvi(51.48, -3.18, START, END, step = 60, chunk_size = chunk_size, tot_ozone = 300))
+
+    assert np.array_equal(times, reference[0])
+    assert np.array_equal(uvi, reference[1])
+    assert np.allclose(cumulative, reference[2], rtol = 1e-12)
+
+
+def test_the_stream_stops_at_end():
+    chunks = list(stream.stream_uvi(51.48, -3.18, START, END, step = 60, chunk_size = 1000, tot_ozone = 300))
+    times, _, cumulative = collect(chunks)
+
+    assert [len(chunk.times) for chunk in chunks] == [1000, 441]
+    assert times[0] == np.datetime64(START) and times[-1] == np.datetime64(END)
+    assert np.all(np.diff(cumulative) >= 0)
+
+    # the streamed dose agrees with the integrator
+    assert cumulative[-1] == pytest.approx(dose.integrate_dose(51.48, -3.18, START, END, tot_ozone = 300, method = "adaptive", tol = 0.1).dose, rel = 1e-3)
+
+
+def test_unbounded_streams_keep_going():
+    chunks = stream.stream_uvi(0, 0, START, step = 3600, chunk_size = 24, tot_ozone = 300)
+
+    assert [next(chunks).times[0] for _ in range(3)] == [np.datetime64(START + timedelta(days = day)) for day in range(3)]
+
+
+@pytest.mark.parametrize("kwargs", [{'step': 0}, {'step': -60}, {'step': float('nan')}, {'chunk_size': 0}, {'chunk_size': -1}])
+def test_bad_stream_arguments_are_rejected(kwargs):
+    with pytest.raises(Exception, match = next(iter(kwargs))):
+        stream.stream_uvi(0, 0, START, END, tot_ozone = 300, **kwargs)
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += timedelta(seconds = seconds)
+
+
+def test_live_samples_are_aligned_to_whole_intervals():
+    clock = FakeClock(datetime(2022, 6, 1, 11, 58, 30))
+    samples = stream.live_uvi(51.48, -3.18, interval_minutes = 5, tot_ozone = 300, clock = clock, sleep = clock.sleep)
+
+    first, second, third = next(samples), next(samples), next(samples)
+
+    assert [sample.time for sample in (first, second, third)] == [np.datetime64(datetime(2022, 6, 1, 12, minute)) for minute in (0, 5, 10)]
+    assert clock.sleeps == [90, 300, 300]
+    assert first.dose == 0
+
+    expected = (first.uvi + second.uvi) / 2 * 300 * dose.UVI_TO_IRRADIANCE
+    assert second.dose == pytest.approx(expected)
+    assert third.dose == pytest.approx(expected + (second.uvi + third.uvi) / 2 * 300 * dose.UVI_TO_IRRADIANCE)
+
+
+def test_live_samples_catch_up_without_sleeping():
+    clock = FakeClock(datetime(2022, 6, 1, 12))
+    samples = stream.live_uvi(0, 0, interval_minutes = 1, tot_ozone = 300, clock = clock, sleep = clock.sleep)
+
+    next(samples)
+    clock.now += timedelta(minutes = 10)
+
+    assert next(samples).time == np.datetime64(datetime(2022, 6, 1, 12, 10))
+
+
+@pytest.mark.parametrize("interval_minutes", [0, -5])
+def test_bad_live_intervals_are_rejected(interval_minutes):
+    with pytest.raises(Exception, match = "interval_minutes"):
+        stream.live_uvi(0, 0, interval_minutes = interval_minutes, tot_ozone = 300)
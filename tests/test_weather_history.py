@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from datetime import datetime
+
+from utils.UV_exposure import cloud_cover, ozone, weather_history
+
+
+STATIONS = pd.DataFrame({'station': ['03716', '03772'], 'latitude': [51.40, 51.48], 'longitude': [-3.34, -0.45]})
+
+
+def hourly_records(days, coco):
+    times = pd.date_range(datetime(2022, 6, 1), periods = 24 * days, freq = 'h')
+    return pd.DataFrame({'station': np.repeat(STATIONS['station'], len(times)).to_numpy(),
+                         'time': np.tile(times, len(STATIONS)),
+                         'coco': coco})
+
+
+def ozone_for_day(day):
+    return ozone.OzoneGrid(np.full(ozone.OZONE_GRID_SHAPE, 300, dtype = ozone.OZONE_DTYPE))
+
+
+def test_sites_are_joined_to_their_nearest_station(tmp_path):
+    pytest.importorskip('pyarrow')
+
+    backend = weather_history.FixtureBackend(STATIONS, hourly_records(2, 4))
+    archive = weather_history.WeatherArchive(cache_dir = str(tmp_path), backend = backend)
+
+    weather = archive.load_sites([51.48, 51.50], [-3.18, -0.13], datetime(2022, 6, 1), datetime(2022, 6, 2, 23))
+    station, distance = weather.nearest_station([51.48, 51.50], [-3.18, -0.13])
+
+    assert list(weather.station_ids[station]) == ['03716', '03772']
+    assert np.all(distance < 30)
+    assert weather.cmf(station[0], datetime(2022, 6, 1, 12)) == pytest.approx(cloud_cover.cloud_mod_factor(weather_history.OVERCAST))
+
+    # the second load of the same region and period comes from the Parquet cache
+    calls = backend.calls
+    archive.load_sites([51.48, 51.50], [-3.18, -0.13], datetime(2022, 6, 1), datetime(2022, 6, 2, 23))
+    assert backend.calls == calls
+
+
+def test_overcast_records_reduce_the_dose():
+    weather = weather_history.HourlyWeather(STATIONS, hourly_records(1, 4), datetime(2022, 6, 1), datetime(2022, 6, 1, 23))
+    results = weather_history.cloud_adjusted_doses([(51.48, -3.18)], datetime(2022, 6, 1), datetime(2022, 6, 2), weather = weather, ozone_for_day = ozone_for_day)
+
+    assert results['weather_coverage'].iloc[0] == 1
+    assert results['mean_cmf'].iloc[0] == pytest.approx(cloud_cover.cloud_mod_factor(weather_history.OVERCAST), rel = 1e-6)
+    assert results['dose'].iloc[0] == pytest.approx(results['clear_sky_dose'].iloc[0] * results['mean_cmf'].iloc[0])
+
+
+def test_hours_without_records_are_not_treated_as_clear():
+    # records for the first of two days only
+    weather = weather_history.HourlyWeather(STATIONS, hourly_records(1, 4), datetime(2022, 6, 1), datetime(2022, 6, 2, 23))
+    assert np.isnan(weather.cmf(0, datetime(2022, 6, 2, 12)))
+
+    results = weather_history.cloud_adjusted_doses([(51.48, -3.18)], datetime(2022, 6, 1), datetime(2022, 6, 3), weather = weather, ozone_for_day = ozone_for_day)
+
+    assert np.isnan(results['dose'].iloc[0])
+    assert results['weather_coverage'].iloc[0] == pytest.approx(0.5, abs = 0.02)
+    assert results['mean_cmf'].iloc[0] == pytest.approx(cloud_cover.cloud_mod_factor(weather_history.OVERCAST), rel = 1e-6)
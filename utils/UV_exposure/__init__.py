@@ -1,12 +1,25 @@
-import pytz
-import warnings
+import importlib
 
-from . import incident_UV
-from . import ozone
 from datetime import datetime, timedelta
-from tzwhere import tzwhere
 
-__all__ = ["cloud_cover", "incident_UV", "ozone"]
+__all__ = ["cloud_cover", "dose", "incident_UV", "ozone", "timezones"]
+
+# Submodules are only imported when first accessed (PEP 562), so that e.g. `incident_UV` can be used without
+# loading pandas, requests, pytz or tzwhere. The heavy dependencies are imported inside the functions that need them.
+_submodules = {"benchmarks", "cloud_cover", "dose", "geocoding", "incident_UV", "instrumentation", "ozone",
+               "ozone_archive", "ozone_cube", "raster", "result_cache", "service", "stream", "timezones",
+               "weather_history"}
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module("." + name, __name__)
+
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | _submodules)
 
 
 def get_times(lat, long, time = None):
@@ -14,11 +27,12 @@ def get_times(lat, long, time = None):
     A function to return the local time and the utc time. If the user does not enter a time then the function finds the current local time and the current utc time. If the user enter s atime, then the function returns that time and calculates what the UTC time would be, given the specified time for a particular location.
     """
     
-    # find timezone name
-    # we expect a warning here which is generated from the tzwhere package - suppress it.
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        timezone_str = tzwhere.tzwhere().tzNameAt(lat, long)
+    import pytz
+
+    from . import timezones
+
+    # find timezone name. The resolver loads the timezone polygons once per process and caches recent coordinates.
+    timezone_str = timezones.get_resolver().timezone_at(lat, long)
 
     # find time difference between timezone and UTC
     timezone = pytz.timezone(timezone_str)
@@ -0,0 +1,396 @@
+import argparse
+import contextlib
+import json
+import numpy as np
+import os
+import pandas as pd
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from datetime import datetime, timedelta
+
+from . import dose
+from . import incident_UV
+from . import ozone
+from . import timezones
+
+
+# Fixed locations used by the suite, with the timezone each one is in
+BENCHMARK_LOCATIONS = [
+    (51.48, -3.18, 'Europe/London'),
+    (40.71, -74.01, 'America/New_York'),
+    (-33.87, 151.21, 'Australia/Sydney'),
+    (35.68, 139.69, 'Asia/Tokyo'),
+    (-1.29, 36.82, 'Africa/Nairobi'),
+    (64.15, -21.94, 'Atlantic/Reykjavik'),
+]
+
+BENCHMARK_DATE = datetime(2022, 6, 1)
+BENCHMARK_SIZES = (1, 100, 10000)
+
+# Import time budgets in seconds. They are generous, because cold imports vary a lot between machines; the main guard is
+# that none of the heavy, lazily imported dependencies are loaded by these imports.
+IMPORT_BUDGETS = {
+    'utils.UV_exposure': 0.05,
+    'utils.UV_exposure.incident_UV': 0.5,
+    'utils.UV_exposure.dose': 0.5,
+}
+LAZY_DEPENDENCIES = ('pandas', 'bs4', 'requests', 'pytz', 'tzwhere')
+
+
+def write_synthetic_ozone_file(filepath, date = datetime(2022, 6, 1), seed = 0):
+    """
+    Writes a file in the raw NASA OMPS text format filled with random ozone values, so that the ozone pipeline can be
+    exercised without a network connection.
+
+    Returns:
+        grid (int array): the 180 x 360 grid of values that was written
+    """
+
+    rng = np.random.default_rng(seed)
+    grid = rng.integers(100, 500, size = ozone.OZONE_GRID_SHAPE)
+
+    # OMPS files have no data near the pole in winter, which shows up as zeros
+    grid[-5:] = 0
+
+    lines = [
+        " Day: {:3d} {} {:2d}, {}    OMPS TO3    STD OZONE    GEN:00:000 Asc LECT: 01:25 PM\n".format(date.timetuple().tm_yday, date.strftime("%b"), date.day, date.year),
+        " Longitudes:  360 bins centered on 179.5  W  to 179.5  E   (1.00 degree steps)\n",
+        " Latitudes :  180 bins centered on  89.5  S  to  89.5  N   (1.00 degree steps)\n",
+    ]
+    for row, lat in zip(grid, ozone.LATITUDES):
+        values = ''.join('{:3d}'.format(value) for value in row)
+        lines += [' ' + values[n:(n+75)] + '\n' for n in range(0, 1050, 75)]
+        lines.append(' ' + values[1050:] + '   lat = {:6.1f}\n'.format(lat))
+
+    with open(filepath, 'w') as f:
+        f.write(''.join(lines))
+
+    return grid
+
+
+def _legacy_parse_raw_ozone_file(raw_filepath):
+    """
+    The original list-comprehension parser, kept as a reference for benchmarking.
+    """
+
+    df_ozone = pd.read_csv(raw_filepath, skiprows=3, names = ["raw_values"])
+    df_ozone['raw_values'] = df_ozone['raw_values'].str[1:]
+    df_ozone['raw_values'] = df_ozone['raw_values'].str.split('lat').str[0]
+    df_ozone['raw_values'] = df_ozone['raw_values'].str.rstrip(' ')
+
+    two_d_list = [[row[n:(n+3)] for n in range(0, len(row), 3)] for row in df_ozone['raw_values']]
+    flatten_list = [ii for item in two_d_list for ii in item]
+
+    return np.array(flatten_list, dtype = float).astype(ozone.OZONE_DTYPE).reshape(ozone.OZONE_GRID_SHAPE)
+
+
+def benchmark_ozone_parser(repeats = 5):
+    """
+    Compares the legacy ozone parser with `ozone.parse_ozone_bytes` on a synthetic file.
+
+    Returns:
+        results (dict): the best time per parse in seconds for each parser, and the speedup
+    """
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_filepath = os.path.join(tmp_dir, "ozone_data_raw.txt")
+        grid = write_synthetic_ozone_file(raw_filepath)
+
+        if not (np.array_equal(_legacy_parse_raw_ozone_file(raw_filepath), grid) and np.array_equal(ozone._parse_raw_ozone_file(raw_filepath), grid)):
+            raise Exception("The ozone parsers do not agree with the synthetic data.")
+
+        legacy = min(timeit.repeat(lambda: _legacy_parse_raw_ozone_file(raw_filepath), number = 1, repeat = repeats))
+        vectorised = min(timeit.repeat(lambda: ozone._parse_raw_ozone_file(raw_filepath), number = 1, repeat = repeats))
+
+    return {'legacy_s': legacy, 'vectorised_s': vectorised, 'speedup': legacy / vectorised}
+
+
+def benchmark_solar_table(n_samples = 1000000, repeats = 5, seed = 0):
+    """
+    Compares the clear-sky UVI computation with and without the precomputed solar table (`incident_UV.solar_table`)
+    on random locations and times over a year, and reports the largest difference between the two.
+
+    Returns:
+        results (dict): the best time in seconds with each setting, the speedup and the largest absolute difference in UVI
+    """
+
+    rng = np.random.default_rng(seed)
+    lat = rng.uniform(-70, 70, n_samples)
+    long = rng.uniform(-180, 180, n_samples)
+    times = np.datetime64('2022-01-01', 'us') + rng.integers(0, 365 * 86400, n_samples).astype('timedelta64[s]')
+
+    def run():
+        return incident_UV.clear_sky_UVI_at(lat, long, times, 300)
+
+    try:
+        incident_UV.use_solar_table(False)
+        direct = min(timeit.repeat(run, number = 1, repeat = repeats))
+        direct_uvi = run()
+
+        incident_UV.use_solar_table(True)
+        table = min(timeit.repeat(run, number = 1, repeat = repeats))
+        table_uvi = run()
+    finally:
+        incident_UV.use_solar_table(True)
+
+    return {'direct_s': direct, 'table_s': table, 'speedup': direct / table, 'max_abs_difference': float(np.max(np.abs(direct_uvi - table_uvi)))}
+
+
+def _best_time(function, repeats):
+    return min(timeit.repeat(function, number = 1, repeat = repeats))
+
+
+def _synthetic_timezone_table(path, resolution = 1.0):
+    """
+    Writes a timezone lookup table (see `timezones.TimezoneResolver`) which only covers the cells around
+    `BENCHMARK_LOCATIONS`, so that timezone lookups can be benchmarked without the tzwhere polygons.
+    """
+
+    names = []
+    codes = np.full((int(180 / resolution) + 1, int(360 / resolution) + 1), -1, dtype = np.int16)
+    for lat, long, name in BENCHMARK_LOCATIONS:
+        if name not in names:
+            names.append(name)
+        row, col = int((lat + 90) // resolution), int((long + 180) // resolution)
+        codes[row:row + 2, col:col + 2] = names.index(name)
+
+    np.savez(path, codes = codes, names = np.array(names), resolution = resolution)
+
+
+@contextlib.contextmanager
+def synthetic_workspace(days = 3):
+    """
+    Runs the enclosed code in a temporary working directory whose ./data/ folder holds synthetic raw OMPS files and
+    ozone grids for `days` days from `BENCHMARK_DATE`, with a timezone resolver that is answered from a synthetic table.
+    Nothing touches the network, and the previous working directory and resolver are restored afterwards.
+    """
+
+    previous_dir, previous_resolver = os.getcwd(), timezones._resolver
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = os.path.join(tmp_dir, "data")
+        os.makedirs(data_dir)
+
+        for offset in range(days):
+            date = BENCHMARK_DATE + timedelta(days = offset)
+            grid = write_synthetic_ozone_file(ozone._raw_filepath(date, data_dir = data_dir), date = date, seed = offset)
+            ozone.save_ozone_grid(grid, date, data_dir = data_dir)
+
+        table_path = os.path.join(data_dir, "timezone_table.npz")
+        _synthetic_timezone_table(table_path)
+
+        try:
+            os.chdir(tmp_dir)
+            timezones._resolver = timezones.TimezoneResolver(table_path = table_path)
+            yield tmp_dir
+        finally:
+            os.chdir(previous_dir)
+            timezones._resolver = previous_resolver
+
+
+def _sample_inputs(size, seed = 0):
+    """
+    Returns `size` latitudes, longitudes and UTC times cycling through `BENCHMARK_LOCATIONS` over `BENCHMARK_DATE`.
+    """
+
+    rng = np.random.default_rng(seed)
+    locations = np.array([location[:2] for location in BENCHMARK_LOCATIONS])[np.arange(size) % len(BENCHMARK_LOCATIONS)]
+    times = np.datetime64(BENCHMARK_DATE, 'us') + rng.integers(0, 86400, size).astype('timedelta64[s]')
+
+    return locations[:, 0], locations[:, 1], times
+
+
+def import_time(module):
+    """
+    Imports a module in a fresh interpreter with `python -X importtime`.
+
+    Returns:
+        seconds (float): the cumulative import time of the module
+        loaded (set): the names of all the modules that were loaded by the import
+    """
+
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import sys, {}; print(" ".join(sys.modules))'.format(module)],
+                               cwd = root, capture_output = True, text = True, check = True)
+
+    for line in completed.stderr.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            seconds = int(fields[1]) / 1e6
+
+    return seconds, set(completed.stdout.split())
+
+
+def check_import_budget(budgets = IMPORT_BUDGETS, lazy_dependencies = LAZY_DEPENDENCIES):
+    """
+    Checks that each module in `budgets` imports within its budget, and without loading any of `lazy_dependencies`.
+
+    Returns:
+        failures (dict): a description of the problem for each module that failed the check
+    """
+
+    failures = {}
+    for module, budget in budgets.items():
+        seconds, loaded = import_time(module)
+
+        problems = []
+        if seconds > budget:
+            problems.append('took {:.3f} s, over the budget of {:.3f} s'.format(seconds, budget))
+        eager = [dependency for dependency in lazy_dependencies if dependency in loaded]
+        if eager:
+            problems.append('loaded ' + ', '.join(eager))
+
+        if problems:
+            failures[module] = '; '.join(problems)
+
+    return failures
+
+
+def run_suite(sizes = BENCHMARK_SIZES, repeats = 3):
+    """
+    Times the main steps of the pipeline on synthetic data: ozone ingestion (`clean_ozone_data`, from the raw file and
+    from the cached grid), `get_ozone_thickness`, `get_times`, `zenith_angle` and `clear_sky_UVI` (one call per location,
+    and one vectorised call) and the runner's dose path, at each batch size in `sizes`.
+
+    Returns:
+        results (dict): the best time in seconds for each benchmark, keyed by 'name[size]'
+    """
+
+    from . import get_times
+
+    results = {}
+
+    for module in IMPORT_BUDGETS:
+        results['import[{}]'.format(module)] = min(import_time(module)[0] for _ in range(repeats))
+
+    with synthetic_workspace():
+        grid_path = ozone.grid_filepath(BENCHMARK_DATE)
+
+        def clean_from_raw():
+            os.remove(grid_path)
+            ozone.clean_ozone_data(BENCHMARK_DATE)
+
+        results['clean_ozone_data_raw'] = _best_time(clean_from_raw, repeats)
+        results['clean_ozone_data_cached'] = _best_time(lambda: ozone.clean_ozone_data(BENCHMARK_DATE), repeats)
+
+        df_ozone = ozone.clean_ozone_data(BENCHMARK_DATE)
+        grid = ozone.get_ozone_grid(BENCHMARK_DATE)
+
+        for size in sizes:
+            lats, longs, times = _sample_inputs(size)
+            utc_times = times.astype(datetime)
+            days = [utc_time.timetuple().tm_yday for utc_time in utc_times]
+            zeniths = incident_UV.zenith_angle_array(lats, longs, times)
+            tot_ozone = grid.thickness(lats, longs)
+
+            # the dataframe lookup scans all 64800 rows per call, so it is only timed on the smaller batches
+            if size <= 100:
+                results['get_ozone_thickness_dataframe[{}]'.format(size)] = _best_time(
+                    lambda: [ozone.get_ozone_thickness(df_ozone, lat, long) for lat, long in zip(lats, longs)], repeats)
+            results['get_ozone_thickness[{}]'.format(size)] = _best_time(
+                lambda: [ozone.get_ozone_thickness(grid, lat, long) for lat, long in zip(lats, longs)], repeats)
+            results['get_ozone_thickness_array[{}]'.format(size)] = _best_time(lambda: grid.thickness(lats, longs), repeats)
+
+            results['get_times[{}]'.format(size)] = _best_time(
+                lambda: [get_times(lat, long, utc_time) for lat, long, utc_time in zip(lats, longs, utc_times)], repeats)
+
+            results['zenith_angle[{}]'.format(size)] = _best_time(
+                lambda: [incident_UV.zenith_angle(lat, long, None, utc_time) for lat, long, utc_time in zip(lats, longs, utc_times)], repeats)
+            results['zenith_angle_array[{}]'.format(size)] = _best_time(lambda: incident_UV.zenith_angle_array(lats, longs, times), repeats)
+
+            results['clear_sky_UVI[{}]'.format(size)] = _best_time(
+                lambda: [incident_UV.clear_sky_UVI(day, zenith, value) for day, zenith, value in zip(days, zeniths, tot_ozone)], repeats)
+            results['clear_sky_UVI_at[{}]'.format(size)] = _best_time(lambda: incident_UV.clear_sky_UVI_at(lats, longs, times, tot_ozone), repeats)
+
+            # the runner's dose path: an 8 hour window per location, integrated with the ozone of each UTC day
+            jobs = [(lat, long, start, start + np.timedelta64(8, 'h')) for lat, long, start in zip(lats, longs, times)]
+            if size <= 100:
+                results['integrate_dose[{}]'.format(size)] = _best_time(
+                    lambda: [dose.integrate_dose(lat, long, start, end, dose.ozone_by_day(lat, long)) for lat, long, start, end in jobs], repeats)
+            results['dose_batch[{}]'.format(size)] = _best_time(lambda: dose.dose_batch(jobs), repeats)
+
+    return results
+
+
+def save_results(results, path):
+    """
+    Writes benchmark results to a JSON file together with the Python, numpy and pandas versions and the platform they were run on.
+    """
+
+    payload = {
+        'created': datetime.utcnow().isoformat(timespec = 'seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with open(path, 'w') as f:
+        json.dump(payload, f, indent = 2)
+
+    return path
+
+
+def compare_results(results, baseline_path, threshold = 1.25):
+    """
+    Compares benchmark results with a baseline JSON file written by `save_results`.
+
+    Returns:
+        regressions (dict): for each benchmark that is more than `threshold` times slower than the baseline, the ratio of the times
+    """
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+
+    ratios = {name: seconds / baseline[name] for name, seconds in results.items() if baseline.get(name)}
+
+    return {name: ratio for name, ratio in ratios.items() if ratio > threshold}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Runs the benchmark suite on synthetic data.")
+    parser.add_argument("--output", help = "The JSON file to write the results to.", type = str, default = "./output/benchmarks.json")
+    parser.add_argument("--baseline", help = "A JSON file from a previous run to compare against.", type = str, default = None)
+    parser.add_argument("--threshold", help = "How many times slower than the baseline counts as a regression.", type = float, default = 1.25)
+    parser.add_argument("--repeats", type = int, default = 3)
+    parser.add_argument("--sizes", type = int, nargs = "+", default = list(BENCHMARK_SIZES))
+    parser.add_argument("--imports_only", help = "Only run the import time budget check.", action = "store_true")
+    args = parser.parse_args()
+
+    failures = check_import_budget()
+    for module, problem in failures.items():
+        print('IMPORT BUDGET {} {}'.format(module, problem))
+    if args.imports_only:
+        sys.exit(1 if failures else 0)
+
+    results = run_suite(sizes = args.sizes, repeats = args.repeats)
+    for name, seconds in results.items():
+        print('{:45s} {:.6g} s'.format(name, seconds))
+
+    # the timings of the comparison benchmarks are saved and compared with the baseline too, e.g. as 'solar_table_direct'
+    for prefix, benchmark in (('ozone_parser', benchmark_ozone_parser), ('solar_table', benchmark_solar_table)):
+        print(benchmark.__name__)
+        for name, value in benchmark(repeats = args.repeats).items():
+            print('    {}: {:.6g}'.format(name, value))
+            if name.endswith('_s'):
+                results[prefix + '_' + name[:-len('_s')]] = value
+
+    print("Results written to", save_results(results, args.output))
+
+    regressions = {}
+    if args.baseline:
+        regressions = compare_results(results, args.baseline, threshold = args.threshold)
+        for name, ratio in regressions.items():
+            print('REGRESSION {:45s} {:.2f}x slower than the baseline'.format(name, ratio))
+
+    if failures or regressions:
+        sys.exit(1)
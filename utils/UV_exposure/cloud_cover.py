@@ -1,18 +1,18 @@
-import requests
+import asyncio
+import threading
+import time
 import warnings
 
-def get_cloud_mod_factor(lat, long, api_key):
-    
-    # Specify parameters required for API call
-    params = {'access_key': api_key, 
-              'query': str(lat) + ', ' + str(long)}
+from . import instrumentation
+
 
-    # Make API request
-    api_result = requests.get('http://api.weatherstack.com/current', params)
-    api_response = api_result.json()
+WEATHERSTACK_URL = 'http://api.weatherstack.com/current'
 
-    # Extract cloud cover from API response
-    cloud_cover = api_response['current']['cloudcover']
+
+def cloud_mod_factor(cloud_cover):
+    """
+    Returns the cloud modification factor for a level of cloud cover.
+    """
 
     # Depending on the level of cloud cover, the cloud modification factor changes
     # See equation 7 at the link below to see where the values below appear from:
@@ -25,5 +25,174 @@ def get_cloud_mod_factor(lat, long, api_key):
         cmf = 0.726
     else:
         cmf = 0.316
-        
-    return cmf
\ No newline at end of file
+
+    return cmf
+
+
+class WeatherstackBackend:
+    """
+    Fetches the current cloud cover from the weatherstack API over a pooled session.
+    `url` can point at a local stub server which returns responses in the same format.
+    """
+
+    def __init__(self, api_key, url = WEATHERSTACK_URL, session = None, pool_size = 8, timeout = 30):
+        self.api_key = api_key
+        self.url = url
+        self.timeout = timeout
+
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+    def cloud_cover(self, lat, long):
+        # Specify parameters required for API call
+        params = {'access_key': self.api_key,
+                  'query': str(lat) + ', ' + str(long)}
+
+        # Make API request
+        api_result = self.session.get(self.url, params = params, timeout = self.timeout)
+        api_response = api_result.json()
+
+        # Extract cloud cover from API response
+        return api_response['current']['cloudcover']
+
+
+class FixtureBackend:
+    """
+    Returns cloud cover from recorded data instead of calling an API, for use in tests.
+    `responses` maps (lat, long) tuples to either a cloud cover value or a recorded weatherstack response.
+    """
+
+    def __init__(self, responses, default = None):
+        self.responses = responses
+        self.default = default
+        self.calls = 0
+
+    def cloud_cover(self, lat, long):
+        self.calls += 1
+
+        response = self.responses.get((lat, long), self.default)
+        if response is None:
+            raise Exception("No recorded cloud cover for ({}, {}).".format(lat, long))
+
+        return response['current']['cloudcover'] if isinstance(response, dict) else response
+
+
+class CloudCoverClient:
+    """
+    A reusable cloud cover client. Results are cached for `ttl` seconds, keyed on coordinates rounded to
+    `precision` decimal places, so nearby and repeated queries do not hit the backend again. Expired entries are
+    dropped as new ones are stored, and at most `max_entries` are kept, so a long-running client stays bounded.
+    """
+
+    def __init__(self, backend, ttl = 1800, precision = 1, clock = time.monotonic, max_entries = 10000):
+        self.backend = backend
+        self.ttl = ttl
+        self.precision = precision
+        self.clock = clock
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _key(self, lat, long):
+        return round(float(lat), self.precision), round(float(long), self.precision)
+
+    def _cached(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and self.clock() - entry[0] < self.ttl:
+                self.hits += 1
+                instrumentation.count('cloud_cover.cache_hits')
+                return entry[1]
+
+            self.misses += 1
+            instrumentation.count('cloud_cover.cache_misses')
+            return None
+
+    def _store(self, key, cloud_cover):
+        with self._lock:
+            now = self.clock()
+            # keep the cache in the order entries were stored, so the oldest (and first to expire) come first
+            self._cache.pop(key, None)
+            self._cache[key] = (now, cloud_cover)
+
+            while self._cache:
+                oldest = next(iter(self._cache))
+                if len(self._cache) <= self.max_entries and now - self._cache[oldest][0] < self.ttl:
+                    break
+                del self._cache[oldest]
+                self.evictions += 1
+
+    def cloud_cover(self, lat, long):
+        """
+        Returns the cloud cover at a location, from the cache if a recent enough value is available.
+        """
+
+        key = self._key(lat, long)
+        cloud_cover = self._cached(key)
+        if cloud_cover is None:
+            with instrumentation.span('cloud_cover.request'):
+                cloud_cover = self.backend.cloud_cover(*key)
+            self._store(key, cloud_cover)
+
+        return cloud_cover
+
+    def cloud_mod_factor(self, lat, long):
+        return cloud_mod_factor(self.cloud_cover(lat, long))
+
+    async def cloud_mod_factors_async(self, coords, concurrency = 8):
+        """
+        Returns the cloud modification factor for each (lat, long) pair. Cache misses are fetched concurrently,
+        with at most `concurrency` requests in flight, and coordinates sharing a cache key are only fetched once.
+        """
+
+        keys = [self._key(lat, long) for lat, long in coords]
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(key):
+            async with semaphore:
+                return await asyncio.to_thread(self.cloud_cover, *key)
+
+        unique_keys = list(dict.fromkeys(keys))
+        cloud_covers = dict(zip(unique_keys, await asyncio.gather(*[fetch(key) for key in unique_keys])))
+
+        return [cloud_mod_factor(cloud_covers[key]) for key in keys]
+
+    def cloud_mod_factors(self, coords, concurrency = 8):
+        """
+        Synchronous wrapper around `cloud_mod_factors_async`.
+        """
+
+        return asyncio.run(self.cloud_mod_factors_async(coords, concurrency = concurrency))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'cached': len(self._cache)}
+
+
+_clients = {}
+
+
+def get_client(api_key):
+    """
+    Returns a shared weatherstack client for an API key.
+    """
+
+    if api_key not in _clients:
+        _clients[api_key] = CloudCoverClient(WeatherstackBackend(api_key))
+
+    return _clients[api_key]
+
+
+def get_cloud_mod_factor(lat, long, api_key):
+
+    return get_client(api_key).cloud_mod_factor(lat, long)
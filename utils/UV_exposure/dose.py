@@ -0,0 +1,291 @@
+import numpy as np
+
+from collections import namedtuple
+from datetime import datetime
+
+from . import incident_UV
+from . import instrumentation
+from . import ozone
+
+
+# We can convert from UV index to W/m^2 by multiplying by 0.025
+# Source: https://www.researchgate.net/post/How-can-I-convert-Ultra-Violet-index-into-Ultra-Violet-irradiation-Dose#:~:text=An%20index%20of%2010%20corresponds,(24%20h%20x%202600%20s).
+UVI_TO_IRRADIANCE = 0.025
+
+METHODS = ("rectangle", "trapezoid", "simpson", "adaptive")
+
+DoseResult = namedtuple("DoseResult", ["dose", "evaluations", "method"])
+DoseResult.__doc__ = "The accumulated UV dose in J/m^2, the number of UVI evaluations used to find it and the integration method."
+
+
+def daylight_intervals(lat, long, start, end):
+    """
+    Returns the parts of the UTC window [start, end] during which the Sun is above the horizon at a location.
+
+    The declination and equation of time only change from one UTC day to the next, so within each day sunrise and
+    sunset follow analytically from the hour angle at which the zenith angle reaches 90 degrees.
+
+    Returns:
+        intervals (list): (start, end) pairs of datetime64[us] values
+    """
+
+    start, end = incident_UV._as_datetime64(start), incident_UV._as_datetime64(end)
+    lat_rad = np.radians(np.clip(lat, -89.9999, 89.9999))
+
+    intervals = []
+    day = start.astype('datetime64[D]')
+    while day < end:
+        day_start = day.astype('datetime64[us]')
+        day_of_year = incident_UV.day_of_year(day_start)
+
+        # the Sun is up while cos(hour angle) > -tan(lat) tan(declination)
+        cos_limit = -np.tan(lat_rad) * np.tan(np.radians(incident_UV.declination(day_of_year)))
+        if cos_limit < 1:
+            half_day = 180.0 if cos_limit <= -1 else float(np.degrees(np.arccos(cos_limit)))
+            solar_noon = 720 - 4 * long - float(incident_UV.equation_of_time(day_of_year))
+
+            # the daylight period may wrap around either end of the UTC day
+            for shift in (-1440, 0, 1440):
+                sunrise = max(solar_noon - 4 * half_day + shift, 0)
+                sunset = min(solar_noon + 4 * half_day + shift, 1440)
+                if sunrise < sunset:
+                    t0 = max(day_start + np.timedelta64(int(round(sunrise * 60e6)), 'us'), start)
+                    t1 = min(day_start + np.timedelta64(int(round(sunset * 60e6)), 'us'), end)
+                    if t0 < t1:
+                        intervals.append((t0, t1))
+
+        day += np.timedelta64(1, 'D')
+
+    # join intervals which meet at midnight (e.g. during polar day)
+    merged = []
+    for t0, t1 in sorted(intervals):
+        if merged and t0 <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], t1))
+        else:
+            merged.append((t0, t1))
+
+    return merged
+
+
+def _fixed_rule(uvi, a, b, method, step):
+    n = max(int(np.ceil((b - a) / step)), 1)
+    if method == "simpson" and n % 2:
+        n += 1
+
+    t = np.linspace(a, b, n + 1)
+    h = (b - a) / n
+
+    if method == "rectangle":
+        values = uvi(t[:-1])
+        return h * np.sum(values), n
+
+    values = uvi(t)
+    if method == "trapezoid":
+        return h * (np.sum(values) - (values[0] + values[-1]) / 2), n + 1
+
+    return h / 3 * (values[0] + values[-1] + 4 * np.sum(values[1:-1:2]) + 2 * np.sum(values[2:-1:2])), n + 1
+
+
+def _adaptive_simpson(uvi, intervals, tol, min_width, initial_panels = 4):
+    """
+    Vectorised adaptive Simpson's rule. Every pass evaluates the midpoints of all unconverged panels in a single call,
+    and a panel is accepted once the difference between its one- and two-panel estimates is within its share of `tol`.
+    """
+
+    total_width = sum(b - a for a, b in intervals)
+    points = [np.linspace(a_, b_, 2 * initial_panels + 1) for a_, b_ in intervals]
+    values = np.split(uvi(np.concatenate(points)), np.cumsum([len(p) for p in points])[:-1])
+    evaluations = sum(len(p) for p in points)
+
+    a, m, b = [np.concatenate([p[offset::2][:initial_panels] for p in points]) for offset in (0, 1, 2)]
+    fa, fm, fb = [np.concatenate([v[offset::2][:initial_panels] for v in values]) for offset in (0, 1, 2)]
+
+    total = 0.0
+    while len(a):
+        left_m, right_m = (a + m) / 2, (m + b) / 2
+        values = uvi(np.concatenate([left_m, right_m]))
+        f_left, f_right = np.split(values, 2)
+        evaluations += len(values)
+
+        whole = (b - a) / 6 * (fa + 4 * fm + fb)
+        left = (m - a) / 6 * (fa + 4 * f_left + fm)
+        right = (b - m) / 6 * (fm + 4 * f_right + fb)
+        error = (left + right - whole) / 15
+
+        done = (np.abs(error) <= tol * (b - a) / total_width) | ((b - a) / 2 <= min_width)
+        total += np.sum((left + right + error)[done])
+
+        # split the remaining panels in two
+        keep = ~done
+        a, m, b = np.concatenate([a[keep], m[keep]]), np.concatenate([left_m[keep], right_m[keep]]), np.concatenate([m[keep], b[keep]])
+        fa, fm, fb = np.concatenate([fa[keep], fm[keep]]), np.concatenate([f_left[keep], f_right[keep]]), np.concatenate([fm[keep], fb[keep]])
+
+    return total, evaluations
+
+
+@instrumentation.span('dose.integrate')
+def integrate_dose(lat, long, start, end, tot_ozone, method = "adaptive", tol = 1.0, step = 300, min_width = 1.0):
+    """
+    Integrates the clear-sky UV irradiance at a location over a UTC time window. Night-time is skipped analytically
+    (see `daylight_intervals`), so only the hours of daylight are sampled.
+
+    Parameters:
+        lat (float): latitude coordinate of the location
+        long (float): longitude coordinate of the location
+        start (datetime/datetime64): the start of the window in UTC
+        end (datetime/datetime64): the end of the window in UTC
+        tot_ozone (float or callable): total column ozone in Dobson units, or a function mapping UTC times to it (see `ozone_by_day`)
+        method (str): one of 'rectangle' (left Riemann sum), 'trapezoid', 'simpson' or 'adaptive'
+        tol (float): the absolute error tolerance of the 'adaptive' method in J/m^2
+        step (float): the sample spacing of the fixed-step methods in seconds
+        min_width (float): the narrowest panel, in seconds, that the 'adaptive' method will split
+
+    Returns:
+        result (DoseResult): the dose in J/m^2 and the number of UVI evaluations used
+    """
+
+    if method not in METHODS:
+        raise Exception("Unknown integration method '{}'. Choose from {}.".format(method, ", ".join(METHODS)))
+    if not step > 0:
+        raise Exception("step must be a positive number of seconds, got {}.".format(step))
+
+    start = incident_UV._as_datetime64(start)
+
+    def uvi(seconds):
+        # `seconds` are measured from the start of the window
+        times = start + np.round(seconds * 1e6).astype('timedelta64[us]')
+        ozone_values = tot_ozone(times) if callable(tot_ozone) else tot_ozone
+        return incident_UV.clear_sky_UVI_at(lat = lat, long = long, utc_time = times, tot_ozone = ozone_values)
+
+    # daylight intervals as seconds since the start of the window
+    intervals = [((t0 - start) / np.timedelta64(1, 's'), (t1 - start) / np.timedelta64(1, 's'))
+                 for t0, t1 in daylight_intervals(lat, long, start, end)]
+
+    if not intervals:
+        return DoseResult(dose = 0.0, evaluations = 0, method = method)
+
+    if method == "adaptive":
+        integral, evaluations = _adaptive_simpson(uvi, intervals, tol = tol / UVI_TO_IRRADIANCE, min_width = min_width)
+    else:
+        integral, evaluations = 0.0, 0
+        for a, b in intervals:
+            interval_integral, interval_evaluations = _fixed_rule(uvi, a, b, method, step)
+            integral += interval_integral
+            evaluations += interval_evaluations
+
+    instrumentation.count('dose.evaluations', evaluations)
+    return DoseResult(dose = float(integral * UVI_TO_IRRADIANCE), evaluations = evaluations, method = method)
+
+
+def ozone_by_day(lat, long, ozone_for_day = ozone.get_ozone_grid):
+    """
+    Returns a function which maps UTC times to the ozone thickness at a location, using each UTC day's ozone grid.
+    Each day's grid is only looked up once. Pass the result as `tot_ozone` to `integrate_dose` for multi-day windows.
+    """
+
+    thickness = {}
+
+    def tot_ozone(times):
+        days = np.asarray(times).astype('datetime64[D]')
+        values = np.empty(days.shape)
+        for day in np.unique(days):
+            if day not in thickness:
+                thickness[day] = ozone_for_day(day.astype(datetime)).thickness(lat, long)
+            values[days == day] = thickness[day]
+
+        return values
+
+    return tot_ozone
+
+
+@instrumentation.span('dose.batch')
+def dose_batch(jobs, ozone_for_day = ozone.get_ozone_grid, method = "trapezoid", step = 300):
+    """
+    Computes the clear-sky UV dose for many (lat, long, start, end) jobs at once. Windows can span several days.
+
+    The daylight part of every job is split at UTC midnight, so each piece uses the solar geometry and ozone grid of
+    its own UTC day. Pieces are grouped by day so that each day's ozone grid is loaded once, then every sample of every
+    job is evaluated in a single vectorised pass.
+
+    Parameters:
+        jobs (iterable): (lat, long, start, end) tuples, with start and end in UTC
+        ozone_for_day (callable): returns the `OzoneGrid` for a date
+        method (str): 'trapezoid' or 'simpson'
+        step (float): the largest sample spacing in seconds
+
+    Returns:
+        results (DataFrame): one row per job with latitude, longitude, start, end, dose (J/m^2) and samples columns
+    """
+
+    import pandas as pd
+
+    if method not in ("trapezoid", "simpson"):
+        raise Exception("Batch doses can only be computed with the 'trapezoid' or 'simpson' methods.")
+    if not step > 0:
+        raise Exception("step must be a positive number of seconds, got {}.".format(step))
+
+    jobs = [(float(lat), float(long), incident_UV._as_datetime64(start), incident_UV._as_datetime64(end)) for lat, long, start, end in jobs]
+
+    # Split the daylight part of each job into pieces which lie within a single UTC day
+    piece_job, piece_day, piece_start, piece_end = [], [], [], []
+    for index, (lat, long, start, end) in enumerate(jobs):
+        for t0, t1 in daylight_intervals(lat, long, start, end):
+            day = t0.astype('datetime64[D]')
+            while t0 < t1:
+                t_split = min(t1, (day + 1).astype('datetime64[us]'))
+                piece_job.append(index)
+                piece_day.append(day)
+                piece_start.append(t0)
+                piece_end.append(t_split)
+                t0, day = t_split, day + 1
+
+    piece_job = np.array(piece_job, dtype = np.int64)
+    piece_day = np.array(piece_day, dtype = 'datetime64[D]')
+    piece_start = np.array(piece_start, dtype = 'datetime64[us]')
+    piece_end = np.array(piece_end, dtype = 'datetime64[us]')
+    lats = np.array([job[0] for job in jobs])[piece_job]
+    longs = np.array([job[1] for job in jobs])[piece_job]
+
+    # Look up the ozone thickness for every piece, loading each day's grid once
+    tot_ozone = np.empty(len(piece_job))
+    for day in np.unique(piece_day):
+        on_day = piece_day == day
+        tot_ozone[on_day] = ozone_for_day(day.astype(datetime)).thickness(lats[on_day], longs[on_day])
+
+    # Sample every piece evenly, with at most `step` seconds between samples
+    width = (piece_end - piece_start) / np.timedelta64(1, 's')
+    n = np.maximum(np.ceil(width / step).astype(np.int64), 1)
+    if method == "simpson":
+        n += n % 2
+    h = width / n
+    counts = n + 1
+
+    first = np.cumsum(counts) - counts
+    k = np.arange(counts.sum()) - np.repeat(first, counts)
+    n_sample, h_sample = np.repeat(n, counts), np.repeat(h, counts)
+    times = np.repeat(piece_start, counts) + np.round(k * h_sample * 1e6).astype('timedelta64[us]')
+
+    uvi = incident_UV.clear_sky_UVI_at(
+        lat = np.repeat(lats, counts),
+        long = np.repeat(longs, counts),
+        utc_time = times,
+        tot_ozone = np.repeat(tot_ozone, counts)
+    )
+
+    end_point = (k == 0) | (k == n_sample)
+    if method == "trapezoid":
+        weights = np.where(end_point, 0.5, 1.0)
+    else:
+        weights = np.where(end_point, 1.0, np.where(k % 2 == 1, 4.0, 2.0)) / 3
+
+    piece_integral = np.add.reduceat(uvi * weights * h_sample, first) if len(first) else np.zeros(0)
+    instrumentation.count('dose.evaluations', len(uvi))
+
+    return pd.DataFrame({
+        'latitude': [job[0] for job in jobs],
+        'longitude': [job[1] for job in jobs],
+        'start': np.array([job[2] for job in jobs], dtype = 'datetime64[us]'),
+        'end': np.array([job[3] for job in jobs], dtype = 'datetime64[us]'),
+        'dose': np.bincount(piece_job, weights = piece_integral, minlength = len(jobs)) * UVI_TO_IRRADIANCE,
+        'samples': np.bincount(piece_job, weights = counts, minlength = len(jobs)).astype(np.int64),
+    })
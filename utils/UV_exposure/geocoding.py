@@ -0,0 +1,205 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from . import instrumentation
+
+
+class NominatimBackend:
+    """
+    Geocodes location strings with OpenStreetMap's Nominatim service, which allows at most one request per second.
+    """
+
+    min_interval = 1.0
+
+    def __init__(self, user_agent = "PDS", timeout = 10):
+        from geopy.geocoders import Nominatim
+
+        self.geolocator = Nominatim(timeout=timeout, user_agent=user_agent)
+
+    def geocode(self, location):
+        location_full = self.geolocator.geocode(location)
+        if location_full is None:
+            return None
+
+        return location_full.latitude, location_full.longitude
+
+
+class StaticBackend:
+    """
+    Geocodes from a fixed mapping of location strings to (lat, long), for use in tests or offline runs.
+    """
+
+    min_interval = 0.0
+
+    def __init__(self, coordinates):
+        self.coordinates = {normalize_location(location): coords for location, coords in coordinates.items()}
+        self.calls = 0
+
+    def geocode(self, location):
+        self.calls += 1
+        return self.coordinates.get(normalize_location(location))
+
+
+def normalize_location(location):
+    """
+    Normalises a location string so that trivially different spellings share a cache entry,
+    e.g. '  Cardiff ,UK' and 'cardiff, uk'.
+    """
+
+    location = re.sub(r'\s*,\s*', ', ', location.casefold())
+    return ' '.join(location.split()).strip(', ')
+
+
+class GeocodingCache:
+    """
+    Geocodes location strings through an on-disk SQLite cache, so that each location only ever reaches the backend once.
+    Locations the backend cannot find are cached too. With `offline = True` the backend is never called.
+
+    The backend can be any object with a `geocode(location)` method returning (lat, long) or None, and a
+    `min_interval` attribute giving the number of seconds to leave between calls.
+    """
+
+    def __init__(self, path = "./data/geocode_cache.sqlite", backend = None, offline = False):
+        self.path = path
+        self.offline = offline
+        self._backend = backend
+        self._last_call = 0.0
+        self._memory = {}
+        self._lock = threading.Lock()
+        # held across the rate limit wait, the backend call and `_last_call`, so that threads take turns
+        self._fetch_lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS locations (query TEXT PRIMARY KEY, latitude REAL, longitude REAL, updated REAL)")
+        self._db.commit()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = NominatimBackend()
+
+        return self._backend
+
+    def _lookup(self, query):
+        if query in self._memory:
+            return True, self._memory[query]
+
+        with self._lock:
+            row = self._db.execute("SELECT latitude, longitude FROM locations WHERE query = ?", (query,)).fetchone()
+
+        if row is None:
+            return False, None
+
+        coords = None if row[0] is None else (row[0], row[1])
+        self._memory[query] = coords
+        return True, coords
+
+    def _store(self, query, coords):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?)",
+                             (query, None if coords is None else coords[0], None if coords is None else coords[1], time.time()))
+            self._db.commit()
+        self._memory[query] = coords
+
+    def _fetch(self, query):
+        with self._fetch_lock:
+            # another thread may have fetched the same location while this one was waiting
+            found, coords = self._lookup(query)
+            if found:
+                return coords
+
+            # leave at least `min_interval` seconds between backend calls
+            wait = self._last_call + getattr(self.backend, 'min_interval', 0.0) - time.monotonic()
+            if wait > 0:
+                instrumentation.count('geocoding.rate_limit_wait_s', wait)
+                time.sleep(wait)
+
+            try:
+                with instrumentation.span('geocoding.request'):
+                    coords = self.backend.geocode(query)
+            finally:
+                self._last_call = time.monotonic()
+
+            self._store(query, coords)
+
+        return coords
+
+    def geocode(self, location):
+        """
+        Returns the (lat, long) of a location string.
+        """
+
+        coords = self.geocode_many([location])[location]
+        if coords is None:
+            raise Exception("Could not find the location '{}'.".format(location))
+
+        return coords
+
+    def geocode_many(self, locations):
+        """
+        Returns a dict mapping each location string to its (lat, long), or None if it could not be found.
+        Cached locations are answered straight away; each remaining distinct location is sent to the backend once,
+        spaced out by the backend's rate limit.
+        """
+
+        queries = {location: normalize_location(location) for location in locations}
+
+        results, pending = {}, []
+        for query in dict.fromkeys(queries.values()):
+            found, coords = self._lookup(query)
+            if found:
+                self.hits += 1
+                results[query] = coords
+            else:
+                self.misses += 1
+                pending.append(query)
+
+        instrumentation.count('geocoding.cache_hits', len(results))
+        instrumentation.count('geocoding.cache_misses', len(pending))
+
+        if pending and self.offline:
+            raise Exception("The geocoding cache is offline and has no entry for: {}.".format(", ".join(pending)))
+
+        for query in pending:
+            results[query] = self._fetch(query)
+
+        return {location: results[query] for location, query in queries.items()}
+
+    def seed(self, coordinates):
+        """
+        Adds known coordinates to the cache, e.g. `seed({'Cardiff': (51.48, -3.18)})`.
+        """
+
+        for location, coords in coordinates.items():
+            self._store(normalize_location(location), tuple(coords))
+
+    def stats(self):
+        with self._lock:
+            cached = self._db.execute("SELECT COUNT(*) FROM locations").fetchone()[0]
+
+        return {'hits': self.hits, 'misses': self.misses, 'cached': cached}
+
+
+_geocoder = None
+
+
+def get_geocoder():
+    """
+    Returns the process-wide geocoding cache, creating it on first use.
+    """
+
+    global _geocoder
+    if _geocoder is None:
+        _geocoder = GeocodingCache()
+
+    return _geocoder
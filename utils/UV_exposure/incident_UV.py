@@ -1,112 +1,245 @@
-import math
+import numpy as np
 
-from datetime import timedelta
+from . import instrumentation
 
 
-def zenith_angle(lat, long, local_time, utc_time):
+# Day-of-year lookup table of the solar terms (see `solar_table`), and whether the solar computations use it
+_solar_table = None
+_use_solar_table = True
+
+
+def _as_datetime64(utc_time):
     """
-    Finds the solar zenith angle for a given location and time. The zenith angle is the angle between a line from a location on the Earth's surface to the Sun, and a line which points perpendicularly outwards from that location on Earth. Therefore, a zenith angle of 0 indicates that the Sun is directly overhead.
-    
+    Converts datetimes, strings or datetime64 values (scalar or array-like) to a datetime64[us] array.
+    Timezone-aware datetimes are converted to naive UTC first so that numpy does not complain.
+    """
+
+    if hasattr(utc_time, 'tzinfo') and utc_time.tzinfo is not None:
+        utc_time = (utc_time - utc_time.utcoffset()).replace(tzinfo = None)
+
+    return np.asarray(utc_time, dtype = 'datetime64[us]')
+
+
+def day_of_year(utc_time):
+    """
+    Returns the day of the year (1-366) for each of the given UTC times.
+
     Parameters:
-        lat (float): latitude coordinate of the given location
-        long (float): longitude coordinate of the given location
-        time (datetime): the time of day
-    
+        utc_time (datetime64 array-like): the UTC times
+
     Returns:
-        zenith_angle (float): the solar zenith angle in radians
+        day (int array): the day of the year, equivalent to `timetuple().tm_yday`
+    """
+
+    utc_time = _as_datetime64(utc_time)
+    return (utc_time.astype('datetime64[D]') - utc_time.astype('datetime64[Y]')).astype(np.int64) + 1
+
+
+def declination(day):
+    """
+    Returns the declination angle of the Earth in degrees for the given day(s) of the year.
+    """
+
+    return -23.45 * np.cos(np.radians((360 / 365) * (np.asarray(day) + 10)))
+
+
+def equation_of_time(day):
+    """
+    Returns the equation of time in minutes for the given day(s) of the year.
+    """
+
+    b = np.radians((360 / 365) * (np.asarray(day) - 81))
+    return 9.87 * np.sin(2 * b) - 7.53 * np.cos(b) - 1.5 * np.sin(b)
+
+
+def earth_sun_factor(utc_day):
+    """
+    Returns the (1 / Earth-Sun distance)^2 factor used to scale the UVA irradiance for the given day(s) of the year.
+    """
+
+    earth_sun_dist = 1 - 0.01672 * np.cos(0.9856 * (np.asarray(utc_day) - 4))
+    return (1 / earth_sun_dist) ** 2
+
+
+def solar_table():
+    """
+    Returns the solar terms for days 0-366 of the year, as a dict of arrays indexed by day: declination (degrees),
+    sin_decl, cos_decl, equation_of_time (minutes) and earth_sun_factor.
+
+    The formulas above only depend on the day of the year, so looking them up is exact. The table is built on first
+    use and shared by all solar computations.
     """
-    
-    
-    def metric_ang_decl(utc_time):
-        """
-        Returns the declination angle of the Earth in degrees.
 
-        Parameters:
-            day (int): the day of the year
+    global _solar_table
+    if _solar_table is None:
+        day = np.arange(367)
+        ang_decl = np.radians(declination(day))
+        _solar_table = {
+            'declination': declination(day),
+            'sin_decl': np.sin(ang_decl),
+            'cos_decl': np.cos(ang_decl),
+            'equation_of_time': equation_of_time(day),
+            'earth_sun_factor': earth_sun_factor(day),
+        }
 
-        Returns:
-            ang_decl (float): the angle of declination of the Earth in degrees
-        """
+    return _solar_table
 
-        day = utc_time.timetuple().tm_yday
-        return -23.45 * math.cos(math.radians((360 / 365) * (day + 10)))
-    
-    
-    def LSTM(lat, long, local_time, utc_time):
-        """
-        Returns the Local Standard Time Meridian
-        """
 
-        delta_utc =  local_time.hour - utc_time.hour
-        
-        return 15 * delta_utc
+def use_solar_table(enabled = True):
+    """
+    Switches the solar computations between the precomputed day-of-year table (the default) and the direct formulas.
+    """
+
+    global _use_solar_table
+    _use_solar_table = enabled
+
+
+def _is_day_index(day):
+    return _use_solar_table and np.asarray(day).dtype.kind in 'iu'
+
 
+def _solar_terms(day):
+    """
+    Returns sin(declination), cos(declination) and the equation of time for the given day(s) of the year.
+    """
 
-    def time_correct_fact(lat, long, local_time, utc_time):
-        """
-        Returns the time correction factor for a particular longitude
-        """
+    if _is_day_index(day):
+        table = solar_table()
+        return table['sin_decl'][day], table['cos_decl'][day], table['equation_of_time'][day]
 
-        day = local_time.timetuple().tm_yday
+    ang_decl = np.radians(declination(day))
+    return np.sin(ang_decl), np.cos(ang_decl), equation_of_time(day)
 
-        b = (360 / 365) * (day - 81)
 
-        tcf = 4 * (long - LSTM(lat = lat, long = long, local_time = local_time, utc_time = utc_time)) + 9.87*math.sin(math.radians(2*b)) - 7.53*math.cos(math.radians(b)) - 1.5*math.sin(math.radians(b))
+@instrumentation.span('incident_UV.zenith_angle')
+def zenith_angle_array(lat, long, utc_time):
+    """
+    Vectorised solar zenith angle. All arguments are broadcast against each other using the usual numpy rules, so
+    N locations x M timestamps can be computed in one call by passing e.g. `lat[:, None]`, `long[:, None]` and `utc_time[None, :]`.
 
-        return tcf 
+    The hour angle is found from the apparent solar time, i.e. the UTC time shifted by 4 minutes per degree of longitude
+    plus the equation of time. This makes the result independent of the local timezone.
 
+    The scalar `zenith_angle` is a wrapper around this function, so the two agree exactly. Compared with NOAA's general
+    solar position formulas the zenith is within 2 degrees, the error coming from the simple cosine declination model.
+    (The original scalar implementation added the time correction factor as tcf / 60 minutes and took the hour angle
+    from the local clock, so it could be off by up to about 16 degrees.)
 
-    def hour_angle(lat, long, local_time, utc_time):
-        """
-        Returns the hour angle for a particular longitude
-        """
+    Parameters:
+        lat (float array-like): latitude coordinates in degrees
+        long (float array-like): longitude coordinates in degrees
+        utc_time (datetime64 array-like): the UTC times
 
-        time_corrected = local_time + timedelta(hours = -12, minutes = time_correct_fact(lat = lat, long = long, local_time = local_time, utc_time = utc_time) / 60, seconds = 0)
+    Returns:
+        zenith_angle (float array): the solar zenith angles in radians
+    """
 
-        hr_angle = 15 * (time_corrected.hour + time_corrected.minute / 60 + time_corrected.second / 3600)
-        
-        return hr_angle
-    
-    
-    #------ function call begins ------#
-    
-    ang_decl = metric_ang_decl(utc_time = utc_time)
+    lat = np.asarray(lat, dtype = float)
+    long = np.asarray(long, dtype = float)
+    utc_time = _as_datetime64(utc_time)
 
-    elevation_angle = math.asin(math.sin(math.radians(ang_decl)) * math.sin(math.radians(lat)) + math.cos(math.radians(ang_decl)) * math.cos(math.radians(lat)) * math.cos(math.radians(hour_angle(lat = lat, long = long, local_time = local_time, utc_time = utc_time))))
+    day = day_of_year(utc_time)
+    utc_minutes = (utc_time - utc_time.astype('datetime64[D]')).astype(np.int64) / 60e6
+
+    sin_decl, cos_decl, eot = _solar_terms(day)
+
+    # apparent solar time in minutes, then the hour angle in degrees (0 at solar noon)
+    solar_minutes = utc_minutes + 4 * long + eot
+    hr_angle = 15 * (solar_minutes / 60 - 12)
+
+    lat_rad = np.radians(lat)
+
+    sin_elevation = sin_decl * np.sin(lat_rad) + cos_decl * np.cos(lat_rad) * np.cos(np.radians(hr_angle))
+    elevation_angle = np.arcsin(np.clip(sin_elevation, -1, 1))
 
     # convert from elevation angle to zenith angle
-    zenith_angle = (math.pi / 2) - elevation_angle
-    return zenith_angle
- 
-    
+    return (np.pi / 2) - elevation_angle
+
+
+def UVA_array(utc_day, zenith):
+    """
+    Vectorised version of `UVA`. Arguments are broadcast against each other.
+    """
+
+    mu = np.cos(zenith) * 0.83 + 0.17
+    factor = solar_table()['earth_sun_factor'][utc_day] if _is_day_index(utc_day) else earth_sun_factor(utc_day)
+
+    with np.errstate(divide = 'ignore', over = 'ignore'):
+        return factor * 1.24 * mu * np.exp(- (0.58 / mu))
+
+
+@instrumentation.span('incident_UV.clear_sky_UVI')
+def clear_sky_UVI_array(utc_day, zenith, tot_ozone):
+    """
+    Vectorised version of `clear_sky_UVI`. Arguments are broadcast against each other.
+    Night-time samples (zenith angle beyond 90 degrees) and non-positive ozone values give a UV index of 0.
+
+    Parameters:
+        utc_day (int array-like): the day of the year in UTC
+        zenith (float array-like): solar zenith angles in radians
+        tot_ozone (float array-like): total column ozone in Dobson units
+
+    Returns:
+        UVI (float array): the clear-sky UV index
+    """
+
+    zenith = np.asarray(zenith, dtype = float)
+    tot_ozone = np.asarray(tot_ozone, dtype = float)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'):
+        X = 1000 * np.cos(zenith) / tot_ozone
+        valid = (X >= 0) & (tot_ozone > 0)
+
+        UVI = UVA_array(utc_day, zenith) * (2 * np.power(np.where(valid, X, 0), 1.62) + 280 / tot_ozone + 1.4)
+
+    return np.where(valid & (UVI > 0), UVI, 0.0)
+
+
+def clear_sky_UVI_at(lat, long, utc_time, tot_ozone):
+    """
+    Convenience function combining `zenith_angle_array` and `clear_sky_UVI_array`. All arguments are broadcast against each other.
+    """
+
+    utc_time = _as_datetime64(utc_time)
+    zenith = zenith_angle_array(lat = lat, long = long, utc_time = utc_time)
+
+    return clear_sky_UVI_array(utc_day = day_of_year(utc_time), zenith = zenith, tot_ozone = tot_ozone)
+
+
+def zenith_angle(lat, long, local_time, utc_time):
+    """
+    Finds the solar zenith angle for a given location and time. The zenith angle is the angle between a line from a location on the Earth's surface to the Sun, and a line which points perpendicularly outwards from that location on Earth. Therefore, a zenith angle of 0 indicates that the Sun is directly overhead.
+
+    This is a thin wrapper around `zenith_angle_array`. The solar time is derived from `utc_time` and the longitude, so
+    `local_time` is only kept for backwards compatibility.
+
+    Parameters:
+        lat (float): latitude coordinate of the given location
+        long (float): longitude coordinate of the given location
+        local_time (datetime): the local time of day (unused)
+        utc_time (datetime): the UTC time
+
+    Returns:
+        zenith_angle (float): the solar zenith angle in radians
+    """
+
+    return float(zenith_angle_array(lat = lat, long = long, utc_time = utc_time))
+
+
 def UVA(utc_day, zenith):
     """
     Calculate the current UVA value for a given location.
     We don't have latitude and longitude because we want the zenith angle to be identical
-    for this equation and for UVI (see below). Having zentih as an argument avoids calculating the 
+    for this equation and for UVI (see below). Having zentih as an argument avoids calculating the
     zenith angle twice and at two separate (albeit close) times.
     """
-    
-    mu = math.cos(zenith) * 0.83 + 0.17
-    earth_sun_dist = 1 - 0.01672 * math.cos(0.9856 * (utc_day - 4))
-    
-    UVA = pow((1 / earth_sun_dist), 2) * 1.24 * mu * math.exp(- (0.58 / mu))
-    return UVA
+
+    return float(UVA_array(utc_day, zenith))
 
 
 def clear_sky_UVI(utc_day, zenith, tot_ozone):
     """
     Calculate current clear-sky UVI for a given location
     """
-    
-    UVA_ = UVA(utc_day, zenith)
-
-    X = 1000 * math.cos(zenith) / tot_ozone
-    
-    UVI = UVA_ * (2 * pow(X, 1.62) + 280 / tot_ozone + 1.4)
-    
-    if isinstance(UVI, complex) or UVI < 0:
-        UVI = 0
-        
-    return UVI
-    
\ No newline at end of file
+
+    return float(clear_sky_UVI_array(utc_day, zenith, tot_ozone))
@@ -0,0 +1,120 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_enabled = True
+
+
+def set_enabled(enabled = True):
+    """
+    Switches the recording of spans and counters on or off. It is on by default; the overhead is a couple of
+    `time.perf_counter` calls per span.
+    """
+
+    global _enabled
+    _enabled = enabled
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Times the enclosed block and adds it to the span `name`, e.g.
+
+        with instrumentation.span('ozone.parse'):
+            ...
+
+    Can also be used as a decorator. Every call, including ones that raise, is recorded.
+    """
+
+    if not _enabled:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        with _lock:
+            stats = _spans.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+
+def count(name, value = 1):
+    """
+    Adds `value` to the counter `name`, e.g. `count('ozone_archive.bytes_downloaded', len(chunk))`.
+    """
+
+    if not _enabled:
+        return
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def report():
+    """
+    Returns everything recorded so far.
+
+    Returns:
+        report (dict): 'spans' maps each span name to its number of calls and its total, mean and maximum time in seconds,
+                       and 'counters' maps each counter name to its value
+    """
+
+    with _lock:
+        spans = {name: {'calls': calls, 'total_s': total, 'mean_s': total / calls, 'max_s': longest}
+                 for name, (calls, total, longest) in sorted(_spans.items())}
+        counters = dict(sorted(_counters.items()))
+
+    return {'spans': spans, 'counters': counters}
+
+
+def dump(path):
+    """
+    Writes `report()` to a JSON file.
+    """
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent = 2)
+
+    return path
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+@contextlib.contextmanager
+def profile(path):
+    """
+    Runs the enclosed block under cProfile and writes the statistics to `path`. The file can be read with `pstats`,
+    or turned into a flame graph with tools such as snakeviz, tuna or flameprof.
+    """
+
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        profiler.dump_stats(path)
@@ -1,93 +1,479 @@
+import glob
 import math
 import numpy as np
 import os
-import pandas as pd
-import pytz
-import requests
+import re
+import threading
 import warnings
 
-from bs4 import BeautifulSoup
 from datetime import datetime, timedelta
 from os.path import exists
-from tzwhere import tzwhere
 
-from .incident_UV import zenith_angle 
+from . import instrumentation
+
+
+# Layout of the cleaned ozone grids: 1 degree cells, rows from latitude -89.5 to 89.5 and columns from longitude -179.5 to 179.5
+OZONE_GRID_SHAPE = (180, 360)
+OZONE_DTYPE = np.int16
+LATITUDES = np.linspace(-89.5, 89.5, 180)
+LONGITUDES = np.linspace(-179.5, 179.5, 360)
 
 
 def get_ozone_data(date): 
-    
-    if not os.path.exists("./data/"):
-        os.makedirs("./data/")
-    
-    # Find current datetime for UTC
-    # date = datetime.utcnow() - timedelta(days=1) 
-    end_filepath = "./data/ozone_data_raw_" + str(date.year) + str(date.month) + str(date.day) + ".txt"
-
-    # Check whether ozone data file already exists
-    if not exists(end_filepath):
-        # Extract all links on the url webpage. This page contains links to text files containing global ozone data
-        url = "https://ozonewatch.gsfc.nasa.gov/data/omps/Y" + str(date.year) + "/"
-        reqs = requests.get(url)
-        links = BeautifulSoup(reqs.text, 'html.parser')
-
-        # Combine year, month and day into a format that we expect to be in the relevant text file link
-        date_suffix = '{:04d}'.format(date.year) + 'm' + '{:02d}'.format(date.month) + '{:02d}'.format(date.day)
-        
-        # Find text file link
-        txt_file_suffix = [link.get('href') for link in links.find_all('a') if date_suffix in link.get('href')]
-        
-        try:
-            file_url = url + txt_file_suffix[0]
-        except IndexError:
-            raise Exception("Cannot get ozone data for the specified date. Try an earlier date. Note that NASA take 2 days to release ozone data.")
-            
-        r = requests.get(file_url, allow_redirects=True)
-        
-        open(f'{end_filepath}', 'wb').write(r.content)
+    """
+    Downloads the raw NASA ozone file for a date into ./data/ unless it has already been downloaded.
+    See `ozone_archive.OzoneArchive` for downloading a range of dates.
+    """
+
+    from .ozone_archive import get_archive
+
+    return get_archive().download(date)
+
+
+def grid_filepath(date, data_dir = "./data/"):
+    """
+    Returns the path of the binary ozone grid for a given date. The grid is stored as a 180 x 360 int16 array in
+    .npy format, with rows running from latitude -89.5 to 89.5 and columns from longitude -179.5 to 179.5.
+    """
+
+    return os.path.join(data_dir, "ozone_grid_" + date.strftime("%Y%m%d") + ".npy")
+
+
+def save_ozone_grid(grid, date, data_dir = "./data/"):
+    """
+    Writes an ozone grid to its binary file. The file is written to a temporary path first and then moved into place
+    so that readers never see a partially written grid.
+    """
+
+    grid = np.asarray(grid, dtype = OZONE_DTYPE)
+    if grid.shape != OZONE_GRID_SHAPE:
+        raise Exception("Ozone grid must have shape {}, got {}.".format(OZONE_GRID_SHAPE, grid.shape))
+
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    filepath = grid_filepath(date, data_dir = data_dir)
+    # the temporary file is unique to this thread, since several threads may create the same grid at once
+    tmp_filepath = "{}.{}.{}.tmp".format(filepath, os.getpid(), threading.get_ident())
+    with open(tmp_filepath, 'wb') as f:
+        np.save(f, grid)
+    os.replace(tmp_filepath, filepath)
+
+    return filepath
+
+
+def load_ozone_grid(date, data_dir = "./data/"):
+    """
+    Returns the ozone grid for a given date as a read-only memory-mapped 180 x 360 int16 array.
+    If the binary grid does not exist yet it is created from the raw NASA file, which must already have been downloaded.
+    """
+
+    filepath = grid_filepath(date, data_dir = data_dir)
+    if exists(filepath):
+        instrumentation.count('ozone.grid_cache_hits')
+    else:
+        instrumentation.count('ozone.grid_cache_misses')
+        raw_filepath = _find_raw_filepath(date, data_dir = data_dir) or _raw_filepath(date, data_dir = data_dir)
+        save_ozone_grid(_parse_raw_ozone_file(raw_filepath), date, data_dir = data_dir)
+
+    with instrumentation.span('ozone.load_grid'):
+        return np.load(filepath, mmap_mode = 'r')
 
 
 def clean_ozone_data(date):
-    
-    # Find current datetime for UTC and subtract 1 day.
-    # We will retrieve the ozone data that was published yesterday.
-    # date = datetime.utcnow() - timedelta(days=1) 
-    raw_filepath = "./data/ozone_data_raw_" + str(date.year) + str(date.month) + str(date.day) + ".txt"
-    clean_filepath = "./data/ozone_data_clean_" + str(date.year) + str(date.month) + str(date.day) + ".txt"
-    
-    if exists(clean_filepath):
-        return pd.read_csv(clean_filepath, sep = ' ')
-    
-    else: 
-        # Read in ozone data
-        df_ozone = pd.read_csv(raw_filepath, skiprows=3, names = ["raw_values"])
+    """
+    Returns the ozone data for a given date as a dataframe with Latitude, Longitude and ozone_dobson_value columns.
+    The data is cached as a binary grid (see `load_ozone_grid`), so only the first call for each date parses the raw file.
+    """
+
+    import pandas as pd
+
+    grid = load_ozone_grid(date)
+
+    return pd.DataFrame({'Latitude': np.repeat(LATITUDES, 360),
+                         'Longitude': np.tile(LONGITUDES, 180),
+                         'ozone_dobson_value': np.asarray(grid).ravel()})
+
+
+def _raw_filepath(date, data_dir = "./data/"):
+    return os.path.join(data_dir, "ozone_data_raw_" + date.strftime("%Y%m%d") + ".txt")
+
+
+def _legacy_raw_filepath(date, data_dir = "./data/"):
+    # Raw files used to be named with an unpadded `str(year) + str(month) + str(day)` stamp, see `_legacy_dates`
+    return os.path.join(data_dir, "ozone_data_raw_" + str(date.year) + str(date.month) + str(date.day) + ".txt")
+
 
-        # Create a dataframe containing our latitude and longitude intervals
-        df_out = pd.DataFrame({'Latitude': np.repeat(np.linspace(-89.5, 89.5, 180), 360),
-                               'Longitude': np.linspace(-179.5, 179.5, 360).tolist() * 180})
+def _find_raw_filepath(date, data_dir = "./data/"):
+    """
+    Returns the path of the downloaded raw file for a date, or None if there is none. Files with a legacy name are only
+    used if the date in their header matches, since legacy names such as 2022111 are shared by two dates.
+    """
 
-        # Remove leading whitespace on each row
-        df_ozone['raw_values'] = df_ozone['raw_values'].str[1:]
+    filepath = _raw_filepath(date, data_dir = data_dir)
+    if exists(filepath):
+        return filepath
+
+    legacy_filepath = _legacy_raw_filepath(date, data_dir = data_dir)
+    if exists(legacy_filepath) and _raw_file_date(legacy_filepath) == datetime(date.year, date.month, date.day):
+        return legacy_filepath
+
+    return None
+
+
+def _parse_raw_ozone_file(raw_filepath):
+    """
+    Parses a raw NASA OMPS text file into a 180 x 360 grid of ozone values in Dobson units.
+    """
+
+    with instrumentation.span('ozone.parse'):
+        with open(raw_filepath, 'rb') as f:
+            raw = f.read()
+
+        instrumentation.count('ozone.files_parsed')
+        instrumentation.count('ozone.bytes_parsed', len(raw))
+        return parse_ozone_bytes(raw)
+
+
+def parse_ozone_bytes(raw):
+    """
+    Parses the contents of a raw NASA OMPS text file into a 180 x 360 int16 grid of ozone values in Dobson units.
+
+    After 3 header lines, each latitude band takes up 15 lines: 14 lines of 25 three-character values and a final line
+    of 10 values followed by a marker such as 'lat =  -89.5'. Every line starts with a single space. The values of all
+    bands are read at once by viewing the lines as a byte array and reshaping it into 3-character fields.
+
+    Parameters:
+        raw (bytes): the contents of the file
+
+    Returns:
+        grid (int16 array): the ozone values, with rows from latitude -89.5 to 89.5 and columns from longitude -179.5 to 179.5
+    """
+
+    lines = raw.splitlines()[3:]
+    while lines and not lines[-1].strip():
+        lines.pop()
+
+    n_bands, n_lines = OZONE_GRID_SHAPE[0], 15
+    if len(lines) != n_bands * n_lines:
+        raise Exception("Expected {} lines of ozone data but found {}.".format(n_bands * n_lines, len(lines)))
+
+    # Fixed-width byte array of every line, grouped by latitude band
+    chars = np.array(lines, dtype = 'S80').view(np.uint8).reshape(n_bands, n_lines, 80)
+
+    full_lines = chars[:, :14, 1:76].reshape(n_bands, -1)
+    last_lines = chars[:, 14, 1:31]
+    fields = np.concatenate([full_lines, last_lines], axis = 1).reshape(n_bands, 360, 3)
+
+    # Values are right-aligned and padded with spaces, so spaces count as 0
+    is_space = fields == ord(' ')
+    digits = fields.astype(np.int16) - ord('0')
+    if not np.all(is_space | ((digits >= 0) & (digits <= 9))):
+        raise Exception("Ozone data contains characters which are not digits.")
+
+    digits[is_space] = 0
+    grid = digits[..., 0] * 100 + digits[..., 1] * 10 + digits[..., 2]
+
+    # Each band must end with the latitude marker, in order from -89.5 to 89.5
+    markers = lines[n_lines - 1::n_lines]
+    try:
+        latitudes = np.array([float(marker[31:].split(b'=')[1]) for marker in markers])
+    except (IndexError, ValueError) as exc:
+        raise Exception("Ozone data has a malformed latitude marker.") from exc
+
+    if not np.allclose(latitudes, LATITUDES):
+        raise Exception("Ozone data latitude markers are not in the expected order.")
+
+    return grid.astype(OZONE_DTYPE)
+
+
+def backfill_ozone_grids(data_dir = "./data/", overwrite = False):
+    """
+    Converts every raw NASA file in `data_dir` into a binary ozone grid. The date of each file is read from its header.
+
+    Returns:
+        written (list): the paths of the binary grids that were written
+    """
+
+    written = []
+    for raw_filepath in sorted(glob.glob(os.path.join(data_dir, "ozone_data_raw_*.txt"))):
+        date = _raw_file_date(raw_filepath)
+        if date is None:
+            warnings.warn("Could not read the date from the header of {}, so it has been skipped.".format(raw_filepath))
+            continue
+
+        if overwrite or not exists(grid_filepath(date, data_dir = data_dir)):
+            written.append(save_ozone_grid(_parse_raw_ozone_file(raw_filepath), date, data_dir = data_dir))
+
+    return written
+
+
+def _legacy_dates(stamp):
+    """
+    Returns the dates which a legacy `str(year) + str(month) + str(day)` file stamp could refer to.
+    Stamps such as 2022111 are ambiguous (11 January or 1 November), so more than one date may be returned.
+    """
+
+    year, rest = int(stamp[:4]), stamp[4:]
+    dates = []
+    for split in range(1, len(rest)):
+        month, day = rest[:split], rest[split:]
+        if len(month) > 2 or len(day) > 2 or month.startswith('0') or day.startswith('0'):
+            continue
+        try:
+            dates.append(datetime(year, int(month), int(day)))
+        except ValueError:
+            continue
 
-        # Remove the word 'lat' and anything that comes after it
-        df_ozone['raw_values'] = df_ozone['raw_values'].str.split('lat').str[0]
+    return dates
 
-        # Remove trailing whitespace on each row
-        df_ozone['raw_values'] = df_ozone['raw_values'].str.rstrip(' ')
 
-        # Now we will separate our row entries into 3-digit long values using nested list comprehension.
-        # We then flatten our list using list comprehension.
-        two_d_list = [[row[n:(n+3)] for n in range(0, len(row), 3)] for row in df_ozone['raw_values']]
-        flatten_list = [ii for item in two_d_list for ii in item]
-        df_out['ozone_dobson_value'] = flatten_list
+def _raw_file_date(raw_filepath):
+    """
+    Reads the date from the header of a raw NASA OMPS text file, e.g. ' Day: 280 Oct  7, 2022 ...'
+    """
 
-        # Write output to a text file
-        df_out.to_csv(clean_filepath, header = True, sep = ' ', index = False)
+    try:
+        with open(raw_filepath, errors = 'replace') as f:
+            header = f.readline()
+    except OSError:
+        return None
 
-        return df_out
+    match = re.search(r'Day:\s*(\d+)\s+\w+\s+\d+\s*,?\s*(\d{4})', header)
+    if match is None:
+        return None
+
+    return datetime(int(match.group(2)), 1, 1) + timedelta(days = int(match.group(1)) - 1)
+
+
+def migrate_clean_csv_cache(data_dir = "./data/", remove = False):
+    """
+    One-shot migration of the old space-separated `ozone_data_clean_*.txt` cache files to binary ozone grids.
+    Ambiguous file names are resolved from the header of the matching raw file when it exists, otherwise they are skipped with a warning.
+
+    Parameters:
+        data_dir (str): the directory containing the cached files
+        remove (bool): whether to delete each CSV file once it has been migrated
+
+    Returns:
+        migrated (list): the paths of the binary grids that were written
+    """
+
+    import pandas as pd
+
+    migrated = []
+    for clean_filepath in sorted(glob.glob(os.path.join(data_dir, "ozone_data_clean_*.txt"))):
+        stamp = os.path.basename(clean_filepath)[len("ozone_data_clean_"):-len(".txt")]
+        dates = _legacy_dates(stamp)
+
+        if len(dates) > 1:
+            raw_filepath = os.path.join(data_dir, "ozone_data_raw_" + stamp + ".txt")
+            raw_date = _raw_file_date(raw_filepath) if exists(raw_filepath) else None
+            dates = [date for date in dates if date == raw_date]
+
+        if len(dates) != 1:
+            warnings.warn("Could not determine the date of {}, so it has not been migrated.".format(clean_filepath))
+            continue
+
+        df_ozone = pd.read_csv(clean_filepath, sep = ' ').sort_values(['Latitude', 'Longitude'])
+        grid = df_ozone['ozone_dobson_value'].to_numpy().astype(OZONE_DTYPE).reshape(OZONE_GRID_SHAPE)
+        migrated.append(save_ozone_grid(grid, dates[0], data_dir = data_dir))
+
+        if remove:
+            os.remove(clean_filepath)
+
+    return migrated
+
+
+def fill_grid_gaps(grid, max_iterations = 360):
+    """
+    Fills the missing (NaN) cells of a single day's grid in place, working inwards from the edges of each gap: every pass
+    sets each missing cell next to a valid cell to the mean of its valid neighbours. Longitude wraps around.
+    """
+
+    for _ in range(max_iterations):
+        missing = np.isnan(grid)
+        if not missing.any() or missing.all():
+            return
+
+        valid = ~missing
+        values = np.where(valid, grid, 0)
+
+        # pad the poles with empty rows, so that neighbours do not wrap from one pole to the other
+        padded_values = np.pad(values, ((1, 1), (0, 0)))
+        padded_valid = np.pad(valid, ((1, 1), (0, 0))).astype(np.int8)
+
+        total = np.zeros_like(values)
+        count = np.zeros(values.shape, dtype = np.int8)
+        for d_row in (-1, 0, 1):
+            rows = slice(1 + d_row, 1 + d_row + grid.shape[0])
+            for d_col in (-1, 0, 1):
+                if d_row == 0 and d_col == 0:
+                    continue
+                total += np.roll(padded_values[rows], d_col, axis = 1)
+                count += np.roll(padded_valid[rows], d_col, axis = 1)
+
+        fill = missing & (count > 0)
+        grid[fill] = total[fill] / count[fill]
+
+
+class OzoneGrid:
+    """
+    A day's ozone data held as a 180 x 360 array which is indexed directly from latitude and longitude,
+    rather than by searching a dataframe. Lookups accept scalars or arrays, which are broadcast against each other.
+
+    OMPS grids mark cells without a retrieval (e.g. the polar night) with 0. Unless `fill_gaps` is False, these are filled
+    from the neighbouring cells (see `fill_grid_gaps`), so they do not give a UV index of 0.
+    """
+
+    def __init__(self, values, date = None, fill_gaps = True):
+        values = np.asarray(values)
+        if values.shape != OZONE_GRID_SHAPE:
+            raise Exception("Ozone grid must have shape {}, got {}.".format(OZONE_GRID_SHAPE, values.shape))
+
+        if fill_gaps:
+            missing = values <= 0
+            if missing.any():
+                if missing.all():
+                    raise Exception("The ozone grid{} has no data.".format("" if date is None else " for " + date.strftime("%Y-%m-%d")))
+
+                values = np.where(missing, np.nan, values).astype(np.float32)
+                fill_grid_gaps(values)
+                instrumentation.count('ozone.cells_filled', int(missing.sum()))
+
+        self.values = values
+        self.date = date
+
+    @classmethod
+    def load(cls, date, data_dir = "./data/"):
+        """
+        Returns the memory-mapped ozone grid for a given date (see `load_ozone_grid`).
+        """
+
+        return cls(load_ozone_grid(date, data_dir = data_dir), date = date)
+
+    @staticmethod
+    def indices(lat, long):
+        """
+        Returns the row and column indices of the grid cells containing the given coordinates.
+        """
+
+        rows = np.clip(np.floor(np.asarray(lat, dtype = float)).astype(np.int64) + 90, 0, 179)
+        cols = (np.floor(np.asarray(long, dtype = float)).astype(np.int64) + 180) % 360
+
+        return rows, cols
+
+    def thickness(self, lat, long, interpolate = False):
+        """
+        Returns the ozone thickness in Dobson units at the given coordinates.
+
+        Parameters:
+            lat (float or array-like): latitude coordinates
+            long (float or array-like): longitude coordinates
+            interpolate (bool): whether to bilinearly interpolate between cell centres instead of taking the containing cell
+
+        Returns:
+            thickness (int/float or array): an int per location, or a float per location when interpolating or when the grid's gaps were filled
+        """
+
+        if interpolate:
+            thickness = self._bilinear(lat, long)
+        else:
+            rows, cols = self.indices(lat, long)
+            thickness = self.values[rows, cols]
+
+        if np.ndim(thickness) == 0:
+            return thickness.item()
+
+        return thickness
+
+    @staticmethod
+    def bilinear_indices(lat, long):
+        """
+        Returns the rows and columns of the cell centres surrounding the given coordinates (`row0`, `row0 + 1`, `col0`
+        and `col1`) and the fractional distances `dy` and `dx` from the first centre, for bilinear interpolation.
+        Latitude is clamped at the poles and longitude wraps around.
+        """
+
+        y = np.clip(np.asarray(lat, dtype = float) + 89.5, 0, 179)
+        x = np.mod(np.asarray(long, dtype = float) + 179.5, 360)
+
+        row0 = np.minimum(np.floor(y).astype(np.int64), 178)
+        col0 = np.floor(x).astype(np.int64) % 360
+        col1 = (col0 + 1) % 360
+
+        return row0, col0, col1, y - row0, x - np.floor(x)
+
+    def _bilinear(self, lat, long):
+        row0, col0, col1, dy, dx = self.bilinear_indices(lat, long)
+
+        values = self.values
+        bottom = values[row0, col0] * (1 - dx) + values[row0, col1] * dx
+        top = values[row0 + 1, col0] * (1 - dx) + values[row0 + 1, col1] * dx
+
+        return bottom * (1 - dy) + top * dy
+
+
+def grid_stamp(date, data_dir = "./data/"):
+    """
+    Returns a string identifying the grid file that `get_ozone_grid` would use for a date: the date of the file (the
+    most recent published day for later dates) and its modification time, or 0 if it does not exist yet. The stamp
+    changes whenever the file is replaced or NASA publishes the day, so in-memory copies can be checked against it.
+    """
+
+    date = datetime(date.year, date.month, date.day)
+    latest = datetime.utcnow() - timedelta(days = 3)
+    date = min(date, datetime(latest.year, latest.month, latest.day))
+
+    try:
+        modified = os.stat(grid_filepath(date, data_dir = data_dir)).st_mtime_ns
+    except OSError:
+        modified = 0
+
+    return date.strftime("%Y%m%d") + ":" + str(modified)
+
+
+def get_ozone_grid(date, data_dir = "./data/"):
+    """
+    Returns the `OzoneGrid` for a date, downloading and parsing the raw NASA file first if needed.
+    NASA takes 2 days to release ozone data, so the most recent ozone data is used for later dates.
+    """
+
+    date = datetime(date.year, date.month, date.day)
+    latest = datetime.utcnow() - timedelta(days = 3)
+    if date > latest:
+        warnings.warn("NASA takes 2 days to release ozone data so the most recent ozone data is being used.")
+        date = datetime(latest.year, latest.month, latest.day)
+
+    if not exists(grid_filepath(date, data_dir = data_dir)):
+        from .ozone_archive import get_archive
+
+        get_archive(data_dir).download(date)
+
+    return OzoneGrid.load(date, data_dir = data_dir)
 
 
 def get_ozone_thickness(df_ozone, lat, long):
+    """
+    Returns the ozone thickness in Dobson units at a location. `df_ozone` can be an `OzoneGrid`, a grid returned by
+    `load_ozone_grid` or a dataframe returned by `clean_ozone_data`.
+    """
+
+    if isinstance(df_ozone, OzoneGrid):
+        return df_ozone.thickness(lat, long)
+
+    if isinstance(df_ozone, np.ndarray):
+        return OzoneGrid(df_ozone).thickness(lat, long)
+
     lat_rounded = math.floor(lat) + 0.5
     long_rounded = math.floor(long) + 0.5
     
-    return int(df_ozone.loc[(df_ozone['Latitude'] == lat_rounded) & (df_ozone['Longitude'] == long_rounded)]['ozone_dobson_value'])
\ No newline at end of file
+    # the dataframe is scanned row by row, so this is much slower than indexing a grid
+    with instrumentation.span('ozone.dataframe_scan'):
+        instrumentation.count('ozone.rows_scanned', len(df_ozone))
+        return int(df_ozone.loc[(df_ozone['Latitude'] == lat_rounded) & (df_ozone['Longitude'] == long_rounded)]['ozone_dobson_value'].iloc[0])
+
+
+if __name__ == "__main__":
+    for filepath in migrate_clean_csv_cache():
+        print(filepath)
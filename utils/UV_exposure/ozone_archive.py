@@ -0,0 +1,246 @@
+import json
+import os
+import requests
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+
+from . import instrumentation
+from . import ozone
+
+
+OZONE_BASE_URL = "https://ozonewatch.gsfc.nasa.gov/data/omps/"
+
+
+class OzoneArchive:
+    """
+    Downloads raw NASA OMPS ozone files into a local mirror. The index page of each year is fetched once and cached,
+    files are downloaded concurrently over a shared connection pool, and every file is written atomically. Partial
+    downloads are resumed and a manifest records completed days so that re-runs skip them.
+
+    `base_url` can point at any server with the same layout (a `Y<year>/` index page linking to the daily files),
+    such as a local HTTP server used in tests. NASA adds each day to its year's index as it is released, so a cached
+    index which is missing a date is fetched again if it is older than `index_refresh` seconds.
+    """
+
+    def __init__(self, data_dir = "./data/", base_url = OZONE_BASE_URL, max_workers = 8, retries = 3, backoff = 1.0, timeout = 60, session = None,
+                 index_refresh = 600):
+        self.data_dir = data_dir
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.index_refresh = index_refresh
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = max_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+        self.manifest_path = os.path.join(data_dir, "ozone_manifest.json")
+        self._year_indexes = {}
+        self._date_locks = {}
+        self._lock = threading.Lock()
+        self._manifest = self._read_manifest()
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _record(self, date, filepath, url):
+        with self._lock:
+            self._manifest[date.strftime("%Y-%m-%d")] = {'file': os.path.basename(filepath), 'bytes': os.path.getsize(filepath), 'url': url}
+            _write_atomic(self.manifest_path, json.dumps(self._manifest, indent = 1, sort_keys = True).encode())
+
+    def is_complete(self, date):
+        """
+        Returns whether the file for a date has already been downloaded.
+        """
+
+        entry = self._manifest.get(date.strftime("%Y-%m-%d"))
+        filepath = ozone._find_raw_filepath(date, data_dir = self.data_dir)
+        if filepath is None:
+            return False
+
+        if entry is not None and entry['file'] == os.path.basename(filepath):
+            return os.path.getsize(filepath) == entry['bytes']
+
+        # Files downloaded before the manifest existed may be truncated, so they are only trusted if they parse
+        try:
+            ozone._parse_raw_ozone_file(filepath)
+        except Exception:
+            return False
+
+        self._record(date, filepath, url = None)
+        return True
+
+    def _get(self, url):
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.get(url, timeout = self.timeout)
+            except requests.RequestException:
+                if attempt == self.retries:
+                    raise
+            else:
+                # Only server errors are worth retrying
+                if response.status_code < 500 or attempt == self.retries:
+                    response.raise_for_status()
+                    return response
+
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def year_index(self, year, refresh = False):
+        """
+        Returns the links on the index page for a year, keyed by the date suffix in each file name (e.g. '2022m0601').
+        Each year's page is only fetched once per archive, unless `refresh` is set.
+        """
+
+        with self._lock:
+            if year in self._year_indexes and not refresh:
+                return self._year_indexes[year][1]
+
+        url = self.base_url + "Y" + str(year) + "/"
+        with instrumentation.span('ozone_archive.year_index'):
+            response = self._get(url)
+        instrumentation.count('ozone_archive.index_pages_fetched')
+
+        from bs4 import BeautifulSoup
+
+        index = {}
+        for link in BeautifulSoup(response.text, 'html.parser').find_all('a'):
+            href = link.get('href') or ''
+            position = href.find(str(year) + 'm')
+            if position >= 0 and href.endswith('.txt'):
+                index[href[position:position + 9]] = url + href
+
+        with self._lock:
+            self._year_indexes[year] = (time.monotonic(), index)
+
+        return index
+
+    def file_url(self, date):
+        # Combine year, month and day into a format that we expect to be in the relevant text file link
+        date_suffix = '{:04d}'.format(date.year) + 'm' + '{:02d}'.format(date.month) + '{:02d}'.format(date.day)
+
+        index = self.year_index(date.year)
+        if date_suffix not in index:
+            # the day may have been released since the index was fetched
+            with self._lock:
+                fetched = self._year_indexes[date.year][0]
+            if time.monotonic() - fetched >= self.index_refresh:
+                index = self.year_index(date.year, refresh = True)
+
+        try:
+            return index[date_suffix]
+        except KeyError:
+            raise Exception("Cannot get ozone data for {}. Try an earlier date. Note that NASA take 2 days to release ozone data.".format(date.strftime("%Y-%m-%d")))
+
+    def _date_lock(self, date):
+        with self._lock:
+            return self._date_locks.setdefault(date.strftime("%Y-%m-%d"), threading.Lock())
+
+    def download(self, date):
+        """
+        Downloads the raw ozone file for a date unless it is already complete, and returns its path.
+        Concurrent calls for the same date wait for the first one rather than sharing its partial file.
+        """
+
+        with self._date_lock(date):
+            return self._download(date)
+
+    def _download(self, date):
+        if self.is_complete(date):
+            instrumentation.count('ozone_archive.cache_hits')
+            return ozone._find_raw_filepath(date, data_dir = self.data_dir)
+
+        filepath = ozone._raw_filepath(date, data_dir = self.data_dir)
+
+        instrumentation.count('ozone_archive.cache_misses')
+
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir, exist_ok = True)
+
+        url = self.file_url(date)
+        part_filepath = filepath + ".part"
+
+        for attempt in range(self.retries + 1):
+            # Resume from the end of any partial download
+            offset = os.path.getsize(part_filepath) if os.path.exists(part_filepath) else 0
+            headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+
+            try:
+                response = self.session.get(url, headers = headers, stream = True, timeout = self.timeout)
+                response.raise_for_status()
+
+                mode = 'ab' if offset and response.status_code == 206 else 'wb'
+                with instrumentation.span('ozone_archive.download'), open(part_filepath, mode) as f:
+                    for chunk in response.iter_content(chunk_size = 1 << 16):
+                        f.write(chunk)
+                        instrumentation.count('ozone_archive.bytes_downloaded', len(chunk))
+                break
+            except requests.RequestException as exc:
+                client_error = exc.response is not None and exc.response.status_code < 500
+                if client_error or attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+        os.replace(part_filepath, filepath)
+        self._record(date, filepath, url)
+        instrumentation.count('ozone_archive.files_downloaded')
+
+        return filepath
+
+    def download_range(self, start, end):
+        """
+        Downloads the raw ozone files for every day from `start` to `end` (inclusive) using a bounded thread pool.
+
+        Returns:
+            results (dict): the file path for each date, or the exception raised while downloading it
+        """
+
+        start = datetime(start.year, start.month, start.day)
+        end = datetime(end.year, end.month, end.day)
+        dates = [start + timedelta(days = ii) for ii in range((end - start).days + 1)]
+
+        # Fetch each year's index up front so that the workers share it
+        for year in sorted({date.year for date in dates}):
+            self.year_index(year)
+
+        def download(date):
+            try:
+                return self.download(date)
+            except Exception as exc:
+                return exc
+
+        with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+            return dict(zip(dates, executor.map(download, dates)))
+
+
+def _write_atomic(filepath, content):
+    tmp_filepath = filepath + ".tmp"
+    with open(tmp_filepath, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_filepath, filepath)
+
+
+_archives = {}
+
+
+def get_archive(data_dir = "./data/"):
+    """
+    Returns a shared `OzoneArchive` for a data directory, so that year indexes and connections are reused between calls.
+    """
+
+    if data_dir not in _archives:
+        _archives[data_dir] = OzoneArchive(data_dir = data_dir)
+
+    return _archives[data_dir]
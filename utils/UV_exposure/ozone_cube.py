@@ -0,0 +1,277 @@
+import numpy as np
+import os
+import threading
+import warnings
+
+from datetime import datetime, timedelta
+
+from . import instrumentation
+from . import ozone
+
+
+CUBE_DTYPE = np.float32
+
+
+def cube_filepath(start, end, data_dir = "./data/"):
+    """
+    Returns the path of the ozone cube covering the days from `start` to `end` (inclusive).
+    """
+
+    return os.path.join(data_dir, "ozone_cube_" + start.strftime("%Y%m%d") + "_" + end.strftime("%Y%m%d") + ".npy")
+
+
+def fill_ozone_gaps(values, max_gap_days = 3):
+    """
+    Fills the missing (NaN) cells of a day x lat x lon ozone array in place.
+
+    1. Cells missing for at most `max_gap_days` days are interpolated linearly in time between the nearest valid days
+       (or copied from the nearest valid day at the ends of the window).
+    2. The remaining gaps in each day, e.g. the polar night, are filled from the neighbouring cells.
+    3. Days with no data at all are copied from the nearest day with data.
+
+    Returns:
+        filled (int): the number of cells that were filled
+    """
+
+    n_days = values.shape[0]
+    missing = np.isnan(values)
+    n_missing = int(missing.sum())
+    if n_missing == 0:
+        return 0
+
+    if missing.all():
+        raise Exception("The ozone cube has no data to fill its gaps from.")
+
+    # index of the previous and next valid day for every cell
+    days = np.arange(n_days, dtype = np.int16)[:, None, None]
+    previous = np.maximum.accumulate(np.where(missing, np.int16(-1), days), axis = 0)
+    following = np.minimum.accumulate(np.where(missing, np.int16(n_days), days)[::-1], axis = 0)[::-1]
+
+    # only the missing cells are interpolated, so the temporary arrays stay small
+    day, row, col = np.nonzero(missing)
+    previous, following = previous[day, row, col].astype(np.int64), following[day, row, col].astype(np.int64)
+    has_previous = (previous >= 0) & (day - previous <= max_gap_days)
+    has_following = (following < n_days) & (following - day <= max_gap_days)
+
+    previous_values = values[np.clip(previous, 0, n_days - 1), row, col]
+    following_values = values[np.clip(following, 0, n_days - 1), row, col]
+    weight = (day - previous) / np.maximum(following - previous, 1)
+
+    values[day, row, col] = np.where(has_previous & has_following, previous_values * (1 - weight) + following_values * weight,
+                                     np.where(has_previous, previous_values, np.where(has_following, following_values, np.nan)))
+
+    for ii in range(n_days):
+        ozone.fill_grid_gaps(values[ii])
+
+    # whole days without data
+    empty = np.isnan(values).all(axis = (1, 2))
+    if empty.any():
+        full = np.flatnonzero(~empty)
+        for ii in np.flatnonzero(empty):
+            values[ii] = values[full[np.argmin(np.abs(full - ii))]]
+
+    instrumentation.count('ozone_cube.cells_filled', n_missing)
+
+    return n_missing
+
+
+def cube_is_stale(start, end, data_dir = "./data/"):
+    """
+    Returns whether the cube for the days from `start` to `end` is missing, or older than any of the daily grids it was
+    built from, e.g. because a day which was filled in has since been downloaded or a grid has been re-parsed.
+    """
+
+    try:
+        built = os.stat(cube_filepath(start, end, data_dir = data_dir)).st_mtime_ns
+    except OSError:
+        return True
+
+    start = datetime(start.year, start.month, start.day)
+    for ii in range((end - start).days + 1):
+        try:
+            if os.stat(ozone.grid_filepath(start + timedelta(days = ii), data_dir = data_dir)).st_mtime_ns > built:
+                return True
+        except OSError:
+            continue
+
+    return False
+
+
+def build_ozone_cube(start, end, data_dir = "./data/", download = True, max_gap_days = 3):
+    """
+    Stacks the daily ozone grids from `start` to `end` (inclusive) into a single day x lat x lon float32 .npy file,
+    with zero-valued (missing) cells and unavailable days filled in by `fill_ozone_gaps`. The cube is written straight
+    to a memory-mapped file, so long windows do not have to fit in memory twice.
+
+    Parameters:
+        start (datetime): the first day
+        end (datetime): the last day
+        data_dir (str): the directory holding the raw files and grids, where the cube is also written
+        download (bool): whether to download raw files which are not in `data_dir` yet
+        max_gap_days (int): the longest gap in a cell's data which is interpolated in time
+
+    Returns:
+        filepath (str): the path of the cube
+    """
+
+    start = datetime(start.year, start.month, start.day)
+    end = datetime(end.year, end.month, end.day)
+    dates = [start + timedelta(days = ii) for ii in range((end - start).days + 1)]
+    if not dates:
+        raise Exception("The end of an ozone cube cannot be before its start.")
+
+    if download and any(not os.path.exists(ozone.grid_filepath(date, data_dir = data_dir)) for date in dates):
+        from .ozone_archive import get_archive
+
+        get_archive(data_dir).download_range(start, end)
+
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    filepath = cube_filepath(start, end, data_dir = data_dir)
+    tmp_filepath = "{}.{}.{}.tmp".format(filepath, os.getpid(), threading.get_ident())
+
+    with instrumentation.span('ozone_cube.build'):
+        values = np.lib.format.open_memmap(tmp_filepath, mode = 'w+', dtype = CUBE_DTYPE, shape = (len(dates),) + ozone.OZONE_GRID_SHAPE)
+        for ii, date in enumerate(dates):
+            try:
+                grid = ozone.load_ozone_grid(date, data_dir = data_dir)
+            except Exception as exc:
+                warnings.warn("No ozone data for {} ({}), so it will be filled from the neighbouring days.".format(date.strftime("%Y-%m-%d"), exc))
+                values[ii] = np.nan
+                continue
+
+            # OMPS grids mark missing cells with 0
+            values[ii] = np.where(grid > 0, grid, np.nan)
+
+        fill_ozone_gaps(values, max_gap_days = max_gap_days)
+        values.flush()
+        del values
+
+    os.replace(tmp_filepath, filepath)
+
+    return filepath
+
+
+class OzoneCube:
+    """
+    A window of consecutive days of ozone data held as one memory-mapped day x lat x lon array, with gaps filled.
+    Lookups at arbitrary (time, lat, long) are vectorised and interpolate linearly between days, with each day's value
+    taken to apply at noon UTC.
+
+    `grid(date)` returns an `ozone.OzoneGrid` for a single day and `tot_ozone(lat, long)` returns a function of UTC times,
+    so a cube can be passed as `ozone_for_day` or `tot_ozone` wherever the per-day grids are used, e.g.
+    `dose.dose_batch(jobs, ozone_for_day = cube.grid)`.
+    """
+
+    def __init__(self, values, start):
+        values = np.asarray(values)
+        if values.ndim != 3 or values.shape[1:] != ozone.OZONE_GRID_SHAPE:
+            raise Exception("Ozone cube must have shape (days,) + {}, got {}.".format(ozone.OZONE_GRID_SHAPE, values.shape))
+
+        self.values = values
+        self.start = datetime(start.year, start.month, start.day)
+
+    @classmethod
+    def load(cls, start, end, data_dir = "./data/", download = True):
+        """
+        Returns the cube for the days from `start` to `end`, building it first if it does not exist or is older than
+        any of its daily grids (see `build_ozone_cube`).
+        """
+
+        filepath = cube_filepath(start, end, data_dir = data_dir)
+        if cube_is_stale(start, end, data_dir = data_dir):
+            build_ozone_cube(start, end, data_dir = data_dir, download = download)
+
+        return cls(np.load(filepath, mmap_mode = 'r'), start)
+
+    @property
+    def end(self):
+        return self.start + timedelta(days = self.values.shape[0] - 1)
+
+    def _day_index(self, date):
+        index = (datetime(date.year, date.month, date.day) - self.start).days
+        if not 0 <= index < self.values.shape[0]:
+            warnings.warn("{} is outside the ozone cube, so the nearest day is being used.".format(date.strftime("%Y-%m-%d")))
+
+        return min(max(index, 0), self.values.shape[0] - 1)
+
+    def grid(self, date):
+        """
+        Returns the gap-filled `ozone.OzoneGrid` for a date.
+        """
+
+        return ozone.OzoneGrid(self.values[self._day_index(date)], date = date)
+
+    def thickness(self, utc_time, lat, long, interpolate = False):
+        """
+        Returns the ozone thickness in Dobson units at the given times and coordinates, interpolated linearly between days.
+        Times outside the cube use its first or last day.
+
+        Parameters:
+            utc_time (datetime/datetime64 or array): UTC times
+            lat (float or array-like): latitude coordinates
+            long (float or array-like): longitude coordinates
+            interpolate (bool): whether to also interpolate bilinearly between cell centres
+
+        Returns:
+            thickness (float or array): the ozone thickness, with the arguments broadcast against each other
+        """
+
+        from .incident_UV import _as_datetime64
+
+        utc_time = _as_datetime64(utc_time)
+        n_days = self.values.shape[0]
+
+        position = (utc_time - np.datetime64(self.start, 'us')) / np.timedelta64(1, 'D') - 0.5
+        if np.any((position < -0.5) | (position > n_days - 0.5)):
+            warnings.warn("Some times are outside the ozone cube, so the nearest day is being used.")
+
+        position = np.clip(position, 0, n_days - 1)
+        day0 = np.minimum(np.floor(position).astype(np.int64), max(n_days - 2, 0))
+        day1 = np.minimum(day0 + 1, n_days - 1)
+        weight = position - day0
+
+        if interpolate:
+            row0, col0, col1, dy, dx = ozone.OzoneGrid.bilinear_indices(lat, long)
+
+            def at(day):
+                bottom = self.values[day, row0, col0] * (1 - dx) + self.values[day, row0, col1] * dx
+                top = self.values[day, row0 + 1, col0] * (1 - dx) + self.values[day, row0 + 1, col1] * dx
+                return bottom * (1 - dy) + top * dy
+        else:
+            rows, cols = ozone.OzoneGrid.indices(lat, long)
+
+            def at(day):
+                return self.values[day, rows, cols]
+
+        thickness = at(day0) * (1 - weight) + at(day1) * weight
+
+        if np.ndim(thickness) == 0:
+            return float(thickness)
+
+        return thickness
+
+    def tot_ozone(self, lat, long, interpolate = False):
+        """
+        Returns a function which maps UTC times to the ozone thickness at a location, for use as the `tot_ozone`
+        argument of `dose.integrate_dose` or `stream.stream_uvi`.
+        """
+
+        return lambda times: self.thickness(times, lat, long, interpolate = interpolate)
+
+
+def get_ozone_cube(end = None, days = 31, data_dir = "./data/", download = True):
+    """
+    Returns a rolling window of `days` days of ozone data ending at `end`. By default the window ends at the most recent
+    day NASA has released (3 days ago).
+    """
+
+    latest = datetime.utcnow() - timedelta(days = 3)
+    if end is None or end > latest:
+        end = latest
+
+    end = datetime(end.year, end.month, end.day)
+    start = end - timedelta(days = days - 1)
+
+    return OzoneCube.load(start, end, data_dir = data_dir, download = download)
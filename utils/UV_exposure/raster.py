@@ -0,0 +1,180 @@
+import argparse
+import numpy as np
+import os
+
+from datetime import datetime
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
+from . import incident_UV
+from . import ozone
+
+
+# Set in each worker process by `_init_worker`
+_worker = {}
+
+
+def raster_axes(resolution = 1.0):
+    """
+    Returns the latitude and longitude cell centres of a global raster with the given resolution in degrees.
+    """
+
+    n_lat, n_long = int(round(180 / resolution)), int(round(360 / resolution))
+
+    return -90 + resolution * (np.arange(n_lat) + 0.5), -180 + resolution * (np.arange(n_long) + 0.5)
+
+
+def _share(array):
+    shm = SharedMemory(create = True, size = max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype = array.dtype, buffer = shm.buf)[...] = array
+
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _attach(spec):
+    name, shape, dtype = spec
+    shm = SharedMemory(name = name)
+
+    return shm, np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+
+
+def _init_worker(ozone_spec, cmf_spec, times, resolution, interpolate, out_path, cmf_out_path):
+    ozone_shm, ozone_values = _attach(ozone_spec)
+    _worker['shm'] = [ozone_shm]
+    # the gaps were already filled before the grid was shared
+    _worker['ozone'] = ozone.OzoneGrid(ozone_values, fill_gaps = False)
+
+    _worker['cmf'] = None
+    if cmf_spec is not None:
+        cmf_shm, _worker['cmf'] = _attach(cmf_spec)
+        _worker['shm'].append(cmf_shm)
+
+    _worker.update(times = times, resolution = resolution, interpolate = interpolate, out_path = out_path, cmf_out_path = cmf_out_path)
+
+
+def _render_tile(rows):
+    """
+    Computes the clear-sky UVI of every time step for the latitude rows [row0, row1) and writes it into the output cube.
+    """
+
+    row0, row1 = rows
+    lats, longs = raster_axes(_worker['resolution'])
+    lats = lats[row0:row1]
+    times = _worker['times']
+
+    lat_grid, long_grid = np.meshgrid(lats, longs, indexing = 'ij')
+    tot_ozone = _worker['ozone'].thickness(lat_grid, long_grid, interpolate = _worker['interpolate'])
+
+    uvi = incident_UV.clear_sky_UVI_at(
+        lat = lat_grid[None, :, :],
+        long = long_grid[None, :, :],
+        utc_time = times[:, None, None],
+        tot_ozone = tot_ozone[None, :, :]
+    ).astype(np.float32)
+
+    out = np.load(_worker['out_path'], mmap_mode = 'r+')
+    out[:, row0:row1, :] = uvi
+    out.flush()
+
+    if _worker['cmf'] is not None:
+        cmf = _worker['cmf']
+        cmf_tile = cmf[row0:row1] if cmf.ndim == 2 else cmf[:, row0:row1]
+        cmf_out = np.load(_worker['cmf_out_path'], mmap_mode = 'r+')
+        cmf_out[:, row0:row1, :] = uvi * cmf_tile
+        cmf_out.flush()
+
+    return row1 - row0
+
+
+def generate_uvi_raster(times, ozone_grid, out_path, resolution = 1.0, tile_rows = 10, processes = None, cmf = None, cmf_out_path = None, interpolate = False):
+    """
+    Generates a global clear-sky UV index raster for each of the given UTC times.
+
+    The globe is split into tiles of `tile_rows` latitude rows, which are processed in a pool of worker processes.
+    The ozone grid (and the cloud modification factors, if given) are placed in shared memory rather than copied to
+    every worker, and each worker writes its tiles straight into the memory-mapped output cube.
+
+    Parameters:
+        times (datetime64 array-like): the UTC times
+        ozone_grid (OzoneGrid or array): the day's 180 x 360 ozone grid
+        out_path (str): path of the .npy file holding the float32 time x lat x lon cube of clear-sky UVI
+        resolution (float): the raster cell size in degrees. Finer rasters take the ozone of the containing cell, or interpolate.
+        tile_rows (int): the number of latitude rows in each tile
+        processes (int): the number of worker processes. Defaults to the number of CPUs; 1 renders in this process.
+        cmf (array): optional cloud modification factors of shape lat x lon or time x lat x lon
+        cmf_out_path (str): path of the .npy file holding the CMF-adjusted UVI cube, required when `cmf` is given
+        interpolate (bool): whether to bilinearly interpolate the ozone grid
+
+    Returns:
+        uvi (memmap): the clear-sky UVI cube, opened read-only
+    """
+
+    times = np.atleast_1d(incident_UV._as_datetime64(times))
+    lats, longs = raster_axes(resolution)
+    shape = (len(times), len(lats), len(longs))
+
+    if not isinstance(ozone_grid, ozone.OzoneGrid):
+        ozone_grid = ozone.OzoneGrid(ozone_grid)
+    values = np.ascontiguousarray(ozone_grid.values)
+
+    if cmf is not None:
+        cmf = np.ascontiguousarray(cmf, dtype = np.float32)
+        if cmf.shape not in (shape[1:], shape) or cmf_out_path is None:
+            raise Exception("cmf must have shape {} or {} and cmf_out_path must be given.".format(shape[1:], shape))
+
+    for path in (out_path, cmf_out_path if cmf is not None else None):
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            np.lib.format.open_memmap(path, mode = 'w+', dtype = np.float32, shape = shape).flush()
+
+    tiles = [(row0, min(row0 + tile_rows, len(lats))) for row0 in range(0, len(lats), tile_rows)]
+
+    shared = []
+    try:
+        ozone_shm, ozone_spec = _share(values)
+        shared.append(ozone_shm)
+
+        cmf_spec = None
+        if cmf is not None:
+            cmf_shm, cmf_spec = _share(cmf)
+            shared.append(cmf_shm)
+
+        init_args = (ozone_spec, cmf_spec, times, resolution, interpolate, out_path, cmf_out_path)
+        processes = processes or os.cpu_count()
+
+        if processes == 1:
+            _init_worker(*init_args)
+            for tile in tiles:
+                _render_tile(tile)
+            worker_shm = _worker.pop('shm')
+            _worker.clear()
+            for shm in worker_shm:
+                shm.close()
+        else:
+            with get_context().Pool(processes, initializer = _init_worker, initargs = init_args) as pool:
+                for _ in pool.imap_unordered(_render_tile, tiles):
+                    pass
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+
+    return np.load(out_path, mmap_mode = 'r')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Generate an hourly global clear-sky UV index raster for one UTC day.")
+    parser.add_argument("-date", "--date", help = "The UTC date, in the format yyyy-mm-dd.", type = str, required = True)
+    parser.add_argument("-res", "--resolution", help = "The raster cell size in degrees.", type = float, default = 1.0)
+    parser.add_argument("-p", "--processes", help = "The number of worker processes.", type = int, default = None)
+    parser.add_argument("-o", "--output", help = "The output .npy path.", type = str, default = None)
+    args = parser.parse_args()
+
+    date = datetime.strptime(args.date, '%Y-%m-%d')
+    times = np.datetime64(date, 'h') + np.arange(24)
+    out_path = args.output or "./output/uvi_raster_" + date.strftime("%Y%m%d") + ".npy"
+
+    generate_uvi_raster(times, ozone.get_ozone_grid(date), out_path, resolution = args.resolution, processes = args.processes)
+    print(out_path)
@@ -0,0 +1,324 @@
+import json
+import numpy as np
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+
+from . import dose
+from . import incident_UV
+from . import instrumentation
+from . import ozone
+
+
+class ResultCache:
+    """
+    Memoizes clear-sky UVI and dose results in a bounded in-memory LRU, with an optional on-disk SQLite tier that
+    persists between runs.
+
+    Queries are quantized before they are looked up and computed: latitude and longitude are rounded to `precision`
+    decimal places and times to the nearest `time_resolution` seconds, so that queries which differ by less than that
+    share an entry. Each entry records the ozone grid files it was computed from (see `ozone_stamp`), and is recomputed
+    once a newer file is available, e.g. when NASA publishes the day that recent queries had to approximate.
+    """
+
+    def __init__(self, max_entries = 4096, path = None, precision = 2, time_resolution = 60, data_dir = "./data/"):
+        self.max_entries = max_entries
+        self.path = path
+        self.precision = precision
+        self.time_resolution = time_resolution
+        self.data_dir = data_dir
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+
+        self._db = None
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+
+            self._db = sqlite3.connect(path, check_same_thread = False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, stamp TEXT, value TEXT, updated REAL)")
+            self._db.commit()
+
+    #------ quantization ------#
+
+    def quantize_coordinates(self, lat, long):
+        return np.round(np.asarray(lat, dtype = float), self.precision), np.round(np.asarray(long, dtype = float), self.precision)
+
+    def quantize_times(self, utc_time):
+        resolution = np.timedelta64(int(self.time_resolution * 1e6), 'us')
+        utc_time = incident_UV._as_datetime64(utc_time)
+        offset = utc_time - np.datetime64(0, 'us')
+
+        return np.datetime64(0, 'us') + (offset + resolution // 2) // resolution * resolution
+
+    def ozone_stamp(self, days, day_stamps = None):
+        """
+        Returns a string identifying the ozone grid files used for a set of UTC days (see `ozone.grid_stamp`).
+        `day_stamps` is an optional dict of the stamps already found for single days, which is filled in as it goes,
+        so that a batch only checks each day's file once.
+        """
+
+        day_stamps = {} if day_stamps is None else day_stamps
+        days = sorted(set(np.asarray(days, dtype = 'datetime64[D]').ravel().tolist()))
+
+        parts = []
+        for day in days:
+            if day not in day_stamps:
+                day_stamps[day] = ozone.grid_stamp(day, data_dir = self.data_dir)
+            parts.append(day_stamps[day])
+
+        return "|".join(parts)
+
+    #------ storage ------#
+
+    @staticmethod
+    def _text_key(key):
+        # UVI queries are keyed in memory by (lat, long, microseconds since the epoch) tuples, which are much cheaper
+        # to build than strings; the text form is only needed for the SQLite tier
+        if isinstance(key, tuple):
+            return "uvi|{}|{}|{}".format(key[0], key[1], np.datetime64(key[2], 'us'))
+
+        return key
+
+    def _get(self, key, stamp):
+        return self._get_many([key], [stamp])[0]
+
+    def _get_many(self, keys, stamps):
+        """
+        Looks up many keys under a single lock, reading the ones not held in memory from SQLite in bulk. Entries whose
+        stamp does not match are dropped.
+
+        Returns:
+            results (list): a (found, value) tuple for each key
+        """
+
+        results = [(False, None)] * len(keys)
+        hits = disk_hits = invalidations = 0
+
+        with self._lock:
+            on_disk, stale_in_memory = {}, set()
+            for ii, (key, stamp) in enumerate(zip(keys, stamps)):
+                entry = self._memory.get(key)
+                if entry is not None and entry[0] == stamp:
+                    self._memory.move_to_end(key)
+                    results[ii] = (True, entry[1])
+                    hits += 1
+                    continue
+
+                if entry is not None:
+                    del self._memory[key]
+                    stale_in_memory.add(key)
+                    invalidations += 1
+                on_disk.setdefault(key, []).append(ii)
+
+            text_keys = {self._text_key(key): key for key in on_disk} if self._db is not None else {}
+
+            if self._db is not None and on_disk:
+                stale = []
+                missing = list(text_keys)
+                for first in range(0, len(missing), 500):
+                    chunk = missing[first:first + 500]
+                    rows = self._db.execute("SELECT key, stamp, value FROM results WHERE key IN ({})".format(", ".join("?" * len(chunk))), chunk).fetchall()
+                    for text_key, stamp, value in rows:
+                        key = text_keys[text_key]
+                        indices = on_disk[key]
+                        if stamp != stamps[indices[0]]:
+                            stale.append((text_key,))
+                            if key not in stale_in_memory:
+                                invalidations += 1
+                            continue
+
+                        value = json.loads(value)
+                        self._remember(key, stamp, value)
+                        for index in indices:
+                            results[index] = (True, value)
+                        disk_hits += len(indices)
+
+                if stale:
+                    self._db.executemany("DELETE FROM results WHERE key = ?", stale)
+                    self._db.commit()
+
+            misses = len(keys) - hits - disk_hits
+            for name, value in (('hits', hits), ('disk_hits', disk_hits), ('misses', misses), ('invalidations', invalidations)):
+                self.counters[name] += value
+                if value:
+                    instrumentation.count('result_cache.' + name, value)
+
+        return results
+
+    def _remember(self, key, stamp, value):
+        self._memory[key] = (stamp, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last = False)
+            self.counters['evictions'] += 1
+
+    def _put(self, entries):
+        # entries are (key, stamp, value) tuples
+        with self._lock:
+            for key, stamp, value in entries:
+                self._remember(key, stamp, value)
+
+            if self._db is not None and entries:
+                self._db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                                     [(self._text_key(key), stamp, json.dumps(value), time.time()) for key, stamp, value in entries])
+                self._db.commit()
+
+    #------ queries ------#
+
+    def uvi_many(self, lats, longs, utc_times, ozone_for_day = ozone.get_ozone_grid):
+        """
+        Returns the clear-sky UVI for each (lat, long, UTC time), computing only the quantized queries which are not cached.
+        The misses are computed together in one vectorised pass, with one ozone grid per UTC day.
+
+        Returns:
+            uvi (float array): the clear-sky UVI of each query
+        """
+
+        lats, longs = self.quantize_coordinates(lats, longs)
+        times = self.quantize_times(utc_times)
+        lats, longs, times = np.broadcast_arrays(lats, longs, times)
+        shape = lats.shape
+        lats, longs, times = lats.ravel(), longs.ravel(), times.ravel()
+
+        keys = list(zip(lats.tolist(), longs.tolist(), times.astype('datetime64[us]').view(np.int64).tolist()))
+        uvi = np.empty(len(keys))
+
+        # one stamp per UTC day, taken before computing so that a grid replaced in the meantime invalidates the new entries
+        days, day_index = np.unique(times.astype('datetime64[D]'), return_inverse = True)
+        day_stamps = [self.ozone_stamp(day) for day in days]
+        query_stamps = [day_stamps[index] for index in day_index.ravel().tolist()]
+
+        pending, stamps = {}, {}
+        for ii, (key, stamp, (found, value)) in enumerate(zip(keys, query_stamps, self._get_many(keys, query_stamps))):
+            if found:
+                uvi[ii] = value
+            else:
+                pending.setdefault(key, []).append(ii)
+                stamps[key] = stamp
+
+        if pending:
+            first = np.array([indices[0] for indices in pending.values()])
+            tot_ozone = np.empty(len(first))
+            days = times[first].astype('datetime64[D]')
+            for day in np.unique(days):
+                on_day = days == day
+                tot_ozone[on_day] = ozone_for_day(day.astype(datetime)).thickness(lats[first][on_day], longs[first][on_day])
+
+            values = incident_UV.clear_sky_UVI_at(lat = lats[first], long = longs[first], utc_time = times[first], tot_ozone = tot_ozone)
+
+            entries = []
+            for (key, indices), ii, value in zip(pending.items(), first, values.tolist()):
+                uvi[indices] = value
+                entries.append((key, stamps[key], value))
+            self._put(entries)
+
+        return uvi.reshape(shape)
+
+    def uvi(self, lat, long, utc_time, ozone_for_day = ozone.get_ozone_grid):
+        """
+        Returns the clear-sky UVI at a location and UTC time (see `uvi_many`).
+        """
+
+        return float(self.uvi_many(lat, long, utc_time, ozone_for_day = ozone_for_day))
+
+    def dose_many(self, jobs, ozone_for_day = ozone.get_ozone_grid, method = "trapezoid", step = 300):
+        """
+        Cached version of `dose.dose_batch`: returns the clear-sky dose for many (lat, long, start, end) jobs, only
+        integrating the quantized jobs which are not cached.
+
+        Returns:
+            results (DataFrame): one row per job with latitude, longitude, start, end, dose (J/m^2) and samples columns
+        """
+
+        import pandas as pd
+
+        quantized = []
+        for lat, long, start, end in jobs:
+            lat, long = self.quantize_coordinates(lat, long)
+            quantized.append((float(lat), float(long), self.quantize_times(start)[()], self.quantize_times(end)[()]))
+
+        day_stamps = {}
+        keys = ["dose|{}|{}|{}|{}|{}|{}".format(lat, long, start, end, method, step) for lat, long, start, end in quantized]
+        job_stamps = [self.ozone_stamp(np.arange(start.astype('datetime64[D]'), end.astype('datetime64[D]') + 1), day_stamps = day_stamps)
+                      for _, _, start, end in quantized]
+
+        results, pending, stamps = [None] * len(quantized), {}, {}
+        for ii, (key, stamp, (found, value)) in enumerate(zip(keys, job_stamps, self._get_many(keys, job_stamps))):
+            if found:
+                results[ii] = value
+            else:
+                pending.setdefault(key, []).append(ii)
+                stamps[key] = stamp
+
+        if pending:
+            first = [indices[0] for indices in pending.values()]
+            table = dose.dose_batch([quantized[ii] for ii in first], ozone_for_day = ozone_for_day, method = method, step = step)
+
+            entries = []
+            for (key, indices), ii, row in zip(pending.items(), first, table.itertuples(index = False)):
+                value = [float(row.dose), int(row.samples)]
+                for index in indices:
+                    results[index] = value
+                entries.append((key, stamps[key], value))
+            self._put(entries)
+
+        return pd.DataFrame({
+            'latitude': [job[0] for job in quantized],
+            'longitude': [job[1] for job in quantized],
+            'start': np.array([job[2] for job in quantized], dtype = 'datetime64[us]'),
+            'end': np.array([job[3] for job in quantized], dtype = 'datetime64[us]'),
+            'dose': [result[0] for result in results],
+            'samples': [result[1] for result in results],
+        })
+
+    def dose(self, lat, long, start, end, ozone_for_day = ozone.get_ozone_grid, method = "trapezoid", step = 300):
+        """
+        Returns the clear-sky dose in J/m^2 at a location over a UTC window (see `dose_many`).
+        """
+
+        return float(self.dose_many([(lat, long, start, end)], ozone_for_day = ozone_for_day, method = method, step = step)['dose'].iloc[0])
+
+    #------ maintenance ------#
+
+    def stats(self):
+        """
+        Returns the hit, disk hit, miss, invalidation and eviction counts, the hit rate and the number of entries held in memory.
+        """
+
+        with self._lock:
+            stats = dict(self.counters, entries = len(self._memory))
+
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM results")
+                self._db.commit()
+
+
+_cache = None
+
+
+def get_cache():
+    """
+    Returns the process-wide result cache (in memory only), creating it on first use.
+    """
+
+    global _cache
+    if _cache is None:
+        _cache = ResultCache()
+
+    return _cache
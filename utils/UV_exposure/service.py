@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import json
+import numpy as np
+import threading
+import time
+
+from collections import deque
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl, urlsplit
+
+from . import dose
+from . import geocoding
+from . import incident_UV
+from . import instrumentation
+from . import ozone
+from . import timezones
+
+
+class UVService:
+    """
+    A long-running UV query service. Ozone grids, the timezone resolver and geocoding results stay warm in memory
+    between queries, and concurrent queries are collected for `batch_window` seconds so that each batch is computed
+    in a single vectorised pass.
+
+    Endpoints (GET with query parameters, or POST with a JSON object or a list of objects):
+        /uvi   location or lat/long, and optionally time (UTC, ISO 8601) or local_time. Without a time the current UVI is returned.
+        /dose  location or lat/long, start and end (UTC, ISO 8601) and optionally step (seconds)
+        /stats request counters, latency, throughput and the time spent in each stage (see `instrumentation`)
+    """
+
+    def __init__(self, cloud_client = None, ozone_for_day = ozone.get_ozone_grid, geocoder = None, batch_window = 0.002, result_cache = None,
+                 data_dir = "./data/"):
+        # `geocoder` is a `geocoding.GeocodingCache`; the process-wide cache is used by default.
+        # `result_cache` is an optional `result_cache.ResultCache`, which answers repeated queries without recomputing them.
+        self.cloud_client = cloud_client
+        self.ozone_for_day = ozone_for_day
+        self.geocoder = geocoder
+        self.batch_window = batch_window
+        self.result_cache = result_cache
+        self.data_dir = data_dir
+
+        self._ozone_grids = {}
+        self._lock = threading.Lock()
+        self._queues = {'uvi': [], 'dose': []}
+
+        self.started = time.monotonic()
+        self.counters = {'requests': 0, 'errors': 0, 'uvi_queries': 0, 'uvi_batches': 0, 'dose_queries': 0, 'dose_batches': 0}
+        self._latencies = deque(maxlen = 10000)
+
+    #------ warm caches ------#
+
+    def ozone_grid(self, date):
+        """
+        Returns the ozone grid for a date, loading it on first use. The grid is reloaded once its file in `data_dir`
+        changes (see `ozone.grid_stamp`), e.g. when NASA publishes a day that was approximated by an earlier one.
+        """
+
+        date = datetime(date.year, date.month, date.day)
+        stamp = ozone.grid_stamp(date, data_dir = self.data_dir)
+        with self._lock:
+            cached = self._ozone_grids.get(date)
+
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        grid = self.ozone_for_day(date)
+        with self._lock:
+            self._ozone_grids[date] = (stamp, grid)
+
+        return grid
+
+    def geocode(self, location):
+        """
+        Returns the (lat, long) of a location string from the geocoding cache (see `geocoding.GeocodingCache`).
+        """
+
+        if self.geocoder is None:
+            self.geocoder = geocoding.get_geocoder()
+
+        return self.geocoder.geocode(location)
+
+    #------ queries ------#
+
+    async def _coordinates(self, params):
+        if 'lat' in params and 'long' in params:
+            return float(params['lat']), float(params['long'])
+        if 'location' in params:
+            return await asyncio.to_thread(self.geocode, params['location'])
+
+        raise Exception("Either location or lat and long must be given.")
+
+    async def _utc_time(self, params, lat, long, key = 'time'):
+        if key in params:
+            utc_time = datetime.fromisoformat(params[key])
+            if utc_time.tzinfo is not None:
+                utc_time = utc_time.astimezone(timezone.utc).replace(tzinfo = None)
+            return utc_time
+
+        if key == 'time' and 'local_time' in params:
+            import pytz
+
+            timezone_str = await asyncio.to_thread(timezones.get_resolver().timezone_at, lat, long)
+            local_time = pytz.timezone(timezone_str).localize(datetime.fromisoformat(params['local_time']))
+            return local_time.astimezone(pytz.UTC).replace(tzinfo = None)
+
+        return datetime.utcnow().replace(second = 0, microsecond = 0)
+
+    async def _submit(self, kind, item):
+        """
+        Adds a query to the batch queue of its kind. The first query of a batch schedules the flush.
+        """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queue = self._queues[kind]
+        queue.append((item, future))
+        if len(queue) == 1:
+            loop.call_later(self.batch_window, lambda: asyncio.ensure_future(self._flush(kind)))
+
+        return await future
+
+    async def _flush(self, kind):
+        batch, self._queues[kind] = self._queues[kind], []
+        items = [item for item, _ in batch]
+
+        compute = self._compute_uvi if kind == 'uvi' else self._compute_dose
+        try:
+            results = await asyncio.to_thread(compute, items)
+        except Exception:
+            # One bad query (e.g. a date without ozone data) should not fail the rest of the batch, so the queries
+            # are retried one at a time and only the ones that fail again get the error
+            results = await asyncio.to_thread(self._compute_each, compute, items)
+
+        self.counters[kind + '_batches'] += 1
+        self.counters[kind + '_queries'] += len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    @staticmethod
+    def _compute_each(compute, items):
+        results = []
+        for item in items:
+            try:
+                results.append(compute([item])[0])
+            except Exception as exc:
+                results.append(exc)
+
+        return results
+
+    def _compute_uvi(self, items):
+        lats = np.array([item[0] for item in items])
+        longs = np.array([item[1] for item in items])
+        times = np.array([item[2] for item in items], dtype = 'datetime64[us]')
+
+        if self.result_cache is not None:
+            return self.result_cache.uvi_many(lats, longs, times, ozone_for_day = self.ozone_grid).tolist()
+
+        # one ozone grid per UTC day in the batch
+        tot_ozone = np.empty(len(items))
+        days = times.astype('datetime64[D]')
+        for day in np.unique(days):
+            on_day = days == day
+            tot_ozone[on_day] = self.ozone_grid(day.astype(datetime)).thickness(lats[on_day], longs[on_day])
+
+        return incident_UV.clear_sky_UVI_at(lat = lats, long = longs, utc_time = times, tot_ozone = tot_ozone).tolist()
+
+    def _compute_dose(self, items):
+        results = []
+        for step in sorted({item[4] for item in items}):
+            jobs = [item[:4] for item in items if item[4] == step]
+            compute = dose.dose_batch if self.result_cache is None else self.result_cache.dose_many
+            table = compute(jobs, ozone_for_day = self.ozone_grid, step = step)
+            results.append((step, iter(table.itertuples(index = False))))
+
+        # put the results back into the order of the queries
+        by_step = dict(results)
+        return [next(by_step[item[4]]) for item in items]
+
+    async def uvi(self, params):
+        lat, long = await self._coordinates(params)
+        current = 'time' not in params and 'local_time' not in params
+        utc_time = await self._utc_time(params, lat, long)
+
+        result = {'latitude': lat, 'longitude': long, 'utc_time': utc_time.isoformat(), 'clear_sky_uvi': await self._submit('uvi', (lat, long, utc_time))}
+
+        if current and self.cloud_client is not None:
+            result['cmf'] = await asyncio.to_thread(self.cloud_client.cloud_mod_factor, lat, long)
+            result['uvi'] = result['cmf'] * result['clear_sky_uvi']
+
+        return result
+
+    async def dose(self, params):
+        lat, long = await self._coordinates(params)
+        if 'start' not in params or 'end' not in params:
+            raise Exception("Both start and end must be given.")
+
+        start = await self._utc_time(params, lat, long, key = 'start')
+        end = await self._utc_time(params, lat, long, key = 'end')
+        step = float(params.get('step', 300))
+        if not step > 0:
+            raise Exception("step must be a positive number of seconds.")
+
+        row = await self._submit('dose', (lat, long, start, end, step))
+
+        return {'latitude': lat, 'longitude': long, 'start': start.isoformat(), 'end': end.isoformat(), 'dose': float(row.dose), 'samples': int(row.samples)}
+
+    def stats(self):
+        """
+        Returns the request counters, the latency distribution in milliseconds and the throughput in requests per second.
+        """
+
+        uptime = time.monotonic() - self.started
+        latencies = np.array(self._latencies) * 1000
+        stats = dict(self.counters, uptime_s = uptime, throughput_rps = self.counters['requests'] / uptime if uptime else 0.0,
+                     ozone_grids_cached = len(self._ozone_grids))
+
+        if self.geocoder is not None:
+            stats['geocoding'] = self.geocoder.stats()
+        if self.result_cache is not None:
+            stats['result_cache'] = self.result_cache.stats()
+
+        stats['stages'] = instrumentation.report()
+
+        if len(latencies):
+            stats.update(latency_ms_mean = float(latencies.mean()), latency_ms_p50 = float(np.percentile(latencies, 50)),
+                         latency_ms_p95 = float(np.percentile(latencies, 95)), latency_ms_max = float(latencies.max()))
+
+        return stats
+
+    #------ HTTP ------#
+
+    async def handle(self, path, params):
+        """
+        Answers a single query (or a list of queries) for an endpoint and returns the HTTP status and the JSON payload.
+        """
+
+        endpoints = {'/uvi': self.uvi, '/dose': self.dose}
+
+        if path == '/stats':
+            return 200, self.stats()
+        if path not in endpoints:
+            return 404, {'error': 'Unknown endpoint {}'.format(path)}
+
+        started = time.monotonic()
+        self.counters['requests'] += 1
+        try:
+            if isinstance(params, list):
+                payload = await asyncio.gather(*[endpoints[path](query) for query in params])
+            else:
+                payload = await endpoints[path](params)
+            status = 200
+        except Exception as exc:
+            self.counters['errors'] += 1
+            status, payload = 400, {'error': str(exc)}
+
+        self._latencies.append(time.monotonic() - started)
+        return status, payload
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                url = urlsplit(target)
+                try:
+                    params = json.loads(body) if method == 'POST' and body else dict(parse_qsl(url.query))
+                except ValueError:
+                    status, payload = 400, {'error': 'The request body is not valid JSON.'}
+                else:
+                    status, payload = await self.handle(url.path, params)
+
+                data = json.dumps(payload).encode()
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                    status, 'OK' if status == 200 else 'Error', len(data), 'keep-alive' if keep_alive else 'close').encode() + data)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host = '127.0.0.1', port = 8080):
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Serve UV index and dose queries over HTTP/JSON.")
+    parser.add_argument("--host", type = str, default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8080)
+    parser.add_argument("--weatherstack_api_key", help = "Enables the real (cloud-adjusted) UV index for current queries.", type = str, default = None)
+    parser.add_argument("--result_cache", help = "Memoize UVI and dose results in memory.", action = "store_true")
+    parser.add_argument("--result_cache_path", help = "Also keep memoized results in this SQLite file, e.g. ./data/result_cache.sqlite.", type = str, default = None)
+    args = parser.parse_args()
+
+    cloud_client = None
+    if args.weatherstack_api_key:
+        from .cloud_cover import get_client
+
+        cloud_client = get_client(args.weatherstack_api_key)
+
+    result_cache = None
+    if args.result_cache or args.result_cache_path:
+        from .result_cache import ResultCache
+
+        result_cache = ResultCache(path = args.result_cache_path)
+
+    asyncio.run(UVService(cloud_client = cloud_client, result_cache = result_cache).serve(host = args.host, port = args.port))
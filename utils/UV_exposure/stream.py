@@ -0,0 +1,124 @@
+import numpy as np
+import time
+
+from collections import namedtuple
+from datetime import datetime
+
+from . import dose
+from . import incident_UV
+
+
+UVChunk = namedtuple("UVChunk", ["times", "uvi", "dose"])
+UVChunk.__doc__ = "A chunk of UTC sample times, the clear-sky UVI at each time and the cumulative dose in J/m^2 since the start of the stream."
+
+UVSample = namedtuple("UVSample", ["time", "uvi", "dose"])
+UVSample.__doc__ = "A single live sample: the UTC time, the clear-sky UVI and the cumulative dose in J/m^2."
+
+
+def _ozone_values(tot_ozone, times):
+    return tot_ozone(times) if callable(tot_ozone) else tot_ozone
+
+
+def stream_uvi(lat, long, start, end = None, step = 60, chunk_size = 1440, tot_ozone = None):
+    """
+    Yields the clear-sky UVI and cumulative dose at a location in chunks of `chunk_size` samples, `step` seconds apart.
+    Only one chunk is held in memory at a time, so arbitrarily long ranges can be streamed. The dose is accumulated with
+    the trapezoid rule and carried over from one chunk to the next.
+
+    Parameters:
+        lat (float): latitude coordinate of the location
+        long (float): longitude coordinate of the location
+        start (datetime/datetime64): the first sample time in UTC
+        end (datetime/datetime64): the last sample time in UTC, or None to stream forever
+        step (float): the time between samples in seconds
+        chunk_size (int): the number of samples in each chunk (the last chunk may be shorter)
+        tot_ozone (float or callable): ozone in Dobson units, or a function of the sample times. Defaults to each UTC day's ozone grid.
+
+    Yields:
+        chunk (UVChunk): datetime64[us] times, UVI and cumulative dose arrays
+    """
+
+    # checked here rather than in the generator, so that bad arguments fail straight away
+    if not step >= 1e-6:
+        raise Exception("step must be a positive number of seconds (at least a microsecond), got {}.".format(step))
+    if not chunk_size >= 1:
+        raise Exception("chunk_size must be at least 1, got {}.".format(chunk_size))
+
+    if tot_ozone is None:
+        tot_ozone = dose.ozone_by_day(lat, long)
+
+    return _stream_uvi(lat, long, incident_UV._as_datetime64(start), None if end is None else incident_UV._as_datetime64(end), step, int(chunk_size), tot_ozone)
+
+
+def _stream_uvi(lat, long, start, end, step, chunk_size, tot_ozone):
+    step_us = np.timedelta64(int(round(step * 1e6)), 'us')
+
+    offsets = np.arange(chunk_size) * step_us
+    chunk_start = start
+    previous_uvi, cumulative_dose = None, 0.0
+
+    while end is None or chunk_start <= end:
+        times = chunk_start + offsets
+        if end is not None:
+            times = times[times <= end]
+
+        uvi = incident_UV.clear_sky_UVI_at(lat = lat, long = long, utc_time = times, tot_ozone = _ozone_values(tot_ozone, times))
+
+        # trapezoid increments, joining on to the last sample of the previous chunk
+        joined = uvi if previous_uvi is None else np.concatenate([[previous_uvi], uvi])
+        increments = (joined[1:] + joined[:-1]) / 2 * step * dose.UVI_TO_IRRADIANCE
+        if previous_uvi is None:
+            increments = np.concatenate([[0.0], increments])
+
+        cumulative = cumulative_dose + np.cumsum(increments)
+        cumulative_dose, previous_uvi = cumulative[-1], uvi[-1]
+
+        yield UVChunk(times = times, uvi = uvi, dose = cumulative)
+
+        chunk_start = chunk_start + chunk_size * step_us
+
+
+def live_uvi(lat, long, interval_minutes = 5, tot_ozone = None, clock = datetime.utcnow, sleep = time.sleep):
+    """
+    Yields a new sample every `interval_minutes`, aligned to whole intervals of UTC time, and updates the cumulative dose
+    incrementally from the previous sample rather than recomputing it from the start.
+
+    `clock` and `sleep` can be replaced, e.g. to replay a period faster than real time.
+
+    Yields:
+        sample (UVSample): the sample time, clear-sky UVI and cumulative dose in J/m^2
+    """
+
+    if not interval_minutes * 60 >= 1e-6:
+        raise Exception("interval_minutes must be positive, got {}.".format(interval_minutes))
+
+    if tot_ozone is None:
+        tot_ozone = dose.ozone_by_day(lat, long)
+
+    return _live_uvi(lat, long, interval_minutes, tot_ozone, clock, sleep)
+
+
+def _live_uvi(lat, long, interval_minutes, tot_ozone, clock, sleep):
+    interval = np.timedelta64(int(round(interval_minutes * 60e6)), 'us')
+    previous = None
+    cumulative_dose = 0.0
+
+    while True:
+        now = incident_UV._as_datetime64(clock())
+
+        # wait until the next whole interval after the previous sample
+        sample_time = now + (-(now - np.datetime64(0, 'us')) % interval)
+        if previous is not None:
+            sample_time = max(sample_time, previous[0] + interval)
+        wait = (sample_time - now) / np.timedelta64(1, 's')
+        if wait > 0:
+            sleep(wait)
+
+        uvi = float(incident_UV.clear_sky_UVI_at(lat = lat, long = long, utc_time = sample_time, tot_ozone = _ozone_values(tot_ozone, sample_time)))
+
+        if previous is not None:
+            elapsed = (sample_time - previous[0]) / np.timedelta64(1, 's')
+            cumulative_dose += (previous[1] + uvi) / 2 * elapsed * dose.UVI_TO_IRRADIANCE
+        previous = (sample_time, uvi)
+
+        yield UVSample(time = sample_time, uvi = uvi, dose = float(cumulative_dose))
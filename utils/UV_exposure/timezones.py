@@ -0,0 +1,153 @@
+import functools
+import numpy as np
+import os
+import threading
+import warnings
+
+from . import instrumentation
+
+
+class TimezoneResolver:
+    """
+    Finds the timezone name for coordinates. The tzwhere polygons are only loaded the first time they are needed and are
+    then shared by every lookup, and recent coordinates are kept in an LRU cache.
+
+    Optionally, a precomputed lookup table can be used. The table stores the timezone at every corner of a regular
+    lat/long lattice; a cell whose four corners share a timezone is answered straight from the table, while cells on a
+    border (or over the sea) fall back to the polygons.
+    """
+
+    def __init__(self, table_path = "./data/timezone_table.npz", cache_size = 4096, precision = 4):
+        self.table_path = table_path
+        self.precision = precision
+
+        self._tzwhere = None
+        self._table = None
+        self._lock = threading.Lock()
+        self._cached_polygon_lookup = functools.lru_cache(maxsize = cache_size)(self._polygon_lookup)
+
+        if table_path is not None and os.path.exists(table_path):
+            self.load_table(table_path)
+
+    def _polygons(self):
+        if self._tzwhere is None:
+            with self._lock:
+                if self._tzwhere is None:
+                    from tzwhere import tzwhere
+
+                    # we expect a warning here which is generated from the tzwhere package - suppress it.
+                    with warnings.catch_warnings(), instrumentation.span('timezones.load_polygons'):
+                        warnings.simplefilter("ignore")
+                        self._tzwhere = tzwhere.tzwhere()
+
+        return self._tzwhere
+
+    def _polygon_lookup(self, lat, long):
+        # only reached on a cache miss
+        polygons = self._polygons()
+        instrumentation.count('timezones.polygon_lookups')
+        with instrumentation.span('timezones.polygon_lookup'):
+            return polygons.tzNameAt(lat, long)
+
+    def timezone_at(self, lat, long):
+        """
+        Returns the timezone name (e.g. 'Europe/London') at a location, or None if the location is not in any timezone polygon.
+        """
+
+        lat, long = round(float(lat), self.precision), round(float(long), self.precision)
+
+        name = self._table_lookup(lat, long)
+        if name is not None:
+            instrumentation.count('timezones.table_hits')
+            return name
+
+        return self._cached_polygon_lookup(lat, long)
+
+    def timezones_at(self, lats, longs):
+        """
+        Batch version of `timezone_at`. Coordinates are broadcast against each other and duplicates are only resolved once.
+
+        Returns:
+            names (object array): the timezone name for each location
+        """
+
+        lats, longs = np.broadcast_arrays(np.round(np.asarray(lats, dtype = float), self.precision),
+                                          np.round(np.asarray(longs, dtype = float), self.precision))
+
+        coords = np.stack([lats.ravel(), longs.ravel()], axis = 1)
+        unique_coords, inverse = np.unique(coords, axis = 0, return_inverse = True)
+
+        names = np.array([self.timezone_at(lat, long) for lat, long in unique_coords], dtype = object)
+
+        return names[inverse.ravel()].reshape(lats.shape)
+
+    def cache_info(self):
+        return self._cached_polygon_lookup.cache_info()
+
+    def _table_lookup(self, lat, long):
+        if self._table is None:
+            return None
+
+        codes, names, resolution = self._table
+        row = int((lat + 90) // resolution)
+        col = int((long + 180) // resolution)
+        if not (0 <= row < codes.shape[0] - 1 and 0 <= col < codes.shape[1] - 1):
+            return None
+
+        corners = codes[row:row + 2, col:col + 2]
+        if corners[0, 0] < 0 or np.any(corners != corners[0, 0]):
+            return None
+
+        return names[corners[0, 0]]
+
+    def build_table(self, resolution = 1.0, path = None):
+        """
+        Builds the lookup table by resolving every lattice corner with the polygons and saves it to `path`
+        (by default the resolver's `table_path`). This is slow, but only needs to be done once.
+        """
+
+        lat_corners = np.arange(-90, 90 + resolution / 2, resolution)
+        long_corners = np.arange(-180, 180 + resolution / 2, resolution)
+
+        names = []
+        codes = np.full((len(lat_corners), len(long_corners)), -1, dtype = np.int16)
+        for ii, lat in enumerate(lat_corners):
+            for jj, long in enumerate(long_corners):
+                name = self._polygons().tzNameAt(float(lat), float(long))
+                if name is None:
+                    continue
+                if name not in names:
+                    names.append(name)
+                codes[ii, jj] = names.index(name)
+
+        path = path or self.table_path
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            np.savez(path, codes = codes, names = np.array(names), resolution = resolution)
+
+        self._table = (codes, names, resolution)
+        return path
+
+    def load_table(self, path):
+        with np.load(path) as table:
+            self._table = (table['codes'], [str(name) for name in table['names']], float(table['resolution']))
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_resolver():
+    """
+    Returns the process-wide timezone resolver, creating it on first use.
+    """
+
+    global _resolver
+    if _resolver is None:
+        with _resolver_lock:
+            if _resolver is None:
+                _resolver = TimezoneResolver()
+
+    return _resolver
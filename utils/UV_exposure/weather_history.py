@@ -0,0 +1,361 @@
+import numpy as np
+import os
+
+from datetime import datetime
+
+from . import cloud_cover
+from . import dose
+from . import incident_UV
+from . import instrumentation
+from . import ozone
+
+
+# Cloud cover in tenths, the scale of the bands in `cloud_cover.cloud_mod_factor`, assumed for each meteostat weather
+# condition code (https://dev.meteostat.net/formats.html). Only clear, fair and cloudy skies leave gaps in the cloud;
+# fog, precipitation and storms are treated as overcast.
+COCO_CLOUD_COVER = {
+    1: 0,   # clear
+    2: 3,   # fair
+    3: 7,   # cloudy
+    4: 10,  # overcast
+}
+OVERCAST = 10
+N_COCO = 28
+
+
+def coco_cmf_table():
+    """
+    Returns an array mapping each meteostat condition code (0 to 27) to the cloud modification factor of
+    `cloud_cover.cloud_mod_factor`.
+    """
+
+    return np.array([cloud_cover.cloud_mod_factor(COCO_CLOUD_COVER.get(code, OVERCAST)) for code in range(N_COCO)])
+
+
+class MeteostatBackend:
+    """
+    Fetches hourly weather station records from meteostat, as in `data/extract_weather_data.ipynb`.
+    """
+
+    def stations(self, bounds, start, end):
+        from meteostat import Stations
+
+        south, west, north, east = bounds
+        stations = Stations().bounds((north, west), (south, east)).inventory('hourly', (start, end)).fetch()
+
+        return stations[['latitude', 'longitude']].rename_axis('station').reset_index()
+
+    def hourly(self, station_ids, start, end):
+        from meteostat import Hourly
+
+        records = Hourly(list(station_ids), start, end).fetch().reset_index()
+        if 'station' not in records:
+            records.insert(0, 'station', station_ids[0])
+
+        return records[['station', 'time', 'coco']]
+
+
+class FixtureBackend:
+    """
+    Serves station and hourly records from local files or dataframes, for tests and offline runs.
+
+    `stations` has station, latitude and longitude columns and `hourly` has station, time (UTC) and coco columns.
+    Files can be CSV or Parquet.
+    """
+
+    def __init__(self, stations, hourly):
+        self._stations = _read_table(stations)
+        self._hourly = _read_table(hourly)
+        self._hourly['time'] = _to_datetime(self._hourly['time'])
+        self.calls = 0
+
+    def stations(self, bounds, start, end):
+        self.calls += 1
+        south, west, north, east = bounds
+        stations = self._stations
+
+        return stations[stations['latitude'].between(south, north) & stations['longitude'].between(west, east)].reset_index(drop = True)
+
+    def hourly(self, station_ids, start, end):
+        self.calls += 1
+        hourly = self._hourly
+
+        return hourly[hourly['station'].isin(list(station_ids)) & hourly['time'].between(start, end)].reset_index(drop = True)
+
+
+def _read_table(table):
+    import pandas as pd
+
+    if isinstance(table, pd.DataFrame):
+        return table.copy()
+    if str(table).endswith('.parquet'):
+        return pd.read_parquet(table)
+
+    return pd.read_csv(table, dtype = {'station': str})
+
+
+def _to_datetime(values):
+    import pandas as pd
+
+    return pd.to_datetime(values).astype('datetime64[us]')
+
+
+class HourlyWeather:
+    """
+    The hourly cloud modification factors of the weather stations in a region, held as a stations x hours array so
+    that they can be joined against UVI time series with plain indexing.
+
+    Hours without a condition code are filled from the nearest reported hour of the same station within `max_gap_hours`,
+    and otherwise left missing, with a cloud modification factor of NaN.
+    """
+
+    def __init__(self, stations, hourly, start, end, max_gap_hours = 3):
+        self.start = np.datetime64(datetime(start.year, start.month, start.day, start.hour), 'h')
+        self.end = np.datetime64(end, 'h')
+        n_hours = int((self.end - self.start) / np.timedelta64(1, 'h')) + 1
+
+        self.station_ids = np.asarray(stations['station']).astype(str)
+        self.latitudes = np.asarray(stations['latitude'], dtype = float)
+        self.longitudes = np.asarray(stations['longitude'], dtype = float)
+
+        codes = np.full((len(self.station_ids), n_hours), -1, dtype = np.int16)
+        if len(hourly):
+            station_index = {station: ii for ii, station in enumerate(self.station_ids)}
+            rows = np.array([station_index.get(str(station), -1) for station in hourly['station']])
+            hours = ((_to_datetime(hourly['time']).to_numpy().astype('datetime64[h]') - self.start) / np.timedelta64(1, 'h')).astype(np.int64)
+            coco = np.asarray(hourly['coco'], dtype = float)
+
+            keep = (rows >= 0) & (hours >= 0) & (hours < n_hours) & ~np.isnan(coco)
+            codes[rows[keep], hours[keep]] = np.clip(coco[keep], 0, N_COCO - 1).astype(np.int16)
+
+        self.reported = (codes >= 0).mean(axis = 1) if n_hours else np.zeros(len(codes))
+        codes = _fill_codes(codes, max_gap_hours)
+
+        cmf_table = np.append(coco_cmf_table(), np.nan)
+        self.cmf_by_hour = cmf_table[np.where(codes >= 0, codes, N_COCO)]
+
+    def nearest_station(self, lat, long):
+        """
+        Returns the index of the nearest station which reported any data, and its distance in km, for each location.
+        """
+
+        lat, long = np.broadcast_arrays(np.asarray(lat, dtype = float), np.asarray(long, dtype = float))
+        if not np.any(self.reported > 0):
+            raise Exception("There are no weather records for this region and period.")
+
+        # haversine distance from every location to every station
+        lat1, long1 = np.radians(lat)[..., None], np.radians(long)[..., None]
+        lat2, long2 = np.radians(self.latitudes), np.radians(self.longitudes)
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2) ** 2
+        distance = 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+        distance[..., self.reported == 0] = np.inf
+
+        index = np.argmin(distance, axis = -1)
+
+        return index, np.take_along_axis(distance, index[..., None], axis = -1)[..., 0]
+
+    def cmf(self, station, utc_time):
+        """
+        Returns the cloud modification factor at the given station indices and UTC times, which are broadcast together.
+        Hours without weather records give NaN. Times outside the period use the first or last hour.
+        """
+
+        hours = ((incident_UV._as_datetime64(utc_time).astype('datetime64[h]') - self.start) / np.timedelta64(1, 'h')).astype(np.int64)
+
+        return self.cmf_by_hour[station, np.clip(hours, 0, self.cmf_by_hour.shape[1] - 1)]
+
+
+def _fill_codes(codes, max_gap_hours):
+    """
+    Fills missing (-1) condition codes from the nearest reported hour of the same station, up to `max_gap_hours` away.
+    """
+
+    n_hours = codes.shape[1]
+    hours = np.arange(n_hours)
+    reported = codes >= 0
+
+    previous = np.maximum.accumulate(np.where(reported, hours, -1), axis = 1)
+    following = np.minimum.accumulate(np.where(reported, hours, n_hours)[:, ::-1], axis = 1)[:, ::-1]
+
+    use_previous = ~reported & (previous >= 0) & (hours - previous <= max_gap_hours)
+    use_following = ~reported & ~use_previous & (following < n_hours) & (following - hours <= max_gap_hours)
+    # prefer whichever reported hour is closer
+    closer = use_previous & (following < n_hours) & (following - hours < hours - previous)
+    use_following |= closer
+    use_previous &= ~closer
+
+    filled = codes.copy()
+    filled[use_previous] = np.take_along_axis(codes, np.clip(previous, 0, n_hours - 1), axis = 1)[use_previous]
+    filled[use_following] = np.take_along_axis(codes, np.clip(following, 0, n_hours - 1), axis = 1)[use_following]
+
+    return filled
+
+
+class WeatherArchive:
+    """
+    Bulk-loads hourly weather records for a region and period from a backend once, and keeps them in a local
+    Parquet cache so that later runs over the same region and period do not touch the network.
+    """
+
+    def __init__(self, cache_dir = "./data/weather/", backend = None):
+        self.cache_dir = cache_dir
+        self._backend = backend
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = MeteostatBackend()
+
+        return self._backend
+
+    def _cache_paths(self, bounds, start, end):
+        key = "_".join("{:.2f}".format(value) for value in bounds) + "_" + start.strftime("%Y%m%d%H") + "_" + end.strftime("%Y%m%d%H")
+
+        return os.path.join(self.cache_dir, "stations_" + key + ".parquet"), os.path.join(self.cache_dir, "hourly_" + key + ".parquet")
+
+    def load(self, bounds, start, end, max_gap_hours = 3):
+        """
+        Returns the `HourlyWeather` for every station within `bounds` (south, west, north, east) from `start` to `end` (UTC).
+        """
+
+        import pandas as pd
+
+        start = datetime(start.year, start.month, start.day, start.hour)
+        end = datetime(end.year, end.month, end.day, end.hour)
+        stations_path, hourly_path = self._cache_paths(bounds, start, end)
+
+        if os.path.exists(stations_path) and os.path.exists(hourly_path):
+            instrumentation.count('weather_history.cache_hits')
+            stations, hourly = pd.read_parquet(stations_path), pd.read_parquet(hourly_path)
+        else:
+            instrumentation.count('weather_history.cache_misses')
+            with instrumentation.span('weather_history.fetch'):
+                stations = self.backend.stations(bounds, start, end)
+                hourly = self.backend.hourly(list(stations['station']), start, end) if len(stations) else pd.DataFrame({'station': [], 'time': [], 'coco': []})
+
+            stations = stations[['station', 'latitude', 'longitude']].astype({'station': str})
+            hourly = pd.DataFrame({'station': hourly['station'].astype(str), 'time': hourly['time'],
+                                   'coco': hourly['coco'].to_numpy(dtype = float, na_value = np.nan)})
+            hourly['time'] = _to_datetime(hourly['time'])
+
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            for table, path in ((stations, stations_path), (hourly, hourly_path)):
+                table.to_parquet(path + ".tmp", index = False)
+                os.replace(path + ".tmp", path)
+
+        instrumentation.count('weather_history.records', len(hourly))
+
+        return HourlyWeather(stations, hourly, start, end, max_gap_hours = max_gap_hours)
+
+    def load_sites(self, lats, longs, start, end, margin = 1.0, max_gap_hours = 3):
+        """
+        Returns the `HourlyWeather` for the region around a set of sites, padded by `margin` degrees.
+        """
+
+        lats, longs = np.asarray(lats, dtype = float), np.asarray(longs, dtype = float)
+        bounds = (max(lats.min() - margin, -90), max(longs.min() - margin, -180), min(lats.max() + margin, 90), min(longs.max() + margin, 180))
+
+        return self.load(bounds, start, end, max_gap_hours = max_gap_hours)
+
+
+def cloud_adjusted_doses(sites, start, end, weather = None, archive = None, ozone_for_day = ozone.get_ozone_grid, step = 300):
+    """
+    Computes the clear-sky and cloud-adjusted UV dose at many sites over the same UTC period. The clear-sky UVI of
+    every site is sampled every `step` seconds, a UTC day at a time, multiplied by the hourly cloud modification factor
+    of the site's nearest weather station and integrated with the trapezoid rule.
+
+    Daylight hours for which the station has no weather records are not assumed to be clear. The cloud-adjusted dose
+    of a site is NaN unless its whole period is covered; `weather_coverage` gives the covered fraction of the
+    clear-sky dose, and `mean_cmf` is measured over the covered hours, so `clear_sky_dose * mean_cmf` estimates the
+    dose of a partly covered period.
+
+    Parameters:
+        sites (list): (lat, long) tuples
+        start (datetime): the start of the period in UTC
+        end (datetime): the end of the period in UTC
+        weather (HourlyWeather): the weather records; by default they are loaded for the sites through `archive`
+        archive (WeatherArchive): the archive used when `weather` is not given; defaults to `get_archive()`
+        ozone_for_day (callable): returns the `OzoneGrid` for a date
+        step (float): the sample spacing in seconds
+
+    Returns:
+        results (DataFrame): one row per site with latitude, longitude, station, station_distance_km, clear_sky_dose,
+                             dose (J/m^2), weather_coverage and mean_cmf (the dose-weighted mean cloud modification
+                             factor of the covered hours) columns
+    """
+
+    import pandas as pd
+
+    lats = np.array([site[0] for site in sites], dtype = float)
+    longs = np.array([site[1] for site in sites], dtype = float)
+    start, end = incident_UV._as_datetime64(start), incident_UV._as_datetime64(end)
+
+    if weather is None:
+        weather = (archive or get_archive()).load_sites(lats, longs, start.item(), end.item())
+
+    station, distance = weather.nearest_station(lats, longs)
+
+    clear_sky_dose = np.zeros(len(lats))
+    covered_dose = np.zeros(len(lats))
+    cloud_dose = np.zeros(len(lats))
+    step_us = np.timedelta64(int(round(step * 1e6)), 'us')
+
+    with instrumentation.span('weather_history.doses'):
+        day = start.astype('datetime64[D]')
+        while day.astype('datetime64[us]') < end:
+            # samples for this day, including both ends so that consecutive days join up
+            day_start = max(start, day.astype('datetime64[us]'))
+            day_end = min(end, (day + 1).astype('datetime64[us]'))
+            times = np.append(np.arange(day_start, day_end, step_us), day_end)
+            widths = np.diff(times) / np.timedelta64(1, 's')
+
+            tot_ozone = ozone_for_day(day.astype(datetime)).thickness(lats, longs)
+            uvi = incident_UV.clear_sky_UVI_at(lat = lats[:, None], long = longs[:, None], utc_time = times[None, :], tot_ozone = np.asarray(tot_ozone, dtype = float)[:, None])
+            cmf = weather.cmf(station[:, None], times[None, :])
+
+            # a trapezoid is covered by the weather records if both of its ends are
+            reported = ~np.isnan(cmf)
+            covered = reported[:, 1:] & reported[:, :-1]
+            cloud_uvi = uvi * np.where(reported, cmf, 0)
+
+            clear_sky_areas = (uvi[:, 1:] + uvi[:, :-1]) / 2 * widths
+            clear_sky_dose += clear_sky_areas.sum(axis = 1)
+            covered_dose += np.where(covered, clear_sky_areas, 0).sum(axis = 1)
+            cloud_dose += np.where(covered, (cloud_uvi[:, 1:] + cloud_uvi[:, :-1]) / 2 * widths, 0).sum(axis = 1)
+
+            instrumentation.count('weather_history.samples', uvi.size)
+            day += 1
+
+    clear_sky_dose *= dose.UVI_TO_IRRADIANCE
+    covered_dose *= dose.UVI_TO_IRRADIANCE
+    cloud_dose *= dose.UVI_TO_IRRADIANCE
+
+    coverage = np.divide(covered_dose, clear_sky_dose, out = np.ones(len(lats)), where = clear_sky_dose > 0)
+    complete = np.isclose(covered_dose, clear_sky_dose)
+
+    return pd.DataFrame({
+        'latitude': lats,
+        'longitude': longs,
+        'station': weather.station_ids[station],
+        'station_distance_km': distance,
+        'clear_sky_dose': clear_sky_dose,
+        'dose': np.where(complete, cloud_dose, np.nan),
+        'weather_coverage': np.where(complete, 1.0, coverage),
+        'mean_cmf': np.divide(cloud_dose, covered_dose, out = np.where(clear_sky_dose > 0, np.nan, 1.0), where = covered_dose > 0),
+    })
+
+
+_archive = None
+
+
+def get_archive():
+    """
+    Returns the process-wide weather archive, creating it on first use.
+    """
+
+    global _archive
+    if _archive is None:
+        _archive = WeatherArchive()
+
+    return _archive